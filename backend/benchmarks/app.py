@@ -0,0 +1,28 @@
+"""just the door endpoints for running under a local uvicorn
+
+the full lockoff.main app talks to klubmodul and google wallet at startup,
+this one only loads the membership snapshot and runs the access log writer
+
+    DB_FILE=/tmp/lockoff-load.db3 uvicorn benchmarks.app:app --port 8765
+"""
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI
+
+from lockoff.access_log import access_log_writer
+from lockoff.membership import membership
+from lockoff.routers import reader
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await membership.rebuild()
+    access_log_task = asyncio.create_task(access_log_writer.runner())
+    yield
+    await access_log_writer.stop(access_log_task)
+
+
+app = FastAPI(title="lockoff door benchmark", lifespan=lifespan)
+app.include_router(reader.router)
@@ -0,0 +1,193 @@
+"""benchmark the door decision path
+
+times verify_access_token, check_qrcode against a seeded sqlite file and the
+full POST /reader-check-code through the asgi app - for every token type and
+with/without the android totp suffix (only members can have an android pass).
+The repeat scan cache is emptied before every call so each one is a full
+decision - check_qrcode_repeat times the cached answer to a repeat scan.
+
+    python -m benchmarks.door --output bench.json
+    python -m benchmarks.door --baseline bench.json --max-regression 0.25
+
+results are printed as json (p50/p95/p99 in ms and ops/sec). With --baseline
+the exit code is 1 if any case got slower than the baseline p95 allows. Every
+answer is checked - the run stops at the first one that is not a grant (an
+offpeak member may be outside hours) so a broken setup is not timed.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import pathlib
+import platform
+import sys
+from datetime import datetime
+
+GROUPS = ["token", "check", "asgi"]
+
+
+class UnexpectedVerdict(Exception):
+    pass
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="/tmp/lockoff-bench.db3")
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=100)
+    parser.add_argument(
+        "--groups", default=",".join(GROUPS), help="comma separated subset of " + ",".join(GROUPS)
+    )
+    parser.add_argument("--output", type=pathlib.Path, help="also write results here")
+    parser.add_argument("--baseline", type=pathlib.Path, help="results to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    return parser.parse_args(argv)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    # imported here as DB_FILE must be set before lockoff.db is imported
+    from lockoff.access_log import access_log_writer
+    from lockoff.access_token import TokenError, TokenType, verify_access_token
+    from lockoff.config import settings
+    from lockoff.membership import membership
+    from lockoff.misc import DISPLAY_CODES
+    from lockoff.routers.reader import check_qrcode, recent_grants
+
+    from .seed import MEMBER_TYPES, mint_token, seed
+    from .timing import measure
+
+    groups = set(args.groups.split(","))
+    population = await seed(members=args.members)
+    await membership.rebuild()
+    writer_task = asyncio.create_task(access_log_writer.runner())
+
+    cases: dict[str, tuple[TokenType, bool, list[int]]] = {}
+    for token_type in TokenType:
+        for android in [False, True] if token_type in MEMBER_TYPES else [False]:
+            ids = [
+                i
+                for i in population.ids(token_type)
+                if not android or i in population.totp_secrets
+            ]
+            name = token_type.name.lower() + ("_totp" if android else "")
+            cases[name] = (token_type, android, ids[:200])
+
+    def mint(name: str) -> list[str]:
+        # right before use - the totp suffix is only good for a few minutes
+        token_type, android, ids = cases[name]
+        return [mint_token(population, i, token_type, android=android) for i in ids]
+
+    def expect_grant(name: str, code: bytes) -> None:
+        if name.startswith("offpeak") and code == DISPLAY_CODES.OFFPEAK_OUTSIDE_HOURS:
+            return
+        raise UnexpectedVerdict(f"{name}: expected access granted but got {code!r}")
+
+    results = {}
+    for name in cases:
+        tokens = mint(name)
+        if "token" in groups:
+            it = itertools.cycle(tokens)
+            results[f"verify_access_token/{name}"] = await measure(
+                lambda: verify_access_token(next(it)),
+                iterations=args.iterations,
+                warmup=args.warmup,
+            )
+        if "check" in groups:
+            it = itertools.cycle(tokens)
+
+            async def check():
+                try:
+                    await check_qrcode(qr_code=next(it))
+                except TokenError as ex:
+                    # eg. offpeak outside hours - still a full decision
+                    expect_grant(name, ex.code)
+
+            async def fresh_check():
+                recent_grants.clear()
+                await check()
+
+            results[f"check_qrcode/{name}"] = await measure(
+                fresh_check, iterations=args.iterations, warmup=args.warmup
+            )
+            # every token scanned once so all the grants are cached
+            for _ in tokens:
+                await check()
+            results[f"check_qrcode_repeat/{name}"] = await measure(
+                check, iterations=args.iterations, warmup=args.warmup
+            )
+            recent_grants.clear()
+
+    if "asgi" in groups:
+        import httpx
+
+        from lockoff.main import app
+
+        async with httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            base_url="http://bench",
+            headers={"reader-token": settings.reader_token},
+        ) as client:
+            for name in cases:
+                it = itertools.cycle(mint(name))
+
+                async def post():
+                    recent_grants.clear()
+                    response = await client.post(
+                        "/reader-check-code", json={"qr_code": next(it)}
+                    )
+                    if response.status_code == 418:
+                        expect_grant(name, response.json()["detail"]["code"].encode())
+                    elif response.status_code != 200 or response.json()[
+                        "status"
+                    ] not in ["K", "J"]:
+                        raise UnexpectedVerdict(
+                            f"{name}: {response.status_code} {response.text}"
+                        )
+
+                results[f"reader-check-code/{name}"] = await measure(
+                    post, iterations=args.iterations, warmup=args.warmup
+                )
+
+    await access_log_writer.stop(writer_task)
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "members": args.members,
+            "iterations": args.iterations,
+        },
+        "results": results,
+    }
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    db = pathlib.Path(args.db)
+    db.unlink(missing_ok=True)
+    os.environ["DB_FILE"] = str(db)
+    # the door endpoints refuse every request if no reader token is configured
+    os.environ.setdefault("READER_TOKEN", "benchmark")
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+
+    if args.baseline:
+        from .timing import find_regressions, load_baseline
+
+        regressions = find_regressions(
+            report["results"], load_baseline(args.baseline), args.max_regression
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
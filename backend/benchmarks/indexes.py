@@ -0,0 +1,152 @@
+"""time the hot queries on a large seeded database before and after the migrations
+
+seeds members, google/apple passes and a year of access log, times every query
+on the bare tables (as create_db_tables leaves them), runs lockoff.migrations
+and times them again
+
+    python -m benchmarks.indexes --members 20000 --access-log 1000000
+
+results are printed as json - p50/p95 per query before and after and the
+speedup of the p50.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import platform
+import sys
+import time
+from datetime import datetime, timedelta
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="/tmp/lockoff-indexes.db3")
+    parser.add_argument("--members", type=int, default=20000)
+    parser.add_argument("--access-log", type=int, default=500000)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument("--output", type=pathlib.Path, help="also write results here")
+    return parser.parse_args(argv)
+
+
+def queries(members: int) -> dict:
+    """the hot queries of the app - as the routers run them"""
+    from lockoff.config import settings
+    from lockoff.db import AccessLog, APPass, APReg, GPass, Max, User
+    from lockoff.misc import simple_hash
+
+    user_id = members // 2
+    hour_ago = int((datetime.now(tz=settings.tz) - timedelta(hours=1)).timestamp())
+    return {
+        # auth.login / request_totp
+        "user_by_mobile": lambda: User.select(User.id, User.totp_secret).where(
+            User.mobile == simple_hash(f"{20000000 + user_id}"), User.active == True
+        ),
+        "user_by_email": lambda: User.select(User.id, User.totp_secret).where(
+            User.email == simple_hash(f"bench{user_id}@test.dk"), User.active == True
+        ),
+        # admin system-status
+        "last_batch_id": lambda: User.select(
+            Max(User.batch_id).as_alias("last_batch_id")
+        ).first(),
+        "latest_access": lambda: AccessLog.select()
+        .order_by(AccessLog.epoch, ascending=False)
+        .limit(20),
+        "access_by_member": lambda: AccessLog.select().where(
+            AccessLog.obj_id == user_id
+        ),
+        # public stats
+        "visitors_last_hour": lambda: AccessLog.count(
+            distinct=[AccessLog.obj_id]
+        ).where(AccessLog.epoch > hour_ago),
+        # totp cache
+        "gpass_by_user": lambda: GPass.select(GPass.totp).where(
+            GPass.user_id == user_id
+        ),
+        # apple wallet
+        "passes_for_device": lambda: APReg.select(
+            APReg.serial_number,
+            APReg.serial_number.join_on(APPass.id).update_tag.as_alias("update_tag"),
+        ).where(APReg.device_library_identifier == f"device-{user_id}-0"),
+        "devices_for_pass": lambda: APReg.select().where(
+            APReg.serial_number == f"{settings.current_season}{user_id}"
+        ),
+        "passes_updated_since": lambda: APPass.count().where(APPass.update_tag > 995),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    # imported here as DB_FILE must be set before lockoff.db is imported
+    from lockoff.migrations import migrate
+
+    from .seed import seed
+    from .timing import measure
+
+    start = time.perf_counter()
+    await seed(
+        members=args.members,
+        access_log_rows=args.access_log,
+        apple_share=0.3,
+    )
+    seed_seconds = time.perf_counter() - start
+
+    async def measure_all() -> dict:
+        results = {}
+        for name, query in queries(args.members).items():
+
+            async def fn(query=query):
+                await query()
+
+            results[name] = await measure(
+                fn, iterations=args.iterations, warmup=args.warmup
+            )
+        return results
+
+    before = await measure_all()
+    start = time.perf_counter()
+    applied = await migrate()
+    migrate_seconds = time.perf_counter() - start
+    after = await measure_all()
+
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "members": args.members,
+            "access_log_rows": args.access_log,
+            "iterations": args.iterations,
+            "seed_seconds": round(seed_seconds, 1),
+            "migrations_applied": applied,
+            "migrate_seconds": round(migrate_seconds, 2),
+        },
+        "results": {
+            name: {
+                "before": before[name],
+                "after": after[name],
+                "speedup_p50": round(before[name]["p50_ms"] / after[name]["p50_ms"], 1)
+                if after[name]["p50_ms"]
+                else None,
+            }
+            for name in before
+        },
+    }
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    db = pathlib.Path(args.db)
+    db.unlink(missing_ok=True)
+    os.environ["DB_FILE"] = str(db)
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,245 @@
+"""drive several simulated door readers against POST /reader-check-code
+
+every reader scans at --rate per second with poisson arrivals (open loop - a
+slow answer does not delay the next scan, so latency is measured from when the
+scan was due). Tokens are minted for a seeded population, members with a
+google wallet pass scan with the android totp suffix.
+
+against the asgi app in-process:
+
+    python -m benchmarks.load --readers 4 --rate 2 --duration 30
+
+against a local uvicorn (started as a subprocess on benchmarks.app):
+
+    python -m benchmarks.load --target uvicorn --workers 2 --readers 16 --rate 5
+
+the report is printed as json - latency percentiles overall and per reader,
+achieved vs offered rate and a count of every outcome (http status and the
+display code from the 418 detail).
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import os
+import pathlib
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+TARGETS = ["asgi", "uvicorn"]
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default="/tmp/lockoff-load.db3")
+    parser.add_argument("--members", type=int, default=2000)
+    parser.add_argument("--android-share", type=float, default=0.3)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=2.0, help="scans/sec per reader")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument(
+        "--bad-share", type=float, default=0.05, help="share of scans by non-members"
+    )
+    parser.add_argument("--target", choices=TARGETS, default="asgi")
+    parser.add_argument("--port", type=int, default=0, help="uvicorn port (0 = any free)")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--timeout", type=float, default=10.0)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", type=pathlib.Path, help="also write the report here")
+    return parser.parse_args(argv)
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def outcome(response) -> str:
+    if response.status_code == 418:
+        return f"418/{response.json().get('detail', {}).get('code', '?')}"
+    return str(response.status_code)
+
+
+async def start_uvicorn(args: argparse.Namespace) -> tuple[subprocess.Popen, str]:
+    import httpx
+
+    port = args.port or free_port()
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "benchmarks.app:app",
+            "--port",
+            str(port),
+            "--workers",
+            str(args.workers),
+            "--log-level",
+            "warning",
+            "--no-access-log",
+        ],
+        env={**os.environ, "DB_FILE": args.db},
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient() as client:
+        for _ in range(100):
+            try:
+                await client.get(f"{base_url}/docs")
+                return process, base_url
+            except httpx.TransportError:
+                await asyncio.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"uvicorn did not start on {base_url}")
+
+
+async def simulate_reader(
+    client,
+    number: int,
+    args: argparse.Namespace,
+    population,
+    deadline: float,
+    results: list,
+):
+    from lockoff.access_token import TokenType
+
+    from .seed import mint_token
+
+    rnd = random.Random(args.seed + number)
+    member_ids = list(population.members)
+    in_flight = set()
+
+    async def scan(qr_code: str, due: float):
+        try:
+            response = await client.post(
+                "/reader-check-code", json={"qr_code": qr_code}, timeout=args.timeout
+            )
+            result = outcome(response)
+        except Exception as ex:
+            result = f"error/{type(ex).__name__}"
+        results.append((number, time.perf_counter() - due, result))
+
+    due = time.perf_counter()
+    while True:
+        due += rnd.expovariate(args.rate)
+        if due > deadline:
+            break
+        if rnd.random() < args.bad_share:
+            # a valid token for someone who is not a member
+            user_id, token_type = max(member_ids) + 1 + rnd.randrange(1000), TokenType.NORMAL
+        else:
+            user_id = rnd.choice(member_ids)
+            token_type = population.members[user_id]
+        qr_code = mint_token(
+            population, user_id, token_type, android=user_id in population.totp_secrets
+        )
+        await asyncio.sleep(max(0.0, due - time.perf_counter()))
+        task = asyncio.create_task(scan(qr_code, due))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+    if in_flight:
+        await asyncio.wait(in_flight)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    # imported here as DB_FILE must be set before lockoff.db is imported
+    import httpx
+
+    from lockoff.access_log import access_log_writer
+    from lockoff.config import settings
+    from lockoff.membership import membership
+
+    from .seed import seed
+    from .timing import summarize
+
+    population = await seed(members=args.members, android_share=args.android_share)
+    headers = {"reader-token": settings.reader_token}
+    process, writer_task = None, None
+    if args.target == "uvicorn":
+        process, base_url = await start_uvicorn(args)
+        client = httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            limits=httpx.Limits(max_connections=None),
+        )
+    else:
+        from .app import app
+
+        await membership.rebuild()
+        writer_task = asyncio.create_task(access_log_writer.runner())
+        client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=app),
+            base_url="http://load",
+            headers=headers,
+        )
+
+    results: list[tuple[int, float, str]] = []
+    try:
+        async with client:
+            start = time.perf_counter()
+            await asyncio.gather(
+                *[
+                    simulate_reader(
+                        client, n, args, population, start + args.duration, results
+                    )
+                    for n in range(args.readers)
+                ]
+            )
+            elapsed = time.perf_counter() - start
+    finally:
+        if writer_task is not None:
+            await access_log_writer.stop(writer_task)
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    per_reader = collections.defaultdict(list)
+    for number, latency, _ in results:
+        per_reader[number].append(latency)
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "target": args.target,
+            "workers": args.workers if args.target == "uvicorn" else None,
+            "members": args.members,
+            "readers": args.readers,
+            "rate_per_reader": args.rate,
+            "duration": args.duration,
+        },
+        "offered_per_sec": round(args.readers * args.rate, 1),
+        "achieved_per_sec": round(len(results) / elapsed, 1),
+        "latency": summarize([latency for _, latency, _ in results], elapsed)
+        if results
+        else None,
+        "outcomes": dict(collections.Counter(result for _, _, result in results)),
+        "per_reader": {
+            str(number): summarize(samples, elapsed)
+            for number, samples in sorted(per_reader.items())
+        },
+    }
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    db = pathlib.Path(args.db)
+    db.unlink(missing_ok=True)
+    os.environ["DB_FILE"] = str(db)
+    # the door endpoints refuse every request if no reader token is configured
+    os.environ.setdefault("READER_TOKEN", "benchmark")
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+"""seed a sqlite file with a synthetic member population
+
+lockoff.db binds the engine to settings.db_file at import time, so set the
+DB_FILE environment variable before importing this module
+"""
+
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+import pyotp
+from piccolo.table import create_db_tables
+
+from lockoff.access_log import local_day_hour
+from lockoff.access_token import TokenMedia, TokenType, generate_access_token
+from lockoff.config import settings
+from lockoff.db import (
+    DB,
+    AccessLog,
+    APDevice,
+    APPass,
+    APReg,
+    DailyVisitors,
+    Dayticket,
+    GPass,
+    KlubmodulSync,
+    HourlyVisitors,
+    Otherticket,
+    OutboxMessage,
+    RollupWatermark,
+    User,
+    VisitDay,
+)
+from lockoff.misc import simple_hash
+
+TABLES = [
+    User,
+    Dayticket,
+    AccessLog,
+    APReg,
+    APDevice,
+    APPass,
+    GPass,
+    KlubmodulSync,
+    Otherticket,
+    OutboxMessage,
+    VisitDay,
+    DailyVisitors,
+    HourlyVisitors,
+    RollupWatermark,
+]
+
+MEMBER_TYPES = [
+    TokenType.NORMAL,
+    TokenType.OFFPEAK,
+    TokenType.JUNIOR_HOLD,
+    TokenType.BØRNE_HOLD,
+]
+
+
+@dataclass
+class Population:
+    members: dict[int, TokenType] = field(default_factory=dict)
+    othertickets: list[int] = field(default_factory=list)
+    daytickets: list[int] = field(default_factory=list)
+    # base32 totp secret for members with an android pass
+    totp_secrets: dict[int, str] = field(default_factory=dict)
+
+    def ids(self, token_type: TokenType) -> list[int]:
+        match token_type:
+            case TokenType.OTHER:
+                return self.othertickets
+            case TokenType.DAY_TICKET:
+                return self.daytickets
+            case _:
+                return [u for u, tt in self.members.items() if tt == token_type]
+
+
+def mint_token(
+    population: Population, user_id: int, token_type: TokenType, android: bool
+) -> str:
+    """a valid qr code as the reader would scan it"""
+    if android and user_id in population.totp_secrets:
+        token = generate_access_token(
+            user_id=user_id,
+            token_type=token_type,
+            token_media=TokenMedia.DIGITAL | TokenMedia.ANDROID,
+        ).decode()
+        return token + pyotp.TOTP(population.totp_secrets[user_id], digits=8).now()
+    return generate_access_token(
+        user_id=user_id, token_type=token_type, token_media=TokenMedia.PRINT
+    ).decode()
+
+
+async def _insert_chunked(table, rows: list, size: int = 500) -> None:
+    for i in range(0, len(rows), size):
+        async with DB.transaction():
+            await table.insert(*rows[i : i + size])
+
+
+async def seed(
+    members: int = 1000,
+    android_share: float = 0.3,
+    othertickets: int = 10,
+    daytickets: int = 100,
+    access_log_rows: int = 0,
+    apple_share: float = 0.0,
+    random_seed: int = 1234,
+) -> Population:
+    """create the tables and fill them - expects an empty database file"""
+    rnd = random.Random(random_seed)
+    await create_db_tables(*TABLES, if_not_exists=True)
+    population = Population()
+    batch_id = datetime.now(tz=settings.tz).isoformat(timespec="seconds")
+
+    users, gpasses = [], []
+    for user_id in range(1, members + 1):
+        token_type = MEMBER_TYPES[user_id % len(MEMBER_TYPES)]
+        population.members[user_id] = token_type
+        users.append(
+            User(
+                id=user_id,
+                name=f"bench user {user_id}",
+                token_type=token_type.value,
+                mobile=simple_hash(f"{20000000 + user_id}"),
+                email=simple_hash(f"bench{user_id}@test.dk"),
+                batch_id=batch_id,
+                totp_secret=pyotp.random_base32(),
+                active=True,
+            )
+        )
+        if rnd.random() < android_share:
+            secret = pyotp.random_base32()
+            population.totp_secrets[user_id] = secret
+            gpasses.append(
+                GPass(
+                    id=f"{settings.current_season}{user_id}",
+                    user_id=user_id,
+                    totp=secret,
+                    status=0,
+                )
+            )
+    await _insert_chunked(User, users)
+    await _insert_chunked(GPass, gpasses)
+
+    if apple_share:
+        # an apple pass registered on one or two devices
+        passes, registrations = [], []
+        for user_id in population.members:
+            if rnd.random() >= apple_share:
+                continue
+            serial = f"{settings.current_season}{user_id}"
+            passes.append(
+                APPass(
+                    id=serial,
+                    user_id=user_id,
+                    auth_token=pyotp.random_base32(),
+                    update_tag=rnd.randint(0, 1000),
+                )
+            )
+            for device in range(rnd.randint(1, 2)):
+                registrations.append(
+                    APReg(
+                        device_library_identifier=f"device-{user_id}-{device}",
+                        serial_number=serial,
+                    )
+                )
+        await _insert_chunked(APPass, passes)
+        await _insert_chunked(APReg, registrations)
+
+    await _insert_chunked(
+        Otherticket,
+        [
+            Otherticket(id=x, name=f"bench ticket {x}", active=True)
+            for x in range(1, othertickets + 1)
+        ],
+    )
+    population.othertickets = list(range(1, othertickets + 1))
+    await _insert_chunked(
+        Dayticket,
+        [
+            Dayticket(id=x, batch_id=batch_id, expires=0)
+            for x in range(1, daytickets + 1)
+        ],
+    )
+    population.daytickets = list(range(1, daytickets + 1))
+
+    if access_log_rows:
+        now = int(time.time())
+        member_ids = list(population.members)
+        await _insert_chunked(
+            AccessLog,
+            [
+                AccessLog(
+                    id=None,
+                    obj_id=(obj_id := rnd.choice(member_ids)),
+                    token_type=population.members[obj_id].value,
+                    token_media=TokenMedia.PRINT.value,
+                    epoch=(epoch := now - rnd.randint(0, 365 * 24 * 60) * 60),
+                    day=(day_hour := local_day_hour(epoch))[0],
+                    hour=day_hour[1],
+                )
+                for _ in range(access_log_rows)
+            ],
+            size=2000,
+        )
+    return population
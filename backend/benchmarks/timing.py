@@ -0,0 +1,72 @@
+import asyncio
+import inspect
+import json
+import pathlib
+import statistics
+import time
+from typing import Awaitable, Callable, Union
+
+
+def summarize(samples: list[float], elapsed: float) -> dict:
+    """latency percentiles in milliseconds and throughput for a list of samples (seconds)"""
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 4)
+
+    return {
+        "n": len(ordered),
+        "p50_ms": pct(0.50),
+        "p95_ms": pct(0.95),
+        "p99_ms": pct(0.99),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 4),
+        "ops_per_sec": round(len(ordered) / elapsed, 1) if elapsed else 0.0,
+    }
+
+
+async def measure(
+    fn: Callable[[], Union[None, Awaitable[None]]],
+    iterations: int = 1000,
+    warmup: int = 50,
+) -> dict:
+    """call fn (sync or async) iterations times and summarize the latency"""
+    is_async = inspect.iscoroutinefunction(fn)
+    for _ in range(warmup):
+        if is_async:
+            await fn()
+        else:
+            fn()
+    samples = []
+    perf_counter = time.perf_counter
+    start = perf_counter()
+    for _ in range(iterations):
+        t0 = perf_counter()
+        if is_async:
+            await fn()
+        else:
+            fn()
+        samples.append(perf_counter() - t0)
+        if is_async:
+            # let background tasks (eg. the access log writer) get a turn
+            await asyncio.sleep(0)
+    return summarize(samples, perf_counter() - start)
+
+
+def find_regressions(
+    results: dict, baseline: dict, max_regression: float, metric: str = "p95_ms"
+) -> list[str]:
+    """compare a run against a stored baseline and describe what got slower"""
+    regressions = []
+    for name, current in results.items():
+        if (base := baseline.get(name)) is None:
+            continue
+        limit = base[metric] * (1 + max_regression)
+        if current[metric] > limit:
+            regressions.append(
+                f"{name}: {metric} {current[metric]} > {limit:.4f} (baseline {base[metric]})"
+            )
+    return regressions
+
+
+def load_baseline(path: pathlib.Path) -> dict:
+    return json.loads(path.read_text())["results"]
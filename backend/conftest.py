@@ -1,5 +1,6 @@
 import base64
 import random
+import time
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 
@@ -11,6 +12,7 @@ import pytest_asyncio
 from fastapi import FastAPI
 from fastapi.testclient import TestClient
 from fastapi_limiter import FastAPILimiter
+from lockoff.access_log import local_day_hour
 from lockoff.access_token import TokenMedia, TokenType
 from lockoff.config import settings
 from lockoff.db import (
@@ -19,12 +21,22 @@ from lockoff.db import (
     APDevice,
     APPass,
     APReg,
+    DailyVisitors,
     Dayticket,
     GPass,
+    KlubmodulSync,
+    HourlyVisitors,
     Otherticket,
+    OutboxMessage,
+    RollupWatermark,
     User,
+    VisitDay,
 )
+from lockoff.membership import membership
+from lockoff.migrations import migrate
 from lockoff.misc import simple_hash
+from lockoff.rollups import rollups
+from lockoff.totp_cache import totp_verifier
 from piccolo.table import create_db_tables
 
 TOTP_SECRET = "H6IC425Q5IFZYAP4VINKRVHX7ZIEKO7E"
@@ -36,6 +48,7 @@ async def testing_lifespan(app: FastAPI):
     #    _redis = aioredis.FakeRedis(encoding="utf-8", decode_responses=True)
     #    await FastAPILimiter.init(_redis)
     yield
+    await DB.close_pool()
 
 
 @pytest_asyncio.fixture(autouse=True)
@@ -50,9 +63,16 @@ async def sample_data():
             APDevice,
             APPass,
             GPass,
+            KlubmodulSync,
             Otherticket,
+            OutboxMessage,
+            VisitDay,
+            DailyVisitors,
+            HourlyVisitors,
+            RollupWatermark,
             if_not_exists=True,
         )
+    await migrate()
     # make some sample data in the database to run tests agains
     batch_id = datetime.now(tz=settings.tz).isoformat(timespec="seconds")
     async with DB.transaction():
@@ -98,12 +118,9 @@ async def sample_data():
                         token_media=random.choice(
                             [TokenMedia.DIGITAL, TokenMedia.PRINT]
                         ),
-                        timestamp=(
-                            (
-                                datetime.now(tz=settings.tz)
-                                - timedelta(minutes=random.randint(0, 200))
-                            ).isoformat(timespec="seconds")
-                        ),
+                        epoch=(epoch := int(time.time()) - random.randint(0, 200) * 60),
+                        day=(day_hour := local_day_hour(epoch))[0],
+                        hour=day_hour[1],
                     )
                 )
             except Exception as ex:
@@ -139,6 +156,41 @@ async def sample_data():
         await APPass.insert(
             APPass(id=serial, auth_token=UPDATE_AUTH_TOKEN, user_id=1, update_tag=0)
         ).on_conflict(target=APPass.id, action="DO UPDATE", values=[APPass.update_tag])
+    # door checks read from the in-memory snapshot
+    await membership.rebuild()
+    totp_verifier.clear()
+
+
+@pytest_asyncio.fixture
+async def log_access():
+    """log_access(obj_id, at) adds an access log row
+
+    the rows are deleted after the test and the rollups rebuilt (sqlite hands
+    the deleted ids out again)
+    """
+    ids = []
+
+    async def log_access(
+        obj_id: int, at: datetime, token_type: TokenType = TokenType.NORMAL
+    ):
+        epoch = int(at.timestamp())
+        day, hour = local_day_hour(epoch)
+        rows = await AccessLog.insert(
+            AccessLog(
+                id=None,
+                obj_id=obj_id,
+                token_type=token_type.value,
+                token_media=TokenMedia.PRINT.value,
+                epoch=epoch,
+                day=day,
+                hour=hour,
+            )
+        ).returning(AccessLog.id)
+        ids.append(rows[0]["id"])
+
+    yield log_access
+    await AccessLog.delete().where(AccessLog.id.is_in(ids or [0]))
+    await rollups.rebuild()
 
 
 @pytest.fixture
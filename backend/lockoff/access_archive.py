@@ -0,0 +1,166 @@
+"""the cold archive of the access log - gzip'd csv files, one per month
+
+rows older than the retention horizon are moved here by lockoff.retention.
+A file is only ever appended to: every append is a complete gzip member
+written in one go. Should the process die between appending and deleting the
+rows from the table, the rows are archived again on the next run - readers
+drop the duplicate ids. A member torn by a crash is cut off before the next
+append (its rows are still in the table) and readers skip a damaged member.
+
+the rows only live here once moved, so the directory has to survive the
+container - see check_archive_dir.
+"""
+
+import asyncio
+import csv
+import gzip
+import io
+import logging
+import os
+import pathlib
+import zlib
+from typing import Iterable, Iterator
+
+from .config import settings
+from .db import AccessLog
+
+log = logging.getLogger(__name__)
+
+COLUMNS = ["id", "obj_id", "token_type", "token_media", "epoch", "day", "hour"]
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def check_archive_dir(directory: pathlib.Path, db_file: str = settings.db_file) -> None:
+    """raise ArchiveError unless rows can be moved to directory for good
+
+    it must be writable and persistent: on the filesystem of the database (the
+    database sits on a volume) or a mount of its own. Anywhere else it is most
+    likely the container's own filesystem - gone with the next image update.
+    """
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+    except OSError as ex:
+        raise ArchiveError(f"cannot create the archive {directory}: {ex}")
+    if not os.access(directory, os.W_OK | os.X_OK):
+        raise ArchiveError(f"the archive {directory} is not writable")
+    database_device = pathlib.Path(db_file).resolve().parent.stat().st_dev
+    if directory.stat().st_dev != database_device and not os.path.ismount(directory):
+        raise ArchiveError(
+            f"the archive {directory} is neither on the database volume nor a mount"
+        )
+
+
+def month_of(day: int) -> str:
+    """yyyy-mm of a yyyymmdd day"""
+    return f"{day // 10000:04d}-{day // 100 % 100:02d}"
+
+
+def month_path(directory: pathlib.Path, month: str) -> pathlib.Path:
+    return directory / f"accesslog-{month}.csv.gz"
+
+
+def months(directory: pathlib.Path = settings.access_log_archive_dir) -> list[str]:
+    """the archived months, oldest first"""
+    return sorted(
+        path.name.removeprefix("accesslog-").removesuffix(".csv.gz")
+        for path in directory.glob("accesslog-*.csv.gz")
+    )
+
+
+_GZIP_MAGIC = b"\x1f\x8b\x08"
+
+
+def _members(data: bytes, name: str = "") -> Iterator[tuple[int, bytes]]:
+    """(end offset, content) of the intact gzip members in data
+
+    a damaged member is skipped - reading goes on at the next gzip header
+    """
+    start = 0
+    while start < len(data):
+        inflater = zlib.decompressobj(wbits=31)
+        try:
+            content = inflater.decompress(data[start:])
+            intact = inflater.eof
+        except zlib.error:
+            intact = False
+        if intact:
+            start = len(data) - len(inflater.unused_data)
+            yield start, content
+            continue
+        log.warning(f"access log archive {name} has a damaged member at {start}")
+        start = data.find(_GZIP_MAGIC, start + 1)
+        if start == -1:
+            return
+
+
+def append_rows(directory: pathlib.Path, month: str, rows: Iterable[dict]) -> None:
+    path = month_path(directory, month)
+    directory.mkdir(parents=True, exist_ok=True)
+    # the end of the last intact member - a torn append after it is cut off
+    end = 0
+    if path.exists():
+        for end, _ in _members(path.read_bytes(), month):
+            pass
+    text = io.StringIO(newline="")
+    writer = csv.writer(text)
+    if not end:
+        writer.writerow(COLUMNS)
+    writer.writerows([row[column] for column in COLUMNS] for row in rows)
+    member = gzip.compress(text.getvalue().encode())
+    with open(path, "r+b" if path.exists() else "wb") as f:
+        f.truncate(end)
+        f.seek(end)
+        f.write(member)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_month(directory: pathlib.Path, month: str) -> list[dict]:
+    rows = {}
+    data = month_path(directory, month).read_bytes()
+    for _, content in _members(data, month):
+        for row in csv.reader(io.StringIO(content.decode(), newline="")):
+            if row == COLUMNS:
+                continue
+            row = dict(zip(COLUMNS, map(int, row)))
+            rows[row["id"]] = row
+    return list(rows.values())
+
+
+async def archived_rows(
+    first_day: int,
+    last_day: int,
+    directory: pathlib.Path = settings.access_log_archive_dir,
+) -> list[dict]:
+    """the archived rows from first_day to last_day (yyyymmdd, both included)"""
+    rows = []
+    for month in months(directory):
+        if month_of(first_day) <= month <= month_of(last_day):
+            rows.extend(
+                row
+                for row in await asyncio.to_thread(read_month, directory, month)
+                if first_day <= row["day"] <= last_day
+            )
+    return rows
+
+
+async def access_log_between(
+    first_day: int,
+    last_day: int,
+    directory: pathlib.Path = settings.access_log_archive_dir,
+) -> list[dict]:
+    """the access log from first_day to last_day - archive and table together
+
+    the archive is only read for the months archived in the range
+    """
+    hot = await AccessLog.select(
+        *[getattr(AccessLog, column) for column in COLUMNS]
+    ).where((AccessLog.day >= first_day) & (AccessLog.day <= last_day))
+    rows = {
+        row["id"]: row for row in await archived_rows(first_day, last_day, directory)
+    }
+    rows.update((row["id"], row) for row in hot)
+    return sorted(rows.values(), key=lambda row: row["epoch"], reverse=True)
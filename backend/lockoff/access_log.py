@@ -0,0 +1,194 @@
+import asyncio
+import logging
+import time
+from datetime import date, datetime
+from typing import Optional
+
+from .access_token import TokenMedia, TokenType
+from .config import settings
+from .db import DB, AccessLog
+
+log = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+def local_day_hour(epoch: int) -> tuple[int, int]:
+    """the local day as yyyymmdd and the local hour of a unix time"""
+    local = datetime.fromtimestamp(epoch, tz=settings.tz)
+    return date_to_day(local), local.hour
+
+
+def date_to_day(d: date) -> int:
+    return d.year * 10000 + d.month * 100 + d.day
+
+
+def day_to_date(day: int) -> date:
+    return date(day // 10000, day // 100 % 100, day % 100)
+
+
+def epoch_to_iso(epoch: int) -> str:
+    return datetime.fromtimestamp(epoch, tz=settings.tz).isoformat(timespec="seconds")
+
+
+class AccessLogWriter:
+    """write-behind writer for the access log
+
+    the door path only puts an event on the queue - the runner inserts the
+    events in batches (one transaction per batch) when batch_size events are
+    waiting or flush_interval seconds have passed since the first one
+
+    a batch that can't be written is kept in front of the queue and retried
+    with a growing pause, so a locked or full database delays events but
+    never drops them
+    """
+
+    def __init__(
+        self,
+        batch_size: int = settings.access_log_batch_size,
+        flush_interval: float = settings.access_log_flush_interval,
+        maxsize: int = 10000,
+        max_retry_pause: float = 10.0,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.failed: list[tuple] = []
+        self.max_retry_pause = max_retry_pause
+        self.stopping = False
+        self.flushed_rows = 0
+        self.flushed_batches = 0
+        self.last_flush_latency: Optional[float] = None
+        self.max_flush_latency: float = 0.0
+
+    async def add(
+        self,
+        obj_id: int,
+        token_type: TokenType,
+        token_media: TokenMedia,
+        at: Optional[datetime] = None,
+    ) -> None:
+        if at is None:
+            epoch = int(time.time())
+        elif at.tzinfo is None:
+            epoch = int(at.replace(tzinfo=settings.tz).timestamp())
+        else:
+            epoch = int(at.timestamp())
+        event = (obj_id, token_type, token_media, epoch, *local_day_hour(epoch))
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            log.warning("access log queue is full - writing directly")
+            if not await self._flush([event]):
+                self.failed.append(event)
+
+    async def _flush(self, batch: list[tuple]) -> bool:
+        start = time.perf_counter()
+        for attempt in range(3):
+            try:
+                async with DB.transaction():
+                    await AccessLog.insert(
+                        *[
+                            AccessLog(
+                                id=None,
+                                obj_id=obj_id,
+                                token_type=token_type,
+                                token_media=token_media,
+                                epoch=epoch,
+                                day=day,
+                                hour=hour,
+                            )
+                            for obj_id, token_type, token_media, epoch, day, hour in batch
+                        ]
+                    )
+                break
+            except Exception as ex:
+                log.warning(f"failed to write access log batch (attempt {attempt}) {ex}")
+                await asyncio.sleep(0.5)
+        else:
+            return False
+        self.last_flush_latency = time.perf_counter() - start
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+        self.flushed_rows += len(batch)
+        self.flushed_batches += 1
+        return True
+
+    async def _retry(self) -> None:
+        """write the failed batches until the database takes them again"""
+        pause = 0.5
+        while self.failed and not self.stopping:
+            batch = self.failed[: self.batch_size]
+            if await self._flush(batch):
+                del self.failed[: len(batch)]
+                pause = 0.5
+            else:
+                log.warning(
+                    f"{len(self.failed)} access log events waiting for the database"
+                )
+                await asyncio.sleep(pause)
+                pause = min(pause * 2, self.max_retry_pause)
+
+    async def runner(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = False
+        while True:
+            await self._retry()
+            if self.stopping:
+                return
+            event = await self.queue.get()
+            if event is _STOP:
+                return
+            batch = [event]
+            stop = False
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self.queue.get(), timeout=timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is _STOP:
+                    stop = True
+                    break
+                batch.append(event)
+            if not await self._flush(batch):
+                self.failed.extend(batch)
+            if stop:
+                return
+
+    async def drain(self) -> None:
+        """flush whatever is left on the queue"""
+        batch, self.failed = self.failed, []
+        while not self.queue.empty():
+            event = self.queue.get_nowait()
+            if event is not _STOP:
+                batch.append(event)
+        for i in range(0, len(batch), self.batch_size):
+            if not await self._flush(batch[i : i + self.batch_size]):
+                self.failed.extend(batch[i : i + self.batch_size])
+        if self.failed:
+            # nothing will write them after this - keep them recoverable
+            log.error(f"access log events not written {self.failed}")
+
+    async def stop(self, task: Optional[asyncio.Task] = None) -> None:
+        """stop the runner after its current batch and write everything queued"""
+        if task is not None and not task.done():
+            self.stopping = True
+            await self.queue.put(_STOP)
+            await task
+        await self.drain()
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "failed_rows": len(self.failed),
+            "flushed_rows": self.flushed_rows,
+            "flushed_batches": self.flushed_batches,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+
+access_log_writer = AccessLogWriter()
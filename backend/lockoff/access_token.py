@@ -3,8 +3,10 @@ import hashlib
 import logging
 import secrets
 import struct
+import time
 from datetime import datetime
 from enum import Enum, IntFlag
+from typing import Iterable, Optional, Union
 
 import base45
 from dateutil.relativedelta import relativedelta
@@ -46,6 +48,116 @@ def log_and_raise_token_error(message, code=DISPLAY_CODES.QR_ERROR, level=loggin
     raise TokenError(message, code=code)
 
 
+class TokenCodec:
+    """encode/verify access tokens with the struct layouts compiled once
+
+    a token is base45(user_id, expires, token_type, token_media, nonce, signature)
+    where signature is shake_256(data + nonce + secret) - android passes add an
+    8 digit totp after the base45 part
+    """
+
+    header = struct.Struct(">IIHH")
+
+    def __init__(self, secret: bytes, nonce_size: int, digest_size: int):
+        self.secret = secret
+        self.nonce_size = nonce_size
+        self.digest_size = digest_size
+        self.layout = struct.Struct(f">IIHH{nonce_size}s{digest_size}s")
+        self.signed_size = self.header.size + nonce_size
+        # base45 encodes 2 bytes as 3 chars (and a last odd byte as 2 chars)
+        self.encoded_size = (self.layout.size // 2) * 3 + (self.layout.size % 2) * 2
+
+    @classmethod
+    def from_settings(cls, settings) -> "TokenCodec":
+        return cls(
+            secret=settings.secret,
+            nonce_size=settings.nonce_size,
+            digest_size=settings.digest_size,
+        )
+
+    def _sign(self, data: bytes) -> bytes:
+        return hashlib.shake_256(data + self.secret).digest(self.digest_size)
+
+    def generate(
+        self,
+        user_id: int,
+        expires: int,
+        token_type: TokenType = TokenType.NORMAL,
+        token_media: TokenMedia = TokenMedia.PRINT,
+    ) -> bytes:
+        data = self.header.pack(user_id, expires, token_type.value, token_media.value)
+        data += secrets.token_bytes(self.nonce_size)
+        return base45.b45encode(data + self._sign(data))
+
+    def generate_many(
+        self,
+        tokens: Iterable[tuple[int, TokenType, TokenMedia]],
+        expires: int,
+    ) -> list[bytes]:
+        """generate tokens for (user_id, token_type, token_media) with the same expire"""
+        return [
+            self.generate(
+                user_id=user_id,
+                expires=expires,
+                token_type=token_type,
+                token_media=token_media,
+            )
+            for user_id, token_type, token_media in tokens
+        ]
+
+    def verify(
+        self, token: str, now: Optional[float] = None
+    ) -> tuple[int, TokenType, TokenMedia, str]:
+        try:
+            raw_token = base45.b45decode(token[: self.encoded_size])
+            totp_suffix = token[self.encoded_size :]
+        except Exception as ex:
+            log_and_raise_token_error(
+                f"could not base45 decode token data: {ex}", code=DISPLAY_CODES.QR_ERROR
+            )
+
+        try:
+            user_id, expires, type_, media_, _, signature = self.layout.unpack(
+                raw_token
+            )
+            token_type = TokenType(type_)
+            token_media = TokenMedia(media_)
+        except Exception as ex:
+            log_and_raise_token_error(
+                f"could not unpack data: {ex}", code=DISPLAY_CODES.QR_ERROR
+            )
+
+        if not secrets.compare_digest(
+            self._sign(raw_token[: self.signed_size]), signature
+        ):
+            log_and_raise_token_error(
+                "could not verify signature", code=DISPLAY_CODES.QR_ERROR_SIGNATURE
+            )
+
+        if (time.time() if now is None else now) > expires:
+            log_and_raise_token_error(
+                "token is expired", code=DISPLAY_CODES.QR_ERROR_EXPIRED
+            )
+
+        return user_id, token_type, token_media, totp_suffix
+
+    def verify_many(
+        self, tokens: Iterable[str]
+    ) -> list[Union[tuple[int, TokenType, TokenMedia, str], TokenError]]:
+        """verify a batch of tokens - a failing token gives its TokenError in place"""
+        now = time.time()
+        results = []
+        for token in tokens:
+            try:
+                results.append(self.verify(token, now=now))
+            except TokenError as ex:
+                results.append(ex)
+        return results
+
+
+token_codec = TokenCodec.from_settings(settings)
+
+
 def generate_access_token(
     user_id: int,
     token_type: TokenType = TokenType.NORMAL,
@@ -66,22 +178,13 @@ def generate_access_token(
     """
 
     expire = datetime.now(tz=settings.tz) + expire_delta
-    data = struct.pack(
-        ">IIHH",
-        user_id,
-        int(expire.timestamp()),
-        token_type.value,
-        token_media.value,
-    )
-
-    nonce = secrets.token_bytes(settings.nonce_size)
-
-    signature = hashlib.shake_256(data + nonce + settings.secret).digest(
-        settings.digest_size
+    return token_codec.generate(
+        user_id=user_id,
+        expires=int(expire.timestamp()),
+        token_type=token_type,
+        token_media=token_media,
     )
 
-    return base45.b45encode(data + nonce + signature)
-
 
 def verify_access_token(token: str) -> tuple[int, TokenType, TokenMedia, str]:
     """verify the access token if possible to parse, 'signed' correct and is not expired
@@ -92,45 +195,7 @@ def verify_access_token(token: str) -> tuple[int, TokenType, TokenMedia, str]:
         if not able to parse, signature wrong or expired
 
     """
-    try:
-        raw_token = base45.b45decode(token[:39])
-        totp_suffix = token[39:]
-    except Exception as ex:
-        log_and_raise_token_error(
-            f"could not base45 decode token data: {ex}", code=DISPLAY_CODES.QR_ERROR
-        )
-
-    try:
-        user_id, expires, type_, media_, _, signature = struct.unpack(
-            f">IIHH{settings.nonce_size}s{settings.digest_size}s",
-            raw_token[: 12 + settings.nonce_size + settings.digest_size],
-        )
-        token_type = TokenType(type_)
-        token_media = TokenMedia(media_)
-        data = raw_token[: -settings.digest_size]
-        # android have 8 digit totp in the token suffix
-        expires_datetime = datetime.fromtimestamp(expires, tz=settings.tz)
-    except Exception as ex:
-        log_and_raise_token_error(
-            f"could not unpack data: {ex}", code=DISPLAY_CODES.QR_ERROR
-        )
-
-    if not secrets.compare_digest(
-        hashlib.shake_256(data + settings.secret).digest(settings.digest_size),
-        signature,
-    ):
-        log_and_raise_token_error(
-            "could not verify signature", code=DISPLAY_CODES.QR_ERROR_SIGNATURE
-        )
-
-    if datetime.now(tz=settings.tz) > expires_datetime:
-        log_and_raise_token_error(
-            "token is expired", code=DISPLAY_CODES.QR_ERROR_EXPIRED
-        )
-
-    print(f"totp_suffix {totp_suffix}")
-
-    return user_id, token_type, token_media, totp_suffix
+    return token_codec.verify(token)
 
 
 def _generate_dl_token(
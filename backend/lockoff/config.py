@@ -1,7 +1,8 @@
 import pathlib
-from typing import Any, Tuple, Type
+from typing import Any, Optional, Tuple, Type
 
 from dateutil.tz import gettz, tzfile
+from pydantic import model_validator
 from pydantic.fields import FieldInfo
 from pydantic_settings import (
     BaseSettings,
@@ -31,6 +32,10 @@ class Settings(BaseSettings):
     klubmodul_base_url: str = "https://changeme.klub-modul.dk"
     klubmodul_admin_user_id: int = 3535  # change to your own user_id for the admin user
     klubmodul_refresh_delay: int = 60
+    # team lists are fetched concurrently on the logged in session
+    klubmodul_list_concurrency: int = 4
+    klubmodul_list_retries: int = 2
+    klubmodul_list_retry_delay: float = 2.0
     apple_pass_certificate: pathlib.Path = pathlib.Path("/secret/apple-certificate.pem")
     apple_pass_key: pathlib.Path = pathlib.Path("/secret/apple-key.encrypted")
     apple_pass_key_password: bytes = ""
@@ -59,6 +64,34 @@ class Settings(BaseSettings):
     admin_user_ids: list[int] = [1]
     eljefe: list[int] = [3587, 4281, 33698]
     db_file: str = "/tmp/lockoff.db3"
+    # see lockoff.db_engine
+    db_reader_connections: int = 4
+    db_synchronous: str = "NORMAL"  # durable in WAL mode except on power loss
+    db_busy_timeout: int = 5000  # ms
+    db_cache_size: int = -16000  # KiB
+    db_mmap_size: int = 64 * 1024 * 1024
+    db_wal_autocheckpoint: int = 1000  # pages - litestream copies the WAL first
+    db_lock_wait_warning: float = 0.5
+    access_log_batch_size: int = 100
+    access_log_flush_interval: float = 2.0
+    # older rows move to gzip'd monthly files - see lockoff.retention
+    access_log_retention_days: int = 365
+    access_log_retention_interval: float = 24 * 60 * 60
+    # "archive" next to db_file when not set - it must be on a volume and
+    # backed up, litestream only replicates the database file
+    access_log_archive_dir: Optional[pathlib.Path] = None
+    # outbound sms/email - see lockoff.outbox
+    outbox_concurrency: int = 2
+    outbox_max_attempts: int = 5
+    outbox_retry_delay: float = 30.0
+    outbox_poll_interval: float = 5.0
+    outbox_draft_delete_delay: float = 60.0
+    outbox_draft_delete_batch: int = 20
+    # access analytics - see lockoff.rollups
+    rollup_interval: float = 60.0
+    rollup_batch_size: int = 5000
+    reader_repeat_window: float = 5.0
+    reader_repeat_cache_size: int = 256
     redis_url: str = "redis://localhost"
     google_service_account: pathlib.Path = pathlib.Path(
         "/secret/google-service-account.json"
@@ -69,6 +102,12 @@ class Settings(BaseSettings):
     reader_token: str = ""
     ext_dayticket_token: str = ""
 
+    @model_validator(mode="after")
+    def default_archive_dir(self) -> "Settings":
+        if self.access_log_archive_dir is None:
+            self.access_log_archive_dir = pathlib.Path(self.db_file).parent / "archive"
+        return self
+
     @classmethod
     def settings_customise_sources(
         cls,
@@ -1,5 +1,4 @@
 from piccolo import columns
-from piccolo.engine import SQLiteEngine
 from piccolo.query import WhereRaw  # noqa: F401
 from piccolo.query import Max, Min  # noqa: F401
 from piccolo.query.methods.select import Count  # noqa: F401
@@ -8,8 +7,9 @@ from piccolo.utils.pydantic import create_pydantic_model
 
 from .access_token import TokenMedia, TokenType
 from .config import settings
+from .db_engine import PooledSQLiteEngine
 
-DB = SQLiteEngine(path=settings.db_file)
+DB = PooledSQLiteEngine(path=settings.db_file, readers=settings.db_reader_connections)
 
 
 class User(Table, tablename="users", db=DB):
@@ -19,6 +19,8 @@ class User(Table, tablename="users", db=DB):
     mobile = columns.Varchar(length=64)
     email = columns.Varchar(length=64)
     batch_id = columns.Varchar(length=25)
+    # content fingerprint of the klubmodul synced columns - see klubmodul.refresh
+    fingerprint = columns.Varchar(length=32, default="")
     totp_secret = columns.Varchar(length=32)
     season_digital = columns.Varchar(length=4)
     season_print = columns.Varchar(length=4)
@@ -42,7 +44,75 @@ class AccessLog(Table, tablename="accesslog", db=DB):
     obj_id = columns.Integer()
     token_type = columns.Integer(choices=TokenType)
     token_media = columns.Integer(choices=TokenMedia)
-    timestamp = columns.Varchar(length=25)
+    # unix time and the local day (yyyymmdd) and hour - see lockoff.access_log
+    epoch = columns.Integer(default=0)
+    day = columns.Integer(default=0)
+    hour = columns.Integer(default=0)
+    # the old iso timestamp - emptied once copied to epoch/day/hour by
+    # migrations.backfill_access_log, nothing reads it
+    timestamp = columns.Varchar(length=25, default="")
+
+
+class VisitDay(Table, tablename="visit_day", db=DB):
+    """the days each member/ticket came in - see lockoff.rollups"""
+
+    token_type = columns.Integer(choices=TokenType)
+    obj_id = columns.Integer()
+    day = columns.Integer()
+
+
+class DailyVisitors(Table, tablename="daily_visitors", db=DB):
+    """unique visitors per day and token type - see lockoff.rollups"""
+
+    day = columns.Integer()
+    token_type = columns.Integer(choices=TokenType)
+    visitors = columns.Integer()
+
+
+class HourlyVisitors(Table, tablename="hourly_visitors", db=DB):
+    """unique visitors per local hour - see lockoff.rollups"""
+
+    day = columns.Integer()
+    hour = columns.Integer()
+    visitors = columns.Integer()
+
+
+class RollupWatermark(Table, tablename="rollup_watermark", db=DB):
+    """the last access log id included in the rollups"""
+
+    name = columns.Varchar(length=32, primary_key=True)
+    last_id = columns.Integer(default=0)
+
+
+class KlubmodulSync(Table, tablename="klubmodul_sync", db=DB):
+    """the latest klubmodul sync - a single row, see klubmodul.refresh"""
+
+    id = columns.Integer(primary_key=True)
+    batch_id = columns.Varchar(length=25)
+    # SyncSummary.as_dict as json
+    summary = columns.Text()
+
+
+class OutboxMessage(Table, tablename="outbox", db=DB):
+    """sms/email waiting to be sent through klubmodul - see lockoff.outbox"""
+
+    id = columns.Integer(primary_key=True)
+    kind = columns.Varchar(length=8)
+    user_id = columns.Integer()
+    subject = columns.Varchar(length=100, default="")
+    message = columns.Text()
+    # unix timestamps
+    created = columns.Float()
+    next_attempt = columns.Float()
+    sent_at = columns.Float(null=True, default=None)
+    # not sent after this (eg. a login code past its validity) - 0 is never
+    expires = columns.Float(default=0.0)
+    attempts = columns.Integer(default=0)
+    state = columns.Varchar(length=8, default="pending")
+    last_error = columns.Text(default="")
+    # the trail left in the klubmodul mail/sms overview - removed lazily
+    draft_id = columns.Varchar(length=32, default="")
+    draft_deleted = columns.Boolean(default=False)
 
 
 class APDevice(Table, tablename="ap_device", db=DB):
@@ -71,6 +141,14 @@ class GPass(Table, tablename="g_pass", db=DB):
     status = columns.Integer()
 
 
+class SchemaVersion(Table, tablename="schema_version", db=DB):
+    """migrations applied to this database - see lockoff.migrations"""
+
+    version = columns.Integer(primary_key=True)
+    name = columns.Varchar(length=100)
+    applied_at = columns.Varchar(length=25)
+
+
 # DayticketModel = create_pydantic_model(Dayticket)
 UserModel = create_pydantic_model(User)
 # AccessLogModel = create_pydantic_model(AccessLog)
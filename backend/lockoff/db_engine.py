@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import time
+import weakref
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import aiosqlite
+from piccolo.engine.sqlite import (
+    SQLiteEngine,
+    SQLiteTransaction,
+    TransactionType,
+    dict_factory,
+)
+
+from .config import settings
+
+log = logging.getLogger(__name__)
+
+
+class LockWaits:
+    """how long queries waited for a connection"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.acquired = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.max_hold = 0.0
+
+    def record(self, wait: float) -> None:
+        self.acquired += 1
+        if wait > 0.001:
+            self.waited += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if wait > settings.db_lock_wait_warning:
+            log.warning(f"waited {wait:.3f}s for the sqlite {self.name} connection")
+
+    def stats(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "total_wait": round(self.total_wait, 4),
+            "max_wait": round(self.max_wait, 4),
+            "max_hold": round(self.max_hold, 4),
+        }
+
+
+class _Pool:
+    """the connections of one event loop"""
+
+    def __init__(self, readers: int):
+        self.readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self.opened_readers = 0
+        self.max_readers = readers
+        self.writer: Optional[aiosqlite.Connection] = None
+        self.writer_lock = asyncio.Lock()
+
+
+class PooledTransaction(SQLiteTransaction):
+    """a transaction on the writer connection - held until commit/rollback"""
+
+    async def __aenter__(self) -> "PooledTransaction":
+        if self._parent is not None:
+            return self._parent
+        self._writer = self.engine.writer()
+        self.connection = await self._writer.__aenter__()
+        try:
+            await self.begin()
+        except BaseException as ex:
+            await self._writer.__aexit__(type(ex), ex, ex.__traceback__)
+            raise
+        self.context = self.engine.current_transaction.set(self)
+        return self
+
+    async def __aexit__(self, exception_type, exception, traceback) -> bool:
+        if self._parent:
+            return exception is None
+        try:
+            if exception:
+                if not self._rolled_back:
+                    await self.rollback()
+            elif not self._committed and not self._rolled_back:
+                await self.commit()
+        finally:
+            self.engine.current_transaction.reset(self.context)
+            await self._writer.__aexit__(exception_type, exception, traceback)
+        return exception is None
+
+
+class PooledSQLiteEngine(SQLiteEngine):
+    """SQLiteEngine keeping its connections open - a few readers and one writer
+
+    the database runs in WAL mode so readers never block the writer (or each
+    other). Every write - single statements and transactions - goes through
+    the one writer connection in turn, so the door, the card downloads, the
+    stats and the klubmodul sync queue up here (the wait is recorded and
+    reported by stats()) instead of spinning on SQLITE_BUSY. busy_timeout
+    still covers other processes like litestream.
+
+    litestream needs WAL and does its own checkpointing - nothing here forces
+    a checkpoint, sqlite's passive autocheckpoint (db_wal_autocheckpoint) is
+    left to run. The connections belong to the event loop that opened them.
+    """
+
+    def __init__(self, path: str, readers: int = 4, **connection_kwargs):
+        super().__init__(path=path, **connection_kwargs)
+        self.reader_count = readers
+        self._pools: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, _Pool]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self.reader_waits = LockWaits("reader")
+        self.writer_waits = LockWaits("writer")
+
+    def pragmas(self) -> list[str]:
+        return [
+            "PRAGMA journal_mode = WAL",
+            f"PRAGMA synchronous = {settings.db_synchronous}",
+            f"PRAGMA busy_timeout = {settings.db_busy_timeout}",
+            f"PRAGMA cache_size = {settings.db_cache_size}",
+            f"PRAGMA mmap_size = {settings.db_mmap_size}",
+            f"PRAGMA wal_autocheckpoint = {settings.db_wal_autocheckpoint}",
+            "PRAGMA temp_store = MEMORY",
+            "PRAGMA foreign_keys = 1",
+        ]
+
+    async def get_connection(self) -> aiosqlite.Connection:
+        """a new connection with the pragmas applied"""
+        connection = aiosqlite.connect(**self.connection_kwargs)
+        # an idle pooled connection must not keep the process alive at exit
+        connection.daemon = True
+        await connection
+        connection.row_factory = dict_factory
+        for pragma in self.pragmas():
+            await connection.execute(pragma)
+        return connection
+
+    def _pool(self) -> _Pool:
+        loop = asyncio.get_running_loop()
+        pool = self._pools.get(loop)
+        if pool is None:
+            pool = self._pools[loop] = _Pool(readers=self.reader_count)
+        return pool
+
+    @asynccontextmanager
+    async def reader(self):
+        pool = self._pool()
+        start = time.perf_counter()
+        if pool.readers.empty() and pool.opened_readers < pool.max_readers:
+            pool.opened_readers += 1
+            try:
+                connection = await self.get_connection()
+            except BaseException:
+                pool.opened_readers -= 1
+                raise
+        else:
+            connection = await pool.readers.get()
+        self.reader_waits.record(time.perf_counter() - start)
+        try:
+            yield connection
+        finally:
+            pool.readers.put_nowait(connection)
+
+    @asynccontextmanager
+    async def writer(self):
+        pool = self._pool()
+        start = time.perf_counter()
+        async with pool.writer_lock:
+            acquired = time.perf_counter()
+            self.writer_waits.record(acquired - start)
+            if pool.writer is None:
+                pool.writer = await self.get_connection()
+            try:
+                yield pool.writer
+            finally:
+                self.writer_waits.max_hold = max(
+                    self.writer_waits.max_hold, time.perf_counter() - acquired
+                )
+
+    async def _execute(self, connection, query, args, query_type, table):
+        async with connection.execute(query, args or []) as cursor:
+            response = await cursor.fetchall()
+            if query_type == "insert" and self.get_version_sync() < 3.35:
+                # no RETURNING clause on older versions of SQLite
+                pk = await self._get_inserted_pk(cursor, table)
+                return [{table._meta.primary_key._meta.db_column_name: pk}]
+            return response
+
+    async def _run_in_new_connection(
+        self, query: str, args=None, query_type: str = "generic", table=None
+    ):
+        # not in a transaction - selects go to a reader, the rest to the writer
+        if query.lstrip()[:6].upper() == "SELECT":
+            async with self.reader() as connection:
+                return await self._execute(connection, query, args, query_type, table)
+        async with self.writer() as connection:
+            return await self._execute(connection, query, args, query_type, table)
+
+    def transaction(
+        self,
+        transaction_type: TransactionType = TransactionType.deferred,
+        allow_nested: bool = True,
+    ) -> PooledTransaction:
+        return PooledTransaction(
+            engine=self, transaction_type=transaction_type, allow_nested=allow_nested
+        )
+
+    async def close_pool(self) -> None:
+        """close the connections of the running event loop"""
+        pool = self._pools.pop(asyncio.get_running_loop(), None)
+        if pool is None:
+            return
+        async with pool.writer_lock:
+            if pool.writer is not None:
+                await pool.writer.close()
+        while not pool.readers.empty():
+            await pool.readers.get_nowait().close()
+
+    def stats(self) -> dict:
+        return {
+            "readers": self.reader_waits.stats(),
+            "writer": self.writer_waits.stats(),
+        }
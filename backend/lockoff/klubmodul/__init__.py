@@ -1,3 +1,19 @@
-from .klubmodul import KlubmodulException, KMClient, klubmodul_runner, refresh
+from .klubmodul import (
+    KlubmodulException,
+    KMClient,
+    KMSessionPool,
+    SyncSummary,
+    klubmodul_runner,
+    km_sessions,
+    refresh,
+)
 
-__all__ = ["KlubmodulException", "KMClient", "klubmodul_runner", "refresh"]
+__all__ = [
+    "KlubmodulException",
+    "KMClient",
+    "KMSessionPool",
+    "SyncSummary",
+    "klubmodul_runner",
+    "km_sessions",
+    "refresh",
+]
@@ -1,18 +1,26 @@
 import asyncio
+import codecs
+import contextlib
 import csv
+import hashlib
+import json
 import logging
 import re
+import time
 import typing
+from dataclasses import dataclass, field
 from datetime import datetime
 from types import TracebackType
 
 import httpx
 import pyotp
+from piccolo.engine.sqlite import TransactionType
 
 from ..access_token import TokenType
 from ..config import settings
-from ..db import DB, User
-from ..misc import async_chunks, simple_hash
+from ..db import DB, KlubmodulSync, User
+from ..membership import membership
+from ..misc import chunks, simple_hash
 from .klubmodul_login_data import data as login_data
 
 log = logging.getLogger(__name__)
@@ -43,11 +51,94 @@ KM_LISTS = {
 }
 
 
+def split_records(text: str, quotechar: str = '"') -> tuple[list[str], str]:
+    """complete csv records in text and the incomplete rest
+
+    a record ends at a newline outside quotes - so a quoted field may span lines
+    """
+    records, start, quoted = [], 0, False
+    position = 0
+    while (newline := text.find("\n", position)) != -1:
+        quoted ^= text.count(quotechar, position, newline) % 2 == 1
+        position = newline + 1
+        if not quoted:
+            records.append(text[start:position])
+            start = position
+    return records, text[start:]
+
+
+async def csv_rows(
+    chunks: typing.AsyncIterator[bytes], delimiter: str = ";", quotechar: str = '"'
+):
+    """yield rows (dicts keyed by the header like csv.DictReader) from byte chunks
+
+    decoded with an incremental utf-8-sig decoder so only the current chunk and
+    an incomplete record are held in memory
+    """
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    header: typing.Optional[list[str]] = None
+    rest = ""
+    final = False
+    while not final:
+        try:
+            rest += decoder.decode(await anext(chunks))
+            records, rest = split_records(rest, quotechar=quotechar)
+        except StopAsyncIteration:
+            rest += decoder.decode(b"", final=True)
+            records, rest, final = [rest], "", True
+        for row in csv.reader(records, delimiter=delimiter, quotechar=quotechar):
+            if not row:
+                continue
+            if header is None:
+                header = row
+                continue
+            yield dict(zip(header, row))
+
+
+def session_expired(response: httpx.Response) -> bool:
+    """klubmodul sends an expired session back to the login page"""
+    if response.status_code in (401, 403):
+        return True
+    return response.is_redirect and "default.aspx" in response.headers.get(
+        "location", ""
+    ).lower()
+
+
 class KMClient:
     def __init__(self):
         self.client = httpx.AsyncClient(
             base_url=settings.klubmodul_base_url, default_encoding="utf-8-sig"
         )
+        self._login_lock = asyncio.Lock()
+        # number of successful logins - 0 means not logged in yet
+        self.login_generation = 0
+
+    async def login(self, seen_generation: typing.Optional[int] = None) -> None:
+        """log in - unless someone else did since seen_generation
+
+        several requests finding the session expired at once end up with a
+        single login: the first one logs in, the rest see a new generation
+        """
+        async with self._login_lock:
+            if seen_generation is not None and self.login_generation != seen_generation:
+                return
+            await self._km_login()
+            self.login_generation += 1
+
+    async def ensure_logged_in(self) -> None:
+        if self.login_generation == 0:
+            await self.login(seen_generation=0)
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """request on the logged in session - logs in again once if it expired"""
+        await self.ensure_logged_in()
+        generation = self.login_generation
+        response = await self.client.request(method, url, **kwargs)
+        if session_expired(response):
+            log.info("klubmodul session expired - logging in again")
+            await self.login(seen_generation=generation)
+            response = await self.client.request(method, url, **kwargs)
+        return response
 
     async def _km_login(self) -> None:
         # First GET the login page to establish session + extract fresh viewstate
@@ -67,15 +158,18 @@ class KMClient:
                 raise KlubmodulException(f"could not extract {name} from login page")
             return m.group(1)
 
-        login_data["__VIEWSTATE"] = _extract("__VIEWSTATE")
-        login_data["__VIEWSTATEGENERATOR"] = _extract("__VIEWSTATEGENERATOR")
-        login_data["__EVENTVALIDATION"] = _extract("__EVENTVALIDATION")
+        data = {
+            **login_data,
+            "__VIEWSTATE": _extract("__VIEWSTATE"),
+            "__VIEWSTATEGENERATOR": _extract("__VIEWSTATEGENERATOR"),
+            "__EVENTVALIDATION": _extract("__EVENTVALIDATION"),
+        }
 
         # Now POST to login — klubmodul returns 302 on success, 200 on failure
         try:
             response = await self.client.post(
                 "/default.aspx",
-                data=login_data,
+                data=data,
                 timeout=10.0,
             )
         except httpx.TimeoutException:
@@ -101,35 +195,102 @@ class KMClient:
             "search": "",
             "order": None,
         }
-        try:
-            response = await self.client.post(
-                "/Adminv2/TeamEnrollmentList/ExportCsv",
-                json=data,
-                timeout=60.0,  # crazy slow
-            )
-        except httpx.TimeoutException:
-            raise KlubmodulException("failed to get member profiles due to timeout")
-        if response.is_error or (not response.is_success):
-            raise KlubmodulException(
-                "failed to get member profiles: " + response.reason_phrase
-            )
-        for row in csv.DictReader(response.iter_lines(), delimiter=";", quotechar='"'):
+        async for row in self._export_csv(
+            "/Adminv2/TeamEnrollmentList/ExportCsv", data=data
+        ):
             yield row
 
-    async def get_members(self):
-        """ "async generator which yield valid user_id, member_type, email, mobile,"""
+    async def _export_csv(self, url: str, data: dict):
+        """stream an export and yield the csv rows as the bytes arrive"""
+        await self.ensure_logged_in()
+        for attempt in range(2):
+            generation = self.login_generation
+            try:
+                async with self.client.stream(
+                    "POST", url, json=data, timeout=60.0  # crazy slow
+                ) as response:
+                    if attempt == 0 and session_expired(response):
+                        expired = True
+                    else:
+                        expired = False
+                        if response.is_error or (not response.is_success):
+                            raise KlubmodulException(
+                                "failed to get member profiles: " + response.reason_phrase
+                            )
+                        async for row in csv_rows(response.aiter_bytes()):
+                            yield row
+            except httpx.TimeoutException:
+                raise KlubmodulException("failed to get member profiles due to timeout")
+            except httpx.TransportError as ex:
+                # eg. connection refused or reset mid-stream - retried by _fetch_list
+                raise KlubmodulException(f"failed to get member profiles: {ex!r}")
+            if not expired:
+                return
+            log.info("klubmodul session expired - logging in again")
+            await self.login(seen_generation=generation)
+
+    async def _fetch_list(
+        self, list_id: int, semaphore: asyncio.Semaphore
+    ) -> tuple[int, list[dict]]:
+        """all rows of a team list - retried with backoff on errors and timeouts"""
+        for attempt in range(settings.klubmodul_list_retries + 1):
+            try:
+                async with semaphore:
+                    start = time.perf_counter()
+                    rows = [row async for row in self._get_list(list_id)]
+                log.info(
+                    f"klubmodul list {list_id} got {len(rows)} rows "
+                    f"in {time.perf_counter() - start:.1f}s"
+                )
+                return list_id, rows
+            except (KlubmodulException, httpx.TransportError) as ex:
+                # the login (ensure_logged_in) can fail on the network too
+                if attempt == settings.klubmodul_list_retries:
+                    raise
+                log.warning(f"klubmodul list {list_id} failed ({ex!r}) - retrying")
+                await asyncio.sleep(settings.klubmodul_list_retry_delay * 2**attempt)
 
-        for list_id, member_type in KM_LISTS.items():
-            async for row in self._get_list(list_id):
-                user_id = int(row["ID"])
-                # hold = [int(i) for i in row["Hold"].split(", ") if i]
-                # lowest_hold_number = min(hold) if hold else -1
-                # member_type = KM_MEMBER_TYPES.get(lowest_hold_number)
-                name = row["Fornavn"].capitalize() + " " + row["Efternavn"].capitalize()
-                email = row["E-mail"].lower()
-                mobile = row["Mobil"]
-                if member_type:
-                    yield user_id, name, member_type, email, mobile
+    async def get_members(self):
+        """ "async generator which yield valid user_id, member_type, email, mobile,
+
+        the lists are fetched concurrently and merged as they arrive - a member
+        on several lists gets the member type of the last of them in KM_LISTS
+        (same as when the lists were fetched one at a time)
+        """
+        priority = {list_id: i for i, list_id in enumerate(KM_LISTS)}
+        semaphore = asyncio.Semaphore(settings.klubmodul_list_concurrency)
+        tasks = [
+            asyncio.create_task(self._fetch_list(list_id, semaphore))
+            for list_id in KM_LISTS
+        ]
+        members: dict[int, tuple[int, tuple]] = {}
+        try:
+            for next_list in asyncio.as_completed(tasks):
+                list_id, rows = await next_list
+                member_type = KM_LISTS[list_id]
+                for row in rows:
+                    user_id = int(row["ID"])
+                    if user_id in members and members[user_id][0] > priority[list_id]:
+                        continue
+                    # hold = [int(i) for i in row["Hold"].split(", ") if i]
+                    # lowest_hold_number = min(hold) if hold else -1
+                    # member_type = KM_MEMBER_TYPES.get(lowest_hold_number)
+                    name = (
+                        row["Fornavn"].capitalize() + " " + row["Efternavn"].capitalize()
+                    )
+                    email = row["E-mail"].lower()
+                    mobile = row["Mobil"]
+                    if member_type:
+                        members[user_id] = (
+                            priority[list_id],
+                            (user_id, name, member_type, email, mobile),
+                        )
+        finally:
+            # one list failed for good - do not leave the others running
+            for task in tasks:
+                task.cancel()
+        for _, member in members.values():
+            yield member
 
     async def get_members_old(self):
         """ "async generator which yield valid user_id, member_type, email, mobile,"""
@@ -158,19 +319,7 @@ class KMClient:
                 "dir": "asc",
             },
         }
-        try:
-            response = await self.client.post(
-                "/Adminv2/SearchProfile/ExportCsv",
-                json=data,
-                timeout=60.0,  # crazy slow
-            )
-        except httpx.TimeoutException:
-            raise KlubmodulException("failed to get member profiles due to timeout")
-        if response.is_error or (not response.is_success):
-            raise KlubmodulException(
-                "failed to get member profiles: " + response.reason_phrase
-            )
-        for row in csv.DictReader(response.iter_lines(), delimiter=";", quotechar='"'):
+        async for row in self._export_csv("/Adminv2/SearchProfile/ExportCsv", data=data):
             user_id = int(row["Id"])
             hold = [int(i) for i in row["Hold"].split(", ") if i]
             lowest_hold_number = min(hold) if hold else -1
@@ -181,9 +330,30 @@ class KMClient:
             if member_type:
                 yield user_id, name, member_type, email, mobile
 
+    async def delete_draft(self, row_id: str) -> None:
+        """remove a sent sms/email from the klubmodul mail/sms overview"""
+        try:
+            response = await self._request(
+                method="DELETE",
+                url="/Adminv2/Newsmail/__Delete",
+                json={"rowId": row_id},
+                timeout=10.0,
+            )
+        except httpx.TimeoutException:
+            raise KlubmodulException(f"remove trail {row_id} timeout")
+        if response.is_error:
+            raise KlubmodulException(
+                f"remove trail {row_id}: " + response.reason_phrase
+            )
+
     async def send_sms(
-        self, user_id: int, message: str, delete_delay: int = 10
-    ) -> None:
+        self, user_id: int, message: str, delete_delay: typing.Optional[int] = 10
+    ) -> str:
+        """send an sms - returns the row id of the trail left in klubmodul
+
+        the trail is removed again after delete_delay seconds - with None it is
+        left for the caller to remove with delete_draft
+        """
         data = {
             "rowData": [
                 {"columnName": "broadcast_media", "value": "sms"},
@@ -262,33 +432,29 @@ class KMClient:
             },
         }
         try:
-            response = await self.client.post(
-                "/Adminv2/NewsMail/__Create", json=data, timeout=10.0
+            response = await self._request(
+                "POST", "/Adminv2/NewsMail/__Create", json=data, timeout=10.0
             )
         except httpx.TimeoutException:
             raise KlubmodulException("send sms timeout")
         if response.is_error:
             raise KlubmodulException("send sms server error: " + response.reason_phrase)
-        save_id = response.json()["savedId"]
+        row_id = f"sms-{response.json()['savedId']}"
 
         # cleanup after ourself again by removing the sms in klubmodul mail/sms overview
-        if delete_delay:
+        if delete_delay is not None:
             await asyncio.sleep(delete_delay)
-        try:
-            response = await self.client.request(
-                method="DELETE",
-                url="/Adminv2/Newsmail/__Delete",
-                json={"rowId": f"sms-{save_id}"},
-                timeout=10.0,
-            )
-        except httpx.TimeoutException:
-            raise KlubmodulException("send sms remove trail timeout")
-        if response.is_error:
-            raise KlubmodulException("send sms remove trail: " + response.reason_phrase)
+            await self.delete_draft(row_id)
+        return row_id
 
     async def send_email(
-        self, user_id: int, subject: str, message: str, delete_delay: int = 10
-    ) -> None:
+        self,
+        user_id: int,
+        subject: str,
+        message: str,
+        delete_delay: typing.Optional[int] = 10,
+    ) -> str:
+        """send an email - see send_sms"""
         data = {
             "rowData": [
                 {"columnName": "broadcast_media", "value": "email"},
@@ -375,8 +541,8 @@ class KMClient:
             },
         }
         try:
-            response = await self.client.post(
-                "/Adminv2/NewsMail/__Create", json=data, timeout=10.0
+            response = await self._request(
+                "POST", "/Adminv2/NewsMail/__Create", json=data, timeout=10.0
             )
         except httpx.TimeoutException:
             raise KlubmodulException("send email timeout")
@@ -384,27 +550,16 @@ class KMClient:
             raise KlubmodulException(
                 "send email server error: " + response.reason_phrase
             )
-        save_id = response.json()["savedId"]
+        row_id = f"newsmail-{response.json()['savedId']}"
 
-        # cleanup after ourself again by removing the sms in klubmodul mail/sms overview
-        if delete_delay:
+        # cleanup after ourself again by removing the email in klubmodul mail/sms overview
+        if delete_delay is not None:
             await asyncio.sleep(delete_delay)
-        try:
-            response = await self.client.request(
-                method="DELETE",
-                url="/Adminv2/Newsmail/__Delete",
-                json={"rowId": f"newsmail-{save_id}"},
-                timeout=10.0,
-            )
-        except httpx.TimeoutException:
-            raise KlubmodulException("send email remove trail timeout")
-        if response.is_error:
-            raise KlubmodulException(
-                "send email remove trail: " + response.reason_phrase
-            )
+            await self.delete_draft(row_id)
+        return row_id
 
     async def __aenter__(self: U) -> U:
-        await self._km_login()
+        await self.login()
         return self
 
     async def __aexit__(
@@ -420,39 +575,169 @@ class KlubmodulException(Exception):
     pass
 
 
-async def refresh():
+class KMSessionPool:
+    """the logged in klubmodul session shared by the sync and the login messages
+
+    one long-lived KMClient - its httpx client keeps the connections and the
+    authenticated cookie jar between uses. It logs in on first use and again
+    only when klubmodul sends a request back to the login page. Closed by the
+    lifespan at shutdown.
+    """
+
+    def __init__(self):
+        self._client: typing.Optional[KMClient] = None
+
+    @contextlib.asynccontextmanager
+    async def session(self) -> typing.AsyncIterator[KMClient]:
+        if self._client is None:
+            self._client = KMClient()
+        await self._client.ensure_logged_in()
+        yield self._client
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.client.aclose()
+            self._client = None
+
+
+km_sessions = KMSessionPool()
+
+
+def fingerprint(name: str, member_type: TokenType, email: str, mobile: str) -> str:
+    """content fingerprint of the synced columns of a user row (email/mobile hashed)"""
+    content = "\x1f".join([name, str(member_type.value), email, mobile])
+    return hashlib.blake2b(content.encode(), digest_size=16).hexdigest()
+
+
+@dataclass
+class SyncSummary:
+    """what a klubmodul sync changed"""
+
+    batch_id: str
+    inserted: list[int] = field(default_factory=list)
+    updated: list[int] = field(default_factory=list)
+    reactivated: list[int] = field(default_factory=list)
+    deactivated: list[int] = field(default_factory=list)
+    unchanged: int = 0
+    # how long the sync held the database write lock
+    write_lock_seconds: float = 0.0
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.inserted or self.updated or self.reactivated or self.deactivated)
+
+    def as_dict(self) -> dict:
+        return {
+            "batch_id": self.batch_id,
+            "inserted": len(self.inserted),
+            "updated": len(self.updated),
+            "reactivated": len(self.reactivated),
+            "deactivated": len(self.deactivated),
+            "unchanged": self.unchanged,
+            "write_lock_seconds": self.write_lock_seconds,
+        }
+
+
+def diff_roster(
+    batch_id: str,
+    fetched: dict[int, tuple[str, TokenType, str, str]],
+    stored: dict[int, tuple[str, bool]],
+) -> SyncSummary:
+    """compare the fetched roster (hashed email/mobile) with stored (fingerprint, active)"""
+    summary = SyncSummary(batch_id=batch_id)
+    for user_id, row in fetched.items():
+        if user_id not in stored:
+            summary.inserted.append(user_id)
+            continue
+        stored_fingerprint, active = stored[user_id]
+        if not active:
+            summary.reactivated.append(user_id)
+        elif stored_fingerprint != fingerprint(*row):
+            summary.updated.append(user_id)
+        else:
+            summary.unchanged += 1
+    summary.deactivated = [
+        user_id
+        for user_id, (_, active) in stored.items()
+        if active and user_id not in fetched
+    ]
+    return summary
+
+
+async def refresh() -> SyncSummary:
+    """sync the users from klubmodul writing only the rows that changed"""
     async with refresh_lock:
         batch_id = datetime.now(tz=settings.tz).isoformat(timespec="seconds")
-        async with KMClient() as client, DB.transaction():
-            async for chunk in async_chunks(client.get_members(), 500):
-                await User.insert(
-                    *[
-                        User(
-                            id=user_id,
-                            name=name,
-                            token_type=member_type.value,
-                            email=simple_hash(email),
-                            mobile=simple_hash(mobile),
-                            batch_id=batch_id,
-                            totp_secret=pyotp.random_base32(),
-                            active=True,
-                        )
-                        for user_id, name, member_type, email, mobile in chunk
-                    ]
-                ).on_conflict(
+        async with km_sessions.session() as client:
+            fetched = {
+                user_id: (name, member_type, simple_hash(email), simple_hash(mobile))
+                async for user_id, name, member_type, email, mobile in client.get_members()
+            }
+        # stage everything before taking the write lock - only this sync
+        # (under refresh_lock) writes the synced columns so the diff holds
+        stored = {
+            u["id"]: (u["fingerprint"], u["active"])
+            for u in await User.select(User.id, User.fingerprint, User.active)
+        }
+        summary = diff_roster(batch_id=batch_id, fetched=fetched, stored=stored)
+        upserts = [
+            User(
+                id=user_id,
+                name=fetched[user_id][0],
+                token_type=fetched[user_id][1].value,
+                email=fetched[user_id][2],
+                mobile=fetched[user_id][3],
+                fingerprint=fingerprint(*fetched[user_id]),
+                batch_id=batch_id,
+                totp_secret=pyotp.random_base32(),
+                active=True,
+            )
+            for user_id in summary.inserted + summary.updated + summary.reactivated
+        ]
+        # one short transaction holding the write lock from BEGIN IMMEDIATE to COMMIT
+        start = time.perf_counter()
+        async with DB.transaction(transaction_type=TransactionType.immediate):
+            for chunk in chunks(upserts, 500):
+                await User.insert(*chunk).on_conflict(
                     target=User.id,
                     action="DO UPDATE",
                     values=[
                         User.name,
                         User.email,
                         User.mobile,
+                        User.fingerprint,
                         User.batch_id,
                         User.token_type,
                         User.active,
                     ],
                 )
-            # mark old data as inactive
-            await User.update({User.active: False}).where(User.batch_id != batch_id)
+            # mark members no longer on any list as inactive
+            for chunk in chunks(summary.deactivated, 500):
+                await User.update({User.active: False, User.batch_id: batch_id}).where(
+                    User.id.is_in(chunk)
+                )
+        summary.write_lock_seconds = round(time.perf_counter() - start, 4)
+        # kept across restarts for the admin system status
+        await KlubmodulSync.insert(
+            KlubmodulSync(
+                id=1, batch_id=batch_id, summary=json.dumps(summary.as_dict())
+            )
+        ).on_conflict(
+            target=KlubmodulSync.id,
+            action="DO UPDATE",
+            values=[KlubmodulSync.batch_id, KlubmodulSync.summary],
+        )
+        log.info(f"klubmodul sync {summary.as_dict()}")
+        # transaction is committed - let the door see the new members
+        if summary.changed:
+            await membership.rebuild()
+        return summary
+
+
+async def last_sync() -> typing.Optional[dict]:
+    """summary of the latest sync - None if there has not been one"""
+    row = await KlubmodulSync.select(KlubmodulSync.summary).first()
+    return json.loads(row["summary"]) if row else None
 
 
 async def klubmodul_runner(one_time_run: bool = False):
@@ -1,13 +1,14 @@
 import asyncio
+import contextlib
 from contextlib import asynccontextmanager
 
 import redis.asyncio as redis
 from fastapi import FastAPI
 
 # from fastapi_limiter import FastAPILimiter
-from piccolo import columns
 from piccolo.table import create_db_tables
 
+from .access_log import access_log_writer
 from .card import GooglePass
 from .config import settings
 from .db import (
@@ -16,13 +17,24 @@ from .db import (
     APDevice,
     APPass,
     APReg,
+    DailyVisitors,
     Dayticket,
     GPass,
+    KlubmodulSync,
+    HourlyVisitors,
     Otherticket,
+    OutboxMessage,
+    RollupWatermark,
     User,
+    VisitDay,
 )
-from .klubmodul import klubmodul_runner
+from .klubmodul import klubmodul_runner, km_sessions
+from .membership import membership
+from .migrations import backfill_runner, migrate
 from .misc import watchdog
+from .outbox import outbox
+from .retention import retention
+from .rollups import rollups
 
 
 @asynccontextmanager
@@ -38,15 +50,34 @@ async def lifespan(app: FastAPI):
         APDevice,
         APPass,
         GPass,
+        KlubmodulSync,
         Otherticket,
+        OutboxMessage,
+        VisitDay,
+        DailyVisitors,
+        HourlyVisitors,
+        RollupWatermark,
         if_not_exists=True,
     )
-    # # simple "migrations"
-    # try:
-    #     await User.alter().add_column("test", columns.Integer(default=0))
-
-    # except Exception:
-    #     pass
+    # columns and indexes on the existing tables
+    await migrate()
+    # and rewrite old rows in the background
+    backfill_task = asyncio.create_task(backfill_runner())
+    watchdog.watch(backfill_task)
+    # load the membership snapshot used by the door
+    await membership.rebuild()
+    # start the background access log writer
+    access_log_task = asyncio.create_task(access_log_writer.runner())
+    watchdog.watch(access_log_task)
+    # start sending queued sms/email
+    outbox_task = asyncio.create_task(outbox.runner())
+    watchdog.watch(outbox_task)
+    # keep the access stats rollups up to date
+    rollup_task = asyncio.create_task(rollups.runner())
+    watchdog.watch(rollup_task)
+    # and move the old access log rows to the archive
+    retention_task = asyncio.create_task(retention.runner())
+    watchdog.watch(retention_task)
     # start klubmodul runner
     klubmodul_task = asyncio.create_task(klubmodul_runner())
     watchdog.watch(klubmodul_task)
@@ -55,4 +86,14 @@ async def lifespan(app: FastAPI):
         await gp.create_class()
     yield
     # clear things now at shutdown
-    # nothing really have to be cleared
+    # write any access log events still waiting in the queue
+    await access_log_writer.stop(access_log_task)
+    await outbox.stop(outbox_task)
+    await rollups.stop(rollup_task)
+    await retention.stop(retention_task)
+    backfill_task.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await backfill_task
+    # close the pooled klubmodul session
+    await km_sessions.close()
+    await DB.close_pool()
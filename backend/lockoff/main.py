@@ -7,6 +7,7 @@ from fastapi_limiter.depends import RateLimiter
 
 from .config import settings
 from .lifespan import lifespan, watchdog
+from .membership import membership
 from .routers import (
     admin,
     apple_wallet,
@@ -67,4 +68,8 @@ async def healthz():
         raise HTTPException(
             status_code=500, detail="watchdog report a task is not running"
         )
-    return {"everything": "is awesome"}
+    return {
+        "everything": "is awesome",
+        # seconds since the door membership snapshot was rebuilt
+        "membership_snapshot_age": membership.age(),
+    }
@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+
+from .access_token import TokenType
+from .config import settings
+from .db import Otherticket, User
+
+log = logging.getLogger(__name__)
+
+
+class MembershipSnapshot:
+    """in-memory copy of who is allowed through the door
+
+    the door path only reads from this - it is rebuilt from the database when
+    klubmodul sync commits or when an admin changes an other-ticket
+    """
+
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        self.members: dict[int, TokenType] = {}
+        self.othertickets: frozenset[int] = frozenset()
+        self.version: int = 0
+        self.built_at: Optional[float] = None
+        # identifies the snapshot for readers keeping a replica - deltas are
+        # only available against the previous batch
+        self.batch_id: Optional[str] = None
+        self._previous: Optional[tuple[str, dict[int, TokenType], frozenset[int]]] = None
+
+    async def rebuild(self) -> None:
+        async with self._lock:
+            start = time.perf_counter()
+            users = await User.select(User.id, User.token_type).where(
+                User.active == True
+            )
+            tickets = await Otherticket.select(Otherticket.id).where(
+                Otherticket.active == True
+            )
+            members = {u["id"]: TokenType(u["token_type"]) for u in users}
+            othertickets = frozenset(t["id"] for t in tickets)
+            if self.batch_id is not None:
+                self._previous = (self.batch_id, self.members, self.othertickets)
+            # swap in one go (no await in between) so readers never see half a snapshot
+            self.members, self.othertickets = members, othertickets
+            self.version += 1
+            self.batch_id = datetime.now(tz=settings.tz).isoformat(
+                timespec="microseconds"
+            )
+            self.built_at = time.time()
+            log.info(
+                f"membership snapshot v{self.version} rebuilt with {len(members)} members "
+                f"and {len(othertickets)} other tickets in {time.perf_counter() - start:.3f}s"
+            )
+
+    async def ensure_loaded(self) -> None:
+        if self.built_at is None:
+            await self.rebuild()
+
+    def is_member(self, user_id: int) -> bool:
+        return user_id in self.members
+
+    def is_otherticket(self, ticket_id: int) -> bool:
+        return ticket_id in self.othertickets
+
+    def export(self, since: Optional[str] = None) -> dict:
+        """compact snapshot for readers - a delta if since is the previous batch_id"""
+        if since is not None and since == self.batch_id:
+            return {"batch_id": self.batch_id, "since": since, "unchanged": True}
+        if self._previous is not None and since == self._previous[0]:
+            _, old_members, old_tickets = self._previous
+            return {
+                "batch_id": self.batch_id,
+                "since": since,
+                "members": [
+                    [user_id, token_type.value]
+                    for user_id, token_type in self.members.items()
+                    if old_members.get(user_id) != token_type
+                ],
+                "removed_members": [u for u in old_members if u not in self.members],
+                "othertickets": sorted(self.othertickets - old_tickets),
+                "removed_othertickets": sorted(old_tickets - self.othertickets),
+            }
+        return {
+            "batch_id": self.batch_id,
+            "since": None,
+            "members": [[u, tt.value] for u, tt in self.members.items()],
+            "othertickets": sorted(self.othertickets),
+        }
+
+    def age(self) -> Optional[float]:
+        """seconds since the snapshot was last rebuilt (None if never built)"""
+        if self.built_at is None:
+            return None
+        return round(time.time() - self.built_at, 1)
+
+
+def sign_snapshot(payload: str) -> str:
+    return hmac.new(settings.secret, payload.encode(), hashlib.sha256).hexdigest()
+
+
+def signed_export(since: Optional[str] = None) -> dict:
+    """snapshot export as a json string and its hmac - readers verify before use
+
+    generated_at is signed with it so a reader can tell how old its copy is
+    """
+    data = {**membership.export(since=since), "generated_at": int(time.time())}
+    payload = json.dumps(data, separators=(",", ":"))
+    return {"payload": payload, "signature": sign_snapshot(payload)}
+
+
+membership = MembershipSnapshot()
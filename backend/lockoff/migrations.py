@@ -0,0 +1,201 @@
+"""versioned schema migrations for the sqlite store
+
+create_db_tables makes missing tables but never touches existing ones - every
+change to an existing table (columns, indexes) is a migration here. migrate()
+runs at startup and applies the migrations whose version is not yet in the
+schema_version table, each one in its own transaction.
+
+a migration is never edited once released - add a new one with the next
+version number instead. Rewriting the rows of a big table is not a migration
+(it would hold the write lock for the whole table) - it runs as a backfill in
+small batches in the background after startup, see backfill_runner
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Awaitable, Callable, Optional
+
+from piccolo.table import create_db_tables
+
+from .config import settings
+from .db import DB, AccessLog, SchemaVersion
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    statements: list[str] = field(default_factory=list)
+    # for changes that plain sql cannot express (eg. add a column if missing)
+    apply: Optional[Callable[[], Awaitable[None]]] = None
+
+
+async def _columns(table: str) -> set[str]:
+    return {row["name"] for row in await DB.run_ddl(f"PRAGMA table_info({table})")}
+
+
+async def _add_column(table: str, column: str, definition: str):
+    # tables made by create_db_tables already have every column
+    if column not in await _columns(table):
+        await DB.run_ddl(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+async def _add_user_fingerprint():
+    await _add_column("users", "fingerprint", "VARCHAR(32) NOT NULL DEFAULT ''")
+
+
+async def _add_access_log_epoch():
+    for column in ["epoch", "day", "hour"]:
+        await _add_column("accesslog", column, "INTEGER NOT NULL DEFAULT 0")
+    # after the columns exist
+    await DB.run_ddl("CREATE INDEX IF NOT EXISTS accesslog_epoch ON accesslog (epoch)")
+    await DB.run_ddl(
+        "CREATE INDEX IF NOT EXISTS accesslog_day ON accesslog (day, token_type, obj_id)"
+    )
+
+
+async def _add_outbox_expires():
+    await _add_column("outbox", "expires", "FLOAT NOT NULL DEFAULT 0")
+
+
+MIGRATIONS = [
+    Migration(1, "users.fingerprint", apply=_add_user_fingerprint),
+    Migration(
+        2,
+        "indexes for the hot queries",
+        [
+            "CREATE INDEX IF NOT EXISTS accesslog_timestamp ON accesslog (timestamp)",
+            "CREATE INDEX IF NOT EXISTS accesslog_obj_id ON accesslog (obj_id)",
+            "CREATE INDEX IF NOT EXISTS users_email ON users (email)",
+            "CREATE INDEX IF NOT EXISTS users_mobile ON users (mobile)",
+            "CREATE INDEX IF NOT EXISTS users_batch_id ON users (batch_id)",
+            "CREATE INDEX IF NOT EXISTS g_pass_user_id ON g_pass (user_id)",
+            "CREATE INDEX IF NOT EXISTS ap_reg_serial_number ON ap_reg (serial_number)",
+            "CREATE INDEX IF NOT EXISTS ap_pass_update_tag ON ap_pass (update_tag)",
+            "CREATE INDEX IF NOT EXISTS outbox_state ON outbox (state, next_attempt)",
+        ],
+    ),
+    Migration(
+        3,
+        "unique ap_reg device and pass",
+        [
+            # keep the first of any duplicate registrations
+            """DELETE FROM ap_reg WHERE id NOT IN (
+                SELECT min(id) FROM ap_reg GROUP BY device_library_identifier, serial_number
+            )""",
+            # also serves the lookups by device_library_identifier
+            """CREATE UNIQUE INDEX IF NOT EXISTS ap_reg_device_serial
+                ON ap_reg (device_library_identifier, serial_number)""",
+        ],
+    ),
+    Migration(
+        4,
+        "accesslog epoch, day and hour",
+        # nothing reads the iso timestamp any more
+        ["DROP INDEX IF EXISTS accesslog_timestamp"],
+        apply=_add_access_log_epoch,
+    ),
+    Migration(
+        5,
+        "keys of the access rollups",
+        [
+            # the catch-up inserts/replaces rows on these - see lockoff.rollups
+            """CREATE UNIQUE INDEX IF NOT EXISTS visit_day_key
+                ON visit_day (token_type, obj_id, day)""",
+            "CREATE INDEX IF NOT EXISTS visit_day_day ON visit_day (day, token_type)",
+            """CREATE UNIQUE INDEX IF NOT EXISTS daily_visitors_key
+                ON daily_visitors (day, token_type)""",
+            """CREATE UNIQUE INDEX IF NOT EXISTS hourly_visitors_key
+                ON hourly_visitors (day, hour)""",
+        ],
+    ),
+    Migration(6, "outbox.expires", apply=_add_outbox_expires),
+    Migration(
+        7,
+        "no login codes in outbox rows never sent",
+        # a small table - the outbox runner blanks them from now on
+        ["UPDATE outbox SET message = '' WHERE state IN ('failed', 'expired')"],
+    ),
+]
+
+
+async def applied_versions() -> set[int]:
+    return {row["version"] for row in await SchemaVersion.select(SchemaVersion.version)}
+
+
+async def migrate(migrations: list[Migration] = MIGRATIONS) -> list[int]:
+    """apply the pending migrations - returns the versions applied"""
+    await create_db_tables(SchemaVersion, if_not_exists=True)
+    done = await applied_versions()
+    applied = []
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version in done:
+            continue
+        start = time.perf_counter()
+        async with DB.transaction():
+            for statement in migration.statements:
+                await DB.run_ddl(statement)
+            if migration.apply is not None:
+                await migration.apply()
+            await SchemaVersion.insert(
+                SchemaVersion(
+                    version=migration.version,
+                    name=migration.name,
+                    applied_at=datetime.now(tz=settings.tz).isoformat(
+                        timespec="seconds"
+                    ),
+                )
+            )
+        log.info(
+            f"applied migration {migration.version} {migration.name} "
+            f"in {time.perf_counter() - start:.2f}s"
+        )
+        applied.append(migration.version)
+    return applied
+
+
+async def backfill_access_log(batch_size: int = 2000, pause: float = 0.05) -> int:
+    """copy the iso timestamp of old access log rows to epoch/day/hour
+
+    a batch at a time (each a short write) so the door keeps logging while it
+    runs - new rows are written with epoch set and are never touched. The
+    timestamp was written in local time so the local day and hour are read
+    straight from the string. Returns the number of rows converted.
+    """
+    converted = 0
+    while True:
+        rows = await AccessLog.raw(
+            "SELECT id FROM accesslog WHERE epoch = 0 ORDER BY id LIMIT {}", batch_size
+        )
+        if not rows:
+            break
+        await AccessLog.raw(
+            """UPDATE accesslog SET
+                epoch = COALESCE(CAST(strftime('%s', timestamp) AS INTEGER), -1),
+                day = COALESCE(CAST(replace(substr(timestamp, 1, 10), '-', '') AS INTEGER), 0),
+                hour = COALESCE(CAST(substr(timestamp, 12, 2) AS INTEGER), 0),
+                timestamp = ''
+            WHERE id >= {} AND id <= {} AND epoch = 0""",
+            rows[0]["id"],
+            rows[-1]["id"],
+        )
+        converted += len(rows)
+        await asyncio.sleep(pause)
+    if converted:
+        log.info(f"backfilled epoch/day/hour of {converted} access log rows")
+    return converted
+
+
+async def backfill_runner(interval: float = 300.0):
+    """run the backfills after startup and again if one fails"""
+    while True:
+        try:
+            await backfill_access_log()
+        except Exception as ex:
+            log.exception(f"access log backfill error {ex}")
+        await asyncio.sleep(interval)
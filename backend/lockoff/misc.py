@@ -30,7 +30,7 @@ class O_CMD:
     DETRIGGER = bytes([0x1B, 0x59, 0xD])
 
 
-from typing import AsyncIterator, TypeVar
+from typing import AsyncIterator, Iterator, TypeVar
 
 T = TypeVar("T")
 
@@ -63,6 +63,12 @@ async def async_chunks(
             yield results
 
 
+def chunks(items: list[T], size: int) -> Iterator[list[T]]:
+    """Generate chunks of at most ``size`` elements from a list."""
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
 class Watchdog:
     def __init__(self):
         self._watch = []
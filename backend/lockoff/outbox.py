@@ -0,0 +1,259 @@
+import asyncio
+import logging
+import time
+from typing import Optional
+
+from .config import settings
+from .db import OutboxMessage
+from .klubmodul import KlubmodulException, km_sessions
+
+log = logging.getLogger(__name__)
+
+KINDS = ("sms", "email")
+
+
+class Outbox:
+    """durable queue for the sms/email sent through klubmodul
+
+    request_totp only inserts a row - the runner sends the pending rows (at
+    most concurrency at a time on the shared klubmodul session), retries a
+    failed send with a growing delay and removes the trail a message leaves in
+    the klubmodul mail/sms overview later, a batch at a time. Rows survive a
+    restart so nothing queued is lost (a message can be sent twice if the
+    process dies between sending it and marking it sent). A message with an
+    expiry (a login code) is retried within it and marked expired, not sent,
+    once past it.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = settings.outbox_concurrency,
+        poll_interval: float = settings.outbox_poll_interval,
+    ):
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self.sent = 0
+        self.failed = 0
+        self.drafts_deleted = 0
+        self.expired = 0
+        self.last_send_latency: Optional[float] = None
+        self.max_send_latency: float = 0.0
+
+    async def add(
+        self,
+        kind: str,
+        user_id: int,
+        message: str,
+        subject: str = "",
+        max_age: Optional[float] = None,
+    ) -> int:
+        """queue a message - one older than max_age seconds is never sent"""
+        if kind not in KINDS:
+            raise ValueError(f"unknown message kind {kind}")
+        now = time.time()
+        rows = await OutboxMessage.insert(
+            OutboxMessage(
+                id=None,
+                kind=kind,
+                user_id=user_id,
+                subject=subject,
+                message=message,
+                created=now,
+                next_attempt=now,
+                expires=now + max_age if max_age is not None else 0.0,
+            )
+        ).returning(OutboxMessage.id)
+        self._wakeup.set()
+        return rows[0]["id"]
+
+    async def _send(self, row: dict) -> None:
+        try:
+            async with km_sessions.session() as km:
+                if row["kind"] == "sms":
+                    draft_id = await km.send_sms(
+                        user_id=row["user_id"],
+                        message=row["message"],
+                        delete_delay=None,
+                    )
+                else:
+                    draft_id = await km.send_email(
+                        user_id=row["user_id"],
+                        subject=row["subject"],
+                        message=row["message"],
+                        delete_delay=None,
+                    )
+        except Exception as ex:
+            attempts = row["attempts"] + 1
+            failed = attempts >= settings.outbox_max_attempts
+            log.warning(
+                f"failed to send {row['kind']} to {row['user_id']} "
+                f"(attempt {attempts}) {ex}"
+            )
+            now = time.time()
+            delay = settings.outbox_retry_delay * 2 ** (attempts - 1)
+            if row["expires"] and not failed:
+                # spread the attempts left over the time the message is good for
+                left = settings.outbox_max_attempts - attempts
+                delay = min(delay, max(row["expires"] - now, 0) / left)
+            values = {
+                OutboxMessage.attempts: attempts,
+                OutboxMessage.state: "failed" if failed else "pending",
+                OutboxMessage.last_error: str(ex),
+                OutboxMessage.next_attempt: now + delay,
+            }
+            if failed:
+                # it is never sent - don't keep the login code around
+                values[OutboxMessage.message] = ""
+            await OutboxMessage.update(values).where(OutboxMessage.id == row["id"])
+            if failed:
+                self.failed += 1
+            return
+        sent_at = time.time()
+        values = {
+            OutboxMessage.attempts: row["attempts"] + 1,
+            OutboxMessage.state: "sent",
+            OutboxMessage.sent_at: sent_at,
+            OutboxMessage.draft_id: draft_id,
+        }
+        if not draft_id:
+            # no klubmodul trail to remove later (see delete_drafts)
+            values[OutboxMessage.message] = ""
+        await OutboxMessage.update(values).where(OutboxMessage.id == row["id"])
+        self.sent += 1
+        self.last_send_latency = sent_at - row["created"]
+        self.max_send_latency = max(self.max_send_latency, self.last_send_latency)
+        log.info(f"{row['kind']} sent to {row['user_id']}")
+
+    async def expire(self) -> int:
+        """give up on the pending messages past their expiry - eg. after a restart"""
+        now = time.time()
+        rows = (
+            await OutboxMessage.update(
+                {OutboxMessage.state: "expired", OutboxMessage.message: ""}
+            )
+            .where(
+                (OutboxMessage.state == "pending")
+                & (OutboxMessage.expires > 0)
+                & (OutboxMessage.expires <= now)
+            )
+            .returning(OutboxMessage.id)
+        )
+        if rows:
+            log.warning(f"{len(rows)} outbox messages expired before they were sent")
+        self.expired += len(rows)
+        return len(rows)
+
+    async def send_due(self) -> int:
+        """send the pending messages that are due - returns how many were tried"""
+        await self.expire()
+        rows = (
+            await OutboxMessage.select()
+            .where(
+                (OutboxMessage.state == "pending")
+                & (OutboxMessage.next_attempt <= time.time())
+            )
+            .order_by(OutboxMessage.id)
+            .limit(self.concurrency * 10)
+        )
+        slots = asyncio.Semaphore(self.concurrency)
+
+        async def send(row: dict):
+            async with slots:
+                await self._send(row)
+
+        await asyncio.gather(*[send(row) for row in rows])
+        return len(rows)
+
+    async def delete_drafts(self) -> int:
+        """remove the klubmodul trail of messages sent a while ago"""
+        rows = (
+            await OutboxMessage.select(OutboxMessage.id, OutboxMessage.draft_id)
+            .where(
+                (OutboxMessage.state == "sent")
+                & (OutboxMessage.draft_deleted == False)
+                & (OutboxMessage.draft_id != "")
+                & (
+                    OutboxMessage.sent_at
+                    <= time.time() - settings.outbox_draft_delete_delay
+                )
+            )
+            .order_by(OutboxMessage.id)
+            .limit(settings.outbox_draft_delete_batch)
+        )
+        if not rows:
+            return 0
+        deleted = []
+        async with km_sessions.session() as km:
+            for row in rows:
+                try:
+                    await km.delete_draft(row["draft_id"])
+                except KlubmodulException as ex:
+                    log.warning(f"failed to remove klubmodul trail {ex}")
+                    continue
+                deleted.append(row["id"])
+        if deleted:
+            # the message (a login code) is not needed once its trail is gone
+            await OutboxMessage.update(
+                {OutboxMessage.draft_deleted: True, OutboxMessage.message: ""}
+            ).where(OutboxMessage.id.is_in(deleted))
+        self.drafts_deleted += len(deleted)
+        return len(deleted)
+
+    async def runner(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                await self.send_due()
+                await self.delete_drafts()
+            except Exception as ex:
+                log.exception(f"outbox runner error {ex}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self, task: asyncio.Task) -> None:
+        """stop the runner - whatever is still pending is sent after a restart"""
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def stats(self) -> dict:
+        now = time.time()
+        pending = await OutboxMessage.select(OutboxMessage.created).where(
+            OutboxMessage.state == "pending"
+        )
+        recent = await OutboxMessage.select(
+            OutboxMessage.created, OutboxMessage.sent_at
+        ).where((OutboxMessage.state == "sent") & (OutboxMessage.sent_at >= now - 3600))
+        latencies = sorted(r["sent_at"] - r["created"] for r in recent)
+        return {
+            "queue_depth": len(pending),
+            "oldest_pending_age": (
+                now - min(r["created"] for r in pending) if pending else None
+            ),
+            "failed": await OutboxMessage.count().where(
+                OutboxMessage.state == "failed"
+            ),
+            "expired": await OutboxMessage.count().where(
+                OutboxMessage.state == "expired"
+            ),
+            "drafts_waiting": await OutboxMessage.count().where(
+                (OutboxMessage.state == "sent") & (OutboxMessage.draft_deleted == False)
+            ),
+            "sent_last_hour": len(latencies),
+            "send_latency_median_last_hour": (
+                latencies[len(latencies) // 2] if latencies else None
+            ),
+            "send_latency_max_last_hour": latencies[-1] if latencies else None,
+            "sent": self.sent,
+            "drafts_deleted": self.drafts_deleted,
+            "last_send_latency": self.last_send_latency,
+            "max_send_latency": self.max_send_latency,
+        }
+
+
+outbox = Outbox()
@@ -0,0 +1,169 @@
+"""keep the access log table small - older rows go to the archive
+
+the runner moves the rows older than access_log_retention_days to the
+monthly archive files (see lockoff.access_archive) once a day, a whole day
+of rows at a time so a day is either in the table or in the archive. Only
+days the rollups already include are moved - the stats pages keep the full
+history in the rollups and a rollup rebuild reads the archive too.
+
+run it once by hand (and give the freed pages back to the filesystem) with
+
+    python -m lockoff.retention --vacuum
+"""
+
+import argparse
+import asyncio
+import logging
+import pathlib
+import sys
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from .access_archive import (
+    COLUMNS,
+    ArchiveError,
+    append_rows,
+    check_archive_dir,
+    month_of,
+    month_path,
+    months,
+)
+from .access_log import date_to_day
+from .config import settings
+from .db import DB, AccessLog, Max
+from .rollups import rollups
+
+log = logging.getLogger(__name__)
+
+
+class AccessLogRetention:
+    """moves access log rows older than the horizon to the archive"""
+
+    def __init__(
+        self,
+        days: int = settings.access_log_retention_days,
+        directory: pathlib.Path = settings.access_log_archive_dir,
+        interval: float = settings.access_log_retention_interval,
+        pause: float = 0.05,
+    ):
+        self.days = days
+        self.directory = directory
+        self.interval = interval
+        self.pause = pause
+        self.moved_rows = 0
+        self.last_run: Optional[str] = None
+        self.archive_error: Optional[str] = None
+
+    async def _move_day(self, day: int, last_id: int) -> int:
+        rows = (
+            await AccessLog.select(*[getattr(AccessLog, column) for column in COLUMNS])
+            .where((AccessLog.day == day) & (AccessLog.id <= last_id))
+            .order_by(AccessLog.id)
+        )
+        await asyncio.to_thread(append_rows, self.directory, month_of(day), rows)
+        # a late row for the day is moved on the next run - the hourly rollup
+        # of its day is only exact again after a rebuild
+        await AccessLog.delete().where(
+            (AccessLog.day == day) & (AccessLog.id <= last_id)
+        )
+        return len(rows)
+
+    async def run(self, today: Optional[date] = None) -> int:
+        """move the days before the horizon - returns the number of rows moved"""
+        today = today or datetime.now(tz=settings.tz).date()
+        horizon = date_to_day(today - timedelta(days=self.days))
+        try:
+            await asyncio.to_thread(check_archive_dir, self.directory)
+        except ArchiveError as ex:
+            # the rows are deleted once archived - keep them rather than lose them
+            log.error(f"not moving any access log rows - {ex}")
+            self.archive_error = str(ex)
+            return 0
+        self.archive_error = None
+        await rollups.catch_up()
+        watermark = await rollups.watermark()
+        # the newest row always stays - sqlite hands out max(id) + 1 as the next
+        # id and the rollup watermark relies on the ids only growing
+        newest = (await AccessLog.select(Max(AccessLog.id).as_alias("id")).first())[
+            "id"
+        ]
+        moved = 0
+        while True:
+            oldest = await AccessLog.raw(
+                """SELECT day, max(id) AS last_id FROM accesslog
+                WHERE day > 0 AND day < {} GROUP BY day ORDER BY day LIMIT 1""",
+                horizon,
+            )
+            if not oldest or oldest[0]["last_id"] >= newest:
+                break
+            if oldest[0]["last_id"] > watermark:
+                log.info(f"access log day {oldest[0]['day']} is not rolled up yet")
+                break
+            moved += await self._move_day(oldest[0]["day"], oldest[0]["last_id"])
+            await asyncio.sleep(self.pause)
+        self.moved_rows += moved
+        self.last_run = datetime.now(tz=settings.tz).isoformat(timespec="seconds")
+        if moved:
+            log.info(f"moved {moved} access log rows before {horizon} to the archive")
+        return moved
+
+    async def runner(self):
+        # let the startup and the backfill go first
+        await asyncio.sleep(5 * 60)
+        while True:
+            try:
+                await self.run()
+            except Exception as ex:
+                log.exception(f"access log retention error {ex}")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self, task: asyncio.Task) -> None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    def stats(self) -> dict:
+        archived = months(self.directory)
+        return {
+            "moved_rows": self.moved_rows,
+            "last_run": self.last_run,
+            "archive_error": self.archive_error,
+            "archive_months": len(archived),
+            "archive_bytes": sum(
+                month_path(self.directory, month).stat().st_size for month in archived
+            ),
+        }
+
+
+retention = AccessLogRetention()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        description="move old access log rows to the archive"
+    )
+    parser.add_argument(
+        "--vacuum",
+        action="store_true",
+        help="rewrite the database file afterwards to give the freed pages back",
+    )
+    args = parser.parse_args(argv)
+
+    async def run() -> int:
+        try:
+            moved = await retention.run()
+            if args.vacuum:
+                await DB.run_ddl("VACUUM")
+            return moved
+        finally:
+            await DB.close_pool()
+
+    moved = asyncio.run(run())
+    print(f"moved {moved} access log rows to {retention.directory}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
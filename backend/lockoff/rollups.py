@@ -0,0 +1,294 @@
+"""rollups of the access log for the admin and public stats
+
+the stats pages read three small tables instead of scanning the access log:
+
+- visit_day: one row per member/ticket (token_type, obj_id) and day they came
+- daily_visitors: unique visitors per day and token type
+- hourly_visitors: unique visitors per local hour
+
+(the usual occupancy counts unique visitors over a two hour window, which
+the hourly counts can't give - see usual_visitors)
+
+the runner folds the access log rows newer than the watermark (the last
+access log id included) into the rollups a batch at a time, each batch in one
+transaction with the watermark. The days a batch touches are recounted so a
+late row (an offline reader event) lands where it belongs - the access log is
+written in time order so that is mostly just today. A rebuild also reads the
+rows moved to the archive (see lockoff.retention).
+Rows the backfill has not converted yet (epoch = 0) are waited for.
+
+rebuild them from scratch with
+
+    python -m lockoff.rollups rebuild
+"""
+
+import argparse
+import asyncio
+import collections
+import functools
+import logging
+import operator
+import pathlib
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from piccolo.table import create_db_tables
+
+from .access_archive import months, read_month
+from .config import settings
+from .db import (
+    DB,
+    AccessLog,
+    Count,
+    DailyVisitors,
+    HourlyVisitors,
+    RollupWatermark,
+    VisitDay,
+)
+from .migrations import migrate
+
+log = logging.getLogger(__name__)
+
+WATERMARK = "access_log"
+ROLLUP_TABLES = [VisitDay, DailyVisitors, HourlyVisitors, RollupWatermark]
+
+# the rows of a batch - id > {} AND id <= {}. The unary + keeps sqlite on the
+# id range (the accesslog_day index would scan every row with day > 0)
+_BATCH = "accesslog WHERE id > {} AND id <= {} AND +day > 0"
+
+
+class Rollups:
+    """keeps the access rollups up to date with the access log"""
+
+    def __init__(
+        self,
+        batch_size: int = settings.rollup_batch_size,
+        interval: float = settings.rollup_interval,
+    ):
+        self.batch_size = batch_size
+        self.interval = interval
+        self._lock = asyncio.Lock()
+        self.rolled_rows = 0
+        self.last_run_latency: Optional[float] = None
+
+    async def watermark(self) -> int:
+        row = (
+            await RollupWatermark.select(RollupWatermark.last_id)
+            .where(RollupWatermark.name == WATERMARK)
+            .first()
+        )
+        return row["last_id"] if row else 0
+
+    async def _set_watermark(self, last_id: int) -> None:
+        await RollupWatermark.insert(
+            RollupWatermark(name=WATERMARK, last_id=last_id)
+        ).on_conflict(
+            target=RollupWatermark.name,
+            action="DO UPDATE",
+            values=[RollupWatermark.last_id],
+        )
+
+    async def _roll_batch(self) -> int:
+        async with DB.transaction():
+            first_id = await self.watermark()
+            # stop short of the first row the backfill has not converted
+            pending = await AccessLog.raw(
+                "SELECT min(id) AS id FROM accesslog WHERE epoch = 0"
+            )
+            stop_id = pending[0]["id"] if pending[0]["id"] is not None else 2**62
+            batch = await AccessLog.raw(
+                """SELECT count(*) AS rows, max(id) AS last_id FROM (
+                    SELECT id FROM accesslog WHERE id > {} AND id < {}
+                    ORDER BY id LIMIT {}
+                )""",
+                first_id,
+                stop_id,
+                self.batch_size,
+            )
+            rows, last_id = batch[0]["rows"], batch[0]["last_id"]
+            if not rows:
+                return 0
+            await AccessLog.raw(
+                f"""INSERT OR IGNORE INTO visit_day (token_type, obj_id, day)
+                SELECT DISTINCT token_type, obj_id, day FROM {_BATCH}""",
+                first_id,
+                last_id,
+            )
+            await AccessLog.raw(
+                f"""INSERT OR REPLACE INTO daily_visitors (day, token_type, visitors)
+                SELECT day, token_type, count(*) FROM visit_day
+                WHERE day IN (SELECT DISTINCT day FROM {_BATCH})
+                GROUP BY day, token_type""",
+                first_id,
+                last_id,
+            )
+            await AccessLog.raw(
+                f"""INSERT OR REPLACE INTO hourly_visitors (day, hour, visitors)
+                SELECT day, hour, count(*) FROM (
+                    SELECT DISTINCT day, hour, token_type, obj_id FROM accesslog
+                    WHERE day IN (SELECT DISTINCT day FROM {_BATCH})
+                )
+                GROUP BY day, hour""",
+                first_id,
+                last_id,
+            )
+            await self._set_watermark(last_id)
+        return rows
+
+    async def _catch_up(self) -> int:
+        start = time.perf_counter()
+        rolled = 0
+        while rows := await self._roll_batch():
+            rolled += rows
+        self.rolled_rows += rolled
+        self.last_run_latency = time.perf_counter() - start
+        return rolled
+
+    async def catch_up(self) -> int:
+        """fold the access log rows past the watermark into the rollups"""
+        async with self._lock:
+            return await self._catch_up()
+
+    async def _roll_archived_month(self, archive_dir: pathlib.Path, month: str) -> int:
+        rows = [
+            row
+            for row in await asyncio.to_thread(read_month, archive_dir, month)
+            if row["day"] > 0
+        ]
+        visits = {(row["token_type"], row["obj_id"], row["day"]) for row in rows}
+        hours = collections.defaultdict(set)
+        for row in rows:
+            hours[(row["day"], row["hour"])].add((row["token_type"], row["obj_id"]))
+        first_day = int(month.replace("-", "")) * 100
+        visit_rows = [
+            VisitDay(token_type=token_type, obj_id=obj_id, day=day)
+            for token_type, obj_id, day in visits
+        ]
+        hour_rows = [
+            HourlyVisitors(day=day, hour=hour, visitors=len(visitors))
+            for (day, hour), visitors in hours.items()
+        ]
+        async with DB.transaction():
+            # within sqlite's limit of bound variables per statement
+            for i in range(0, len(visit_rows), 1000):
+                await VisitDay.insert(*visit_rows[i : i + 1000])
+            for i in range(0, len(hour_rows), 1000):
+                await HourlyVisitors.insert(*hour_rows[i : i + 1000])
+            await AccessLog.raw(
+                """INSERT OR REPLACE INTO daily_visitors (day, token_type, visitors)
+                SELECT day, token_type, count(*) FROM visit_day
+                WHERE day > {} AND day < {}
+                GROUP BY day, token_type""",
+                first_day,
+                first_day + 100,
+            )
+        return len(rows)
+
+    async def rebuild(
+        self, archive_dir: pathlib.Path = settings.access_log_archive_dir
+    ) -> int:
+        """empty the rollups and roll up the archive and the access log again"""
+        async with self._lock:
+            async with DB.transaction():
+                for table in [VisitDay, DailyVisitors, HourlyVisitors]:
+                    await table.delete(force=True)
+                await self._set_watermark(0)
+            rolled = 0
+            for month in months(archive_dir):
+                rolled += await self._roll_archived_month(archive_dir, month)
+            rolled += await self._catch_up()
+        log.info(f"rebuilt the access rollups from {rolled} access log rows")
+        return rolled
+
+    async def runner(self):
+        while True:
+            try:
+                await self.catch_up()
+            except Exception as ex:
+                log.exception(f"rollup runner error {ex}")
+            await asyncio.sleep(self.interval)
+
+    async def stop(self, task: asyncio.Task) -> None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    async def stats(self) -> dict:
+        watermark = await self.watermark()
+        behind = await AccessLog.count().where(AccessLog.id > watermark)
+        unconverted = await AccessLog.count().where(AccessLog.epoch == 0)
+        return {
+            "watermark": watermark,
+            "behind": behind,
+            # the rollups wait for the backfill to convert these
+            "unconverted_rows": unconverted,
+            "blocked_on_backfill": bool(behind and unconverted),
+            "rolled_rows": self.rolled_rows,
+            "last_run_latency": self.last_run_latency,
+        }
+
+
+rollups = Rollups()
+
+
+async def usual_visitors(at: datetime, span: timedelta = timedelta(hours=2)) -> float:
+    """the median unique visitors in the span before at, same weekday, the last 12 weeks
+
+    comparable to the live count of the /occupancy page, so a visitor is
+    counted once per window - that is why this reads the access log (the
+    epoch index, 12 short ranges) and not the hourly rollups, where someone
+    staying past the hour is in two hours. The span is cut at midnight (it
+    is the same weekday). Days without visitors in the span are left out.
+    """
+    at = at.astimezone(settings.tz)
+    windows = []
+    for weeks in range(1, 13):
+        end = at - timedelta(weeks=weeks)
+        midnight = datetime.combine(end.date(), datetime.min.time(), tzinfo=settings.tz)
+        start = max(end - span, midnight)
+        windows.append(
+            (AccessLog.epoch > int(start.timestamp()))
+            & (AccessLog.epoch <= int(end.timestamp()))
+        )
+    visited = [
+        row["count"]
+        for row in await AccessLog.select(
+            AccessLog.day, Count(distinct=[AccessLog.obj_id])
+        )
+        .where(functools.reduce(operator.or_, windows))
+        .group_by(AccessLog.day)
+    ]
+    return round(statistics.median(visited), 2) if visited else 0
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="maintain the access log rollups")
+    parser.add_argument(
+        "command",
+        choices=["rebuild", "catch-up"],
+        help="rebuild from scratch or only roll up the rows past the watermark",
+    )
+    args = parser.parse_args(argv)
+
+    async def run() -> int:
+        try:
+            await create_db_tables(*ROLLUP_TABLES, if_not_exists=True)
+            await migrate()
+            if args.command == "rebuild":
+                return await rollups.rebuild()
+            return await rollups.catch_up()
+        finally:
+            await DB.close_pool()
+
+    rows = asyncio.run(run())
+    print(f"{args.command}: rolled up {rows} access log rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,8 @@
 import io
 import logging
 import asyncio
-from datetime import datetime, date
-from typing import Annotated
+from datetime import date, datetime
+from typing import Annotated, Optional
 import itertools
 import statistics
 
@@ -18,6 +18,8 @@ from fastapi import (
 )
 
 from .. import depends, schemas
+from ..access_archive import access_log_between
+from ..access_log import access_log_writer, date_to_day, day_to_date, epoch_to_iso
 from ..access_token import (
     TokenError,
     TokenMedia,
@@ -32,6 +34,7 @@ from ..config import settings
 from ..db import (
     DB,
     AccessLog,
+    DailyVisitors,
     Dayticket,
     Max,
     Otherticket,
@@ -41,11 +44,25 @@ from ..db import (
     APDevice,
     APPass,
     APReg,
+    VisitDay,
 )
-from ..klubmodul import refresh
+from ..klubmodul import klubmodul, refresh
+from ..membership import membership
+from ..outbox import outbox
+from ..retention import retention
+from ..rollups import rollups
 
 router = APIRouter(tags=["admin"])
 
+# the access log as the admin pages show it - timestamp is added from epoch
+ACCESS_LOG_COLUMNS = [
+    AccessLog.id,
+    AccessLog.obj_id,
+    AccessLog.token_type,
+    AccessLog.token_media,
+    AccessLog.epoch,
+]
+
 log = logging.getLogger(__name__)
 
 
@@ -151,6 +168,7 @@ async def create_other_ticket(
     inserted = await Otherticket.insert(
         Otherticket(id=None, name=data.name, active=True)
     ).returning(Otherticket.id)
+    await membership.rebuild()
 
 
 @router.get("/othertickets/{id}")
@@ -173,6 +191,7 @@ async def delete_other_ticket(
     ],
 ) -> schemas.StatusReply:
     await Otherticket.update({Otherticket.active: False}).where(Otherticket.id == id)
+    await membership.rebuild()
     return schemas.StatusReply(status="OK")
 
 
@@ -257,6 +276,17 @@ async def klubmodul_force_resync(
     return schemas.StatusReply(status="sync started")
 
 
+@router.post("/rollups-rebuild")
+async def rollups_rebuild(
+    _: Annotated[
+        list[UserModel], Security(depends.get_current_users, scopes=["admin"])
+    ],
+    background_tasks: BackgroundTasks,
+) -> schemas.StatusReply:
+    background_tasks.add_task(rollups.rebuild)
+    return schemas.StatusReply(status="rebuild started")
+
+
 async def expire_google_passes_task():
     google_passes = await GPass.select().where(GPass.status != GPassStatus.DELETED)
     async with GooglePass() as gp:
@@ -317,8 +347,20 @@ async def get_raw_log(
     _: Annotated[
         list[UserModel], Security(depends.get_current_users, scopes=["admin"])
     ],
+    since: Optional[date] = None,
+    until: Optional[date] = None,
 ):
-    data = await AccessLog.select().order_by(AccessLog.timestamp, ascending=False)
+    if since is None and until is None:
+        # the table - rows older than the retention horizon are archived
+        data = await AccessLog.select(*ACCESS_LOG_COLUMNS).order_by(
+            AccessLog.epoch, ascending=False
+        )
+    else:
+        data = await access_log_between(
+            date_to_day(since or date.min), date_to_day(until or date.max)
+        )
+    for row in data:
+        row["timestamp"] = epoch_to_iso(row["epoch"])
     return {"data": data}
 
 
@@ -329,17 +371,17 @@ async def get_log_unique_daily(
     ],
 ):
     data = []
-    rawdata = await AccessLog.select().order_by(AccessLog.timestamp)
-    for k, g in itertools.groupby(rawdata, lambda x: x["timestamp"][:10]):
-        d = date.fromisoformat(k)
-        row = {"day": k, "dow": f"{d:%A}".lower()}
-        lg = list(g)
-        for tt in TokenType:
-            row[tt.name] = len(
-                {x["obj_id"] for x in lg if TokenType(x["token_type"]) == tt}
-            )
+    rawdata = await DailyVisitors.select(
+        DailyVisitors.day, DailyVisitors.token_type, DailyVisitors.visitors
+    ).order_by(DailyVisitors.day, ascending=False)
+    for day, g in itertools.groupby(rawdata, lambda x: x["day"]):
+        d = day_to_date(day)
+        row = {"day": d.isoformat(), "dow": f"{d:%A}".lower()}
+        row.update({tt.name: 0 for tt in TokenType})
+        for x in g:
+            row[TokenType(x["token_type"]).name] = x["visitors"]
         data.append(row)
-    return {"data": sorted(data, key=lambda x: x["day"], reverse=True)}
+    return {"data": data}
 
 
 @router.get("/log-user-freq.json")
@@ -350,17 +392,16 @@ async def get_log_user_freq(
 ):
     data = []
     rawdata = (
-        await AccessLog.select()
+        await VisitDay.select(VisitDay.obj_id, VisitDay.day)
         .where(
-            AccessLog.token_type.is_in(
-                [TokenType.NORMAL.value, TokenType.OFFPEAK.value]
-            )
+            VisitDay.token_type.is_in([TokenType.NORMAL.value, TokenType.OFFPEAK.value])
         )
-        .order_by(AccessLog.obj_id)
+        .distinct()
+        .order_by(VisitDay.obj_id)
+        .order_by(VisitDay.day)
     )
     for user_id, g in itertools.groupby(rawdata, lambda x: x["obj_id"]):
-        lg = list(g)
-        dates = sorted({date.fromisoformat(x["timestamp"][:10]) for x in lg})
+        dates = [day_to_date(x["day"]) for x in g]
         diffs = [(x2 - x1).days for (x1, x2) in itertools.pairwise(dates)]
         if diffs:
             data.append(
@@ -375,22 +416,27 @@ async def system_status(
         list[UserModel], Security(depends.get_current_users, scopes=["admin"])
     ],
 ):
+    last_sync = await klubmodul.last_sync()
+    # unchanged rows keep their batch_id so the newest one is only a fallback
     last_batch_id = (
-        await User.select(Max(User.batch_id).as_alias("last_batch_id"))
-        .where(User.active == True)
-        .first()
-    )["last_batch_id"]
+        last_sync["batch_id"]
+        if last_sync
+        else (
+            await User.select(Max(User.batch_id).as_alias("last_batch_id")).first()
+        )["last_batch_id"]
+    )
     lsd = datetime.now(tz=settings.tz) - datetime.fromisoformat(last_batch_id)
     hours, remainder = divmod(lsd.total_seconds(), 3600)
     minutes, _ = divmod(remainder, 60)
     active_users = await User.count().where(User.active == True)
     member_access = (
-        await AccessLog.select()
-        .order_by(AccessLog.timestamp, ascending=False)
+        await AccessLog.select(*ACCESS_LOG_COLUMNS)
+        .order_by(AccessLog.epoch, ascending=False)
         .limit(20)
     )
-    # fixup display of tokentype and tokenmedia
+    # fixup display of timestamp, tokentype and tokenmedia
     for ma in member_access:
+        ma["timestamp"] = epoch_to_iso(ma["epoch"])
         ma["token_type"] = TokenType(ma["token_type"]).name
         ma["token_media"] = TokenMedia(ma["token_media"]).name
     dt_stats = await Dayticket.raw(
@@ -424,6 +470,7 @@ group by batch_id"""
     )
     return {
         "last_sync": f"{hours:.0f} hours and {minutes:.0f} minutes ago",
+        "last_sync_changes": last_sync,
         "active_users": active_users,
         "member_access": member_access,
         "dt_stats": dt_stats,
@@ -433,4 +480,9 @@ group by batch_id"""
         "digital_issued": digital_issued,
         "print_issued": print_issued,
         "total_issued": total_issued,
+        "access_log_writer": access_log_writer.stats(),
+        "db": DB.stats(),
+        "outbox": await outbox.stats(),
+        "rollups": await rollups.stats(),
+        "retention": retention.stats(),
     }
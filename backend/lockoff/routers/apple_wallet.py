@@ -50,17 +50,13 @@ async def register_device(
                 APDevice.push_service_url,
             ],
         )
-        # upsert link pass and device - piccolo-orm currently doesn't support compound-keys so cannot do upsert :-/
-        if not await APReg.exists().where(
-            APReg.device_library_identifier == device_library_identifier,
-            APReg.serial_number == serial_number,
-        ):
-            await APReg.insert(
-                APReg(
-                    device_library_identifier=device_library_identifier,
-                    serial_number=serial_number,
-                )
+        # link pass and device - unique on (device_library_identifier, serial_number)
+        await APReg.insert(
+            APReg(
+                device_library_identifier=device_library_identifier,
+                serial_number=serial_number,
             )
+        ).on_conflict(action="DO NOTHING")
 
 
 # apple wallet delete
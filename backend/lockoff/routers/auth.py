@@ -2,7 +2,7 @@ import logging
 from datetime import datetime, timedelta
 
 import pyotp
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status
 
 # from fastapi_limiter.depends import RateLimiter
 from jose import jwt
@@ -10,28 +10,23 @@ from jose import jwt
 from .. import schemas
 from ..config import settings
 from ..db import User
-from ..klubmodul import KMClient
 from ..misc import simple_hash
+from ..outbox import outbox
 
 router = APIRouter(tags=["auth"])
 log = logging.getLogger(__name__)
 
 
-async def send_mobile(user_id: int, message: str):
-    async with KMClient() as km:
-        await km.send_sms(user_id=user_id, message=message)
-    log.info(f"sms sent to {user_id}")
+# codes are accepted this many 30s steps either side of now - see login
+LOGIN_VALID_WINDOW = 6
+# a login code not sent by then is not worth sending - it leaves a minute to
+# type it in before it expires
+LOGIN_CODE_MAX_AGE = LOGIN_VALID_WINDOW * 30 - 60
 
-
-async def send_email(user_id: int, message: str):
-    async with KMClient() as km:
-        await km.send_email(user_id=user_id, subject="AUTHMSG", message=message)
-    log.info(f"email sent to {user_id}")
-
-
-send_funcs = {
-    "email": send_email,
-    "mobile": send_mobile,
+# username_type -> outbox message kind
+message_kinds = {
+    "email": "email",
+    "mobile": "sms",
 }
 
 
@@ -39,9 +34,7 @@ send_funcs = {
     "/request-totp"
 )  # , dependencies=[Depends(RateLimiter(times=10, seconds=300))]
 # )
-async def request_totp(
-    rt: schemas.RequestTOTP, background_tasks: BackgroundTasks
-) -> schemas.StatusReply:
+async def request_totp(rt: schemas.RequestTOTP) -> schemas.StatusReply:
     if rt.username_type == "email":
         users = await User.select(User.id, User.totp_secret).where(
             User.email == simple_hash(rt.username), User.active == True
@@ -58,12 +51,15 @@ async def request_totp(
     totp = pyotp.TOTP(users[0]["totp_secret"])
     log.info(f"send_{rt.username_type}(user_id={user_ids[0]}, message={totp.now()})")
     code = totp.now()
-    background_tasks.add_task(
-        send_funcs[rt.username_type],
+    # sent by the outbox runner
+    await outbox.add(
+        kind=message_kinds[rt.username_type],
         user_id=user_ids[0],
+        subject="AUTHMSG",
         message=f"code is {code}\n\n@nkk.dk #{code}",
+        max_age=LOGIN_CODE_MAX_AGE,
     )
-    return schemas.StatusReply(status=f"{rt.username_type} message sent")
+    return schemas.StatusReply(status=f"{rt.username_type} message queued")
 
 
 @router.post("/login")  # , dependencies=[Depends(RateLimiter(times=10, seconds=300))])
@@ -87,7 +83,7 @@ async def login(
     totp_secrets = [u["totp_secret"] for u in users]
     user_ids = [u["id"] for u in users]
     totp = pyotp.TOTP(totp_secrets[0])
-    if not totp.verify(otp=login_data.totp, valid_window=6):
+    if not totp.verify(otp=login_data.totp, valid_window=LOGIN_VALID_WINDOW):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="no such user, code is expired or not valid",
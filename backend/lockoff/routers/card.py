@@ -17,6 +17,7 @@ from ..access_token import (
 from ..card import ApplePass, GooglePass, GPassStatus, generate_pdf, generate_png
 from ..config import settings
 from ..db import DB, APPass, GPass, User
+from ..totp_cache import totp_verifier
 
 router = APIRouter(tags=["card"])
 
@@ -202,6 +203,8 @@ async def get_google_wallet(
                 status=GPassStatus.UNKNOWN,
             )
         ).on_conflict(target=GPass.id, action="DO UPDATE", values=[GPass.totp])
+    # the door must pick up the new totp secret on next scan
+    totp_verifier.invalidate(user_id)
     return RedirectResponse(
         url=jwt_url,
         headers={"Cache-Control": "no-cache", "CDN-Cache-Control": "no-store"},
@@ -1,21 +1,36 @@
+import asyncio
+import json
 import logging
 from datetime import date, datetime
+from typing import Any, Optional
 
+from cachetools import TTLCache
 from dateutil.relativedelta import relativedelta
-from fastapi import APIRouter, Depends, HTTPException, Security, status
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Security,
+    WebSocket,
+    WebSocketDisconnect,
+    status,
+)
 from fastapi.security import APIKeyHeader
-from pyotp import TOTP
 
 from .. import schemas
+from ..access_log import access_log_writer
 from ..access_token import (
     TokenError,
+    TokenMedia,
     TokenType,
     log_and_raise_token_error,
     verify_access_token,
 )
 from ..config import settings
-from ..db import DB, AccessLog, Dayticket, GPass, Otherticket, User
+from ..db import DB, Dayticket
+from ..membership import membership, signed_export
 from ..misc import DISPLAY_CODES
+from ..totp_cache import totp_verifier
 
 log = logging.getLogger(__name__)
 
@@ -23,6 +38,14 @@ router = APIRouter(tags=["reader"])
 
 api_key_header = APIKeyHeader(name="reader-token", auto_error=False)
 
+# people hold the phone under the reader for a while which gives repeated scans
+# of the same qr code - remember recent grants (with the membership snapshot
+# version they were decided on) and answer repeats without redoing the work
+recent_grants = TTLCache(
+    maxsize=settings.reader_repeat_cache_size,
+    ttl=settings.reader_repeat_window,
+)
+
 
 async def get_api_key(api_key_header: str = Security(api_key_header)):
     if api_key_header == settings.reader_token:
@@ -35,13 +58,8 @@ async def get_api_key(api_key_header: str = Security(api_key_header)):
 
 
 async def check_member(user_id: int, token_type: TokenType):
-    today = datetime.now(tz=settings.tz)
-    user = (
-        await User.select(User.id)
-        .where(User.id == user_id, User.active == True)
-        .first()
-    )
-    if not user:
+    await membership.ensure_loaded()
+    if not membership.is_member(user_id):
         log_and_raise_token_error(
             "did you cancel your membership?", code=DISPLAY_CODES.NO_MEMBER
         )
@@ -91,25 +109,27 @@ async def check_member(user_id: int, token_type: TokenType):
 
 
 async def check_totp(user_id: int, totp: str):
-    gps = await GPass.select(GPass.totp).where(GPass.user_id == user_id)
-    verifiers = [TOTP(s=gp["totp"], digits=8) for gp in gps]
-    if not any([verifier.verify(otp=totp, valid_window=5) for verifier in verifiers]):
+    if not await totp_verifier.verify(user_id=user_id, otp=totp):
         log_and_raise_token_error(
             "totp code did not match", code=DISPLAY_CODES.QR_ERROR_SIGNATURE
         )
 
 
 async def check_otherticket(user_id: int):
-    ticket = (
-        await Otherticket.select(Otherticket.id)
-        .where(Otherticket.id == user_id)
-        .first()
-    )
-    if not ticket:
+    await membership.ensure_loaded()
+    # only active tickets - one deleted in the admin (made inactive) is refused
+    if not membership.is_otherticket(user_id):
         log_and_raise_token_error("no such ticket", code=DISPLAY_CODES.NO_MEMBER)
 
 
 async def check_qrcode(qr_code: str) -> tuple[int, str, str]:
+    if (cached := recent_grants.get(qr_code)) is not None:
+        version, grant = cached
+        if version == membership.version:
+            log.info(f"{grant[0]} {grant[1]} repeat scan - access granted")
+            return grant
+        # membership changed since the grant - decide again
+        del recent_grants[qr_code]
     user_id, token_type, token_media, totp = verify_access_token(
         token=qr_code
     )  # it will raise TokenError if not valid
@@ -133,27 +153,127 @@ async def check_qrcode(qr_code: str) -> tuple[int, str, str]:
         case _:
             log_and_raise_token_error("general error", code=DISPLAY_CODES.GENERIC_ERROR)
     log.info(f"{user_id} {token_type} access granted")
-    # log in access_log db
-    async with DB.transaction():
-        await AccessLog.insert(
-            AccessLog(
-                id=None,
-                obj_id=user_id,
-                token_type=token_type,
-                token_media=token_media,
-                timestamp=datetime.now(tz=settings.tz).isoformat(timespec="seconds"),
-            )
-        )
-    return (user_id, token_type, token_media)
+    # log in access_log db (written in the background)
+    await access_log_writer.add(
+        obj_id=user_id, token_type=token_type, token_media=token_media
+    )
+    grant = (user_id, token_type, token_media)
+    recent_grants[qr_code] = (membership.version, grant)
+    return grant
 
 
-@router.post("/reader-check-code", dependencies=[Depends(get_api_key)])
-async def reader_check_code(data: schemas.ReaderCheckCode):
+async def reader_verdict(qr_code: str) -> tuple[bool, dict]:
+    """the answer for the reader: (True, status reply) or (False, error detail)"""
     try:
-        user_id, _, _ = await check_qrcode(qr_code=data.qr_code)
+        user_id, _, _ = await check_qrcode(qr_code=qr_code)
     except TokenError as ex:
-        raise HTTPException(
-            status_code=status.HTTP_418_IM_A_TEAPOT,
-            detail={"code": ex.code.decode(), "reason": str(ex)},
+        return False, {"code": ex.code.decode(), "reason": str(ex)}
+    return True, {"status": "J" if user_id in settings.eljefe else "K"}
+
+
+@router.post("/reader-check-code", dependencies=[Depends(get_api_key)])
+async def reader_check_code(data: schemas.ReaderCheckCode):
+    granted, reply = await reader_verdict(qr_code=data.qr_code)
+    if not granted:
+        raise HTTPException(status_code=status.HTTP_418_IM_A_TEAPOT, detail=reply)
+    return schemas.StatusReply(**reply)
+
+
+@router.get("/reader-snapshot", dependencies=[Depends(get_api_key)])
+async def reader_snapshot(since: Optional[str] = None):
+    """signed membership snapshot for readers verifying offline
+
+    pass the batch_id the reader has as since to get a delta (if possible)
+    """
+    await membership.ensure_loaded()
+    return signed_export(since=since)
+
+
+@router.post("/reader-access-log", dependencies=[Depends(get_api_key)])
+async def reader_access_log(data: schemas.ReaderAccessLog) -> schemas.StatusReply:
+    """access events the reader granted while offline"""
+    for event in data.events:
+        await access_log_writer.add(
+            obj_id=event.user_id,
+            token_type=event.token_type,
+            token_media=event.token_media,
+            at=event.timestamp,
         )
-    return schemas.StatusReply(status="J" if user_id in settings.eljefe else "K")
+    log.info(f"received {len(data.events)} offline access events from reader")
+    return schemas.StatusReply(status="OK")
+
+
+def parse_scan(raw: str) -> tuple[Any, Optional[str]]:
+    """the id and qr code of a reader websocket message - qr code None if malformed"""
+    try:
+        message = json.loads(raw)
+    except ValueError:
+        return None, None
+    if not isinstance(message, dict):
+        return None, None
+    qr_code = message.get("qr_code")
+    return message.get("id"), qr_code if isinstance(qr_code, str) else None
+
+
+@router.websocket("/reader-ws")
+async def reader_ws(websocket: WebSocket):
+    """long-lived channel for the reader
+
+    the reader sends {"id": 1, "qr_code": "..."} and gets the same answer as
+    /reader-check-code back tagged with the id - {"id": 1, "status": "K"} or
+    {"id": 1, "detail": {"code": "Q", "reason": "..."}}. A malformed message
+    gets a Q detail too (with its id if it has one) and the channel stays up
+    """
+    if websocket.headers.get("reader-token") != settings.reader_token:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    send_lock = asyncio.Lock()
+    tasks = set()
+
+    async def send(request_id: Any, granted: bool, reply: dict):
+        async with send_lock:
+            await websocket.send_json(
+                {"id": request_id, **(reply if granted else {"detail": reply})}
+            )
+
+    async def answer(request_id: Any, qr_code: str):
+        try:
+            granted, reply = await reader_verdict(qr_code=qr_code)
+        except Exception as ex:
+            # the reader waits for an answer to every id
+            log.exception(f"reader websocket error {ex}")
+            granted, reply = False, {
+                "code": DISPLAY_CODES.GENERIC_ERROR.decode(),
+                "reason": "general error",
+            }
+        await send(request_id, granted, reply)
+
+    try:
+        while True:
+            try:
+                raw = await websocket.receive_text()
+            except KeyError:
+                # a binary frame
+                raw = ""
+            request_id, qr_code = parse_scan(raw)
+            if qr_code is None:
+                log.warning(f"malformed reader websocket message {raw[:100]!r}")
+                await send(
+                    request_id,
+                    False,
+                    {
+                        "code": DISPLAY_CODES.QR_ERROR.decode(),
+                        "reason": "malformed message",
+                    },
+                )
+                continue
+            # answer scans concurrently - the id tells the reader which is which
+            task = asyncio.create_task(answer(request_id, qr_code))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        log.info("reader websocket disconnected")
+    finally:
+        for task in tasks:
+            task.cancel()
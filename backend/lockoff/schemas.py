@@ -1,7 +1,10 @@
+from datetime import datetime
 from typing import Annotated, Literal, Optional
 
 from pydantic import BaseModel, Field, constr
 
+from .access_token import TokenMedia, TokenType
+
 username_type = Literal["mobile", "email"]
 
 
@@ -68,5 +71,16 @@ class ReaderCheckCode(BaseModel):
     qr_code: str
 
 
+class ReaderAccessEvent(BaseModel):
+    user_id: int
+    token_type: TokenType
+    token_media: TokenMedia
+    timestamp: datetime
+
+
+class ReaderAccessLog(BaseModel):
+    events: list[ReaderAccessEvent]
+
+
 class OtherTicket(BaseModel):
     name: str
@@ -0,0 +1,86 @@
+import hashlib
+import hmac
+import logging
+import struct
+import time
+from dataclasses import dataclass, field
+
+import pyotp
+
+from .db import GPass
+
+log = logging.getLogger(__name__)
+
+
+def hotp(key: bytes, counter: int, digits: int = 8) -> str:
+    """rfc4226 hotp - same result as pyotp but on an already decoded key"""
+    digest = hmac.digest(key, struct.pack(">Q", counter), hashlib.sha1)
+    offset = digest[-1] & 0xF
+    code = struct.unpack_from(">I", digest, offset)[0] & 0x7FFFFFFF
+    return str(code % 10**digits).zfill(digits)
+
+
+@dataclass
+class _UserCodes:
+    keys: list[bytes]
+    bucket: int = -1
+    codes: dict[int, frozenset[str]] = field(default_factory=dict)
+    accepted: frozenset[str] = frozenset()
+
+
+class TOTPVerifier:
+    """verify the rotating 8 digit totp suffix from google wallet passes
+
+    the decoded secrets for a user are kept in memory together with the codes
+    accepted for the current 30 second bucket +/- valid_window buckets, so a
+    scan is a set lookup. When the bucket rolls over only the new buckets are
+    computed. Call invalidate when a user gets a new secret (users without
+    any secret are not cached).
+    """
+
+    def __init__(self, digits: int = 8, interval: int = 30, valid_window: int = 5):
+        self.digits = digits
+        self.interval = interval
+        self.valid_window = valid_window
+        self._users: dict[int, _UserCodes] = {}
+
+    async def _load(self, user_id: int) -> _UserCodes:
+        keys = []
+        for gp in await GPass.select(GPass.totp).where(GPass.user_id == user_id):
+            try:
+                keys.append(pyotp.TOTP(gp["totp"]).byte_secret())
+            except Exception as ex:
+                log.warning(f"could not decode totp secret for user {user_id}: {ex}")
+        entry = _UserCodes(keys=keys)
+        # a user without a pass yet is looked up again on the next scan - so a
+        # pass written without an invalidate still works
+        if keys:
+            self._users[user_id] = entry
+        return entry
+
+    def _roll(self, entry: _UserCodes, bucket: int) -> None:
+        window = range(bucket - self.valid_window, bucket + self.valid_window + 1)
+        entry.codes = {
+            b: entry.codes.get(b)
+            or frozenset(hotp(key, b, self.digits) for key in entry.keys)
+            for b in window
+        }
+        entry.accepted = frozenset().union(*entry.codes.values())
+        entry.bucket = bucket
+
+    async def verify(self, user_id: int, otp: str) -> bool:
+        if (entry := self._users.get(user_id)) is None:
+            entry = await self._load(user_id)
+        bucket = int(time.time()) // self.interval
+        if entry.bucket != bucket:
+            self._roll(entry, bucket)
+        return otp in entry.accepted
+
+    def invalidate(self, user_id: int) -> None:
+        self._users.pop(user_id, None)
+
+    def clear(self) -> None:
+        self._users.clear()
+
+
+totp_verifier = TOTPVerifier()
@@ -0,0 +1,99 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from lockoff.access_log import AccessLogWriter, day_to_date, epoch_to_iso
+from lockoff.access_token import TokenMedia, TokenType
+from lockoff.config import settings
+from lockoff.db import AccessLog
+
+
+@pytest.mark.asyncio
+async def test_access_log_writer_batches():
+    writer = AccessLogWriter(batch_size=3, flush_interval=0.05)
+    before = await AccessLog.count()
+    task = asyncio.create_task(writer.runner())
+
+    for x in range(4):
+        await writer.add(
+            obj_id=1000 + x, token_type=TokenType.NORMAL, token_media=TokenMedia.PRINT
+        )
+    # first batch is flushed on size, the last event on time
+    await asyncio.sleep(0.2)
+    assert writer.stats()["queue_depth"] == 0
+    assert writer.flushed_rows == 4
+    assert writer.flushed_batches == 2
+    assert writer.last_flush_latency is not None
+    assert await AccessLog.count() == before + 4
+
+    await writer.stop(task)
+    assert task.done()
+
+
+@pytest.mark.asyncio
+async def test_access_log_writer_drain_on_stop():
+    writer = AccessLogWriter(batch_size=100, flush_interval=60)
+    before = await AccessLog.count()
+    task = asyncio.create_task(writer.runner())
+
+    for x in range(5):
+        await writer.add(
+            obj_id=2000 + x, token_type=TokenType.OTHER, token_media=TokenMedia.PRINT
+        )
+    await asyncio.sleep(0)
+    assert await AccessLog.count() == before
+
+    # stopping writes everything still waiting
+    await writer.stop(task)
+    assert await AccessLog.count() == before + 5
+    assert writer.stats()["queue_depth"] == 0
+
+
+@pytest.mark.asyncio
+async def test_access_log_writer_epoch():
+    writer = AccessLogWriter(batch_size=100, flush_interval=60)
+    at = datetime(2023, 1, 2, 8, 0, 0, tzinfo=settings.tz)
+    await writer.add(
+        obj_id=3000, token_type=TokenType.NORMAL, token_media=TokenMedia.PRINT, at=at
+    )
+    await writer.drain()
+    row = await AccessLog.select().where(AccessLog.obj_id == 3000).first()
+    assert row["epoch"] == int(at.timestamp())
+    assert (row["day"], row["hour"]) == (20230102, 8)
+    assert day_to_date(row["day"]) == at.date()
+    assert epoch_to_iso(row["epoch"]) == at.isoformat(timespec="seconds")
+    await AccessLog.delete().where(AccessLog.obj_id == 3000)
+
+
+@pytest.mark.asyncio
+async def test_access_log_writer_keeps_failed_batch(mocker):
+    writer = AccessLogWriter(batch_size=100, flush_interval=0.05, max_retry_pause=0.1)
+    insert = AccessLog.insert
+    failures = 3
+
+    def locked(*rows):
+        nonlocal failures
+        if failures:
+            failures -= 1
+            raise Exception("database is locked")
+        return insert(*rows)
+
+    inserted = mocker.patch.object(AccessLog, "insert", side_effect=locked)
+    task = asyncio.create_task(writer.runner())
+    for x in range(2):
+        await writer.add(
+            obj_id=4000 + x, token_type=TokenType.NORMAL, token_media=TokenMedia.PRINT
+        )
+    # every attempt of the first flush fails - a scan meanwhile queues behind it
+    await asyncio.sleep(0.5)
+    await writer.add(
+        obj_id=4002, token_type=TokenType.NORMAL, token_media=TokenMedia.PRINT
+    )
+    await asyncio.sleep(1.5)
+    assert writer.stats()["failed_rows"] == 0
+    assert writer.flushed_rows == 3
+    assert inserted.call_count == 5
+    rows = await AccessLog.select(AccessLog.obj_id).where(AccessLog.obj_id >= 4000)
+    assert [row["obj_id"] for row in rows] == [4000, 4001, 4002]
+    await writer.stop(task)
+    await AccessLog.delete().where(AccessLog.obj_id >= 4000)
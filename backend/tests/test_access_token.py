@@ -1,7 +1,14 @@
+import hashlib
+import secrets
+import struct
+import time
+
+import base45
 import pytest
 from dateutil.relativedelta import relativedelta
 from fastapi import HTTPException
 from lockoff.access_token import (
+    TokenCodec,
     TokenError,
     TokenType,
     TokenMedia,
@@ -11,7 +18,9 @@ from lockoff.access_token import (
     verify_access_token,
     verify_dl_admin_token,
     verify_dl_member_token,
+    token_codec,
 )
+from lockoff.config import settings
 from freezegun import freeze_time
 
 
@@ -109,3 +118,51 @@ def test_token(user_id, token_type, token_media):
         # giberish base45 encoded
         with pytest.raises(TokenError):
             verify_access_token("D3DVJC5$C+EDE2")
+
+
+def test_token_codec_compatible_with_printed_tokens():
+    # token built the way cards were printed before the codec existed
+    with freeze_time("2023-01-01 12:00:00"):
+        expires = int(time.time()) + 3600
+        data = struct.pack(
+            ">IIHH", 42, expires, TokenType.NORMAL.value, TokenMedia.PRINT.value
+        )
+        nonce = secrets.token_bytes(settings.nonce_size)
+        signature = hashlib.shake_256(data + nonce + settings.secret).digest(
+            settings.digest_size
+        )
+        legacy_token = base45.b45encode(data + nonce + signature).decode()
+        assert len(legacy_token) == token_codec.encoded_size
+
+        assert verify_access_token(legacy_token) == (
+            42,
+            TokenType.NORMAL,
+            TokenMedia.PRINT,
+            "",
+        )
+        # android totp suffix is passed on
+        assert verify_access_token(legacy_token + "12345678")[3] == "12345678"
+
+
+def test_token_codec_many():
+    codec = TokenCodec(secret=b"other-secret", nonce_size=4, digest_size=10)
+    with freeze_time("2023-01-01 12:00:00"):
+        expires = int(time.time()) + 3600
+        tokens = codec.generate_many(
+            [
+                (1, TokenType.NORMAL, TokenMedia.PRINT),
+                (2, TokenType.OFFPEAK, TokenMedia.DIGITAL | TokenMedia.ANDROID),
+                (3, TokenType.OTHER, TokenMedia.PRINT),
+            ],
+            expires=expires,
+        )
+        results = codec.verify_many([t.decode() for t in tokens] + ["gibberish"])
+        assert [r[0] for r in results[:3]] == [1, 2, 3]
+        assert results[1][2] == TokenMedia.DIGITAL | TokenMedia.ANDROID
+        assert isinstance(results[3], TokenError)
+        # signed with another secret
+        with pytest.raises(TokenError):
+            verify_access_token(tokens[0].decode())
+    # expired
+    with freeze_time("2023-01-01 14:00:00"):
+        assert isinstance(codec.verify_many([tokens[0].decode()])[0], TokenError)
@@ -11,7 +11,7 @@ from lockoff.access_token import (
     generate_dl_admin_token,
 )
 from lockoff.config import settings
-from lockoff.routers.auth import send_email, send_mobile
+from lockoff.routers.auth import LOGIN_CODE_MAX_AGE
 
 
 @pytest.mark.parametrize(
@@ -60,14 +60,19 @@ def test_bad_jwt(client: TestClient):
 )
 def test_request_totp_mobile(user_id, ok, mocker, client: TestClient):
     mobile = f"1000100{user_id}"
-    mock = mocker.patch("fastapi.BackgroundTasks.add_task")
+    mock = mocker.patch("lockoff.routers.auth.outbox.add")
     data = {"username": mobile, "username_type": "mobile"}
     response = client.post("/request-totp", json=data)
 
     if ok:
         assert response.status_code == status.HTTP_200_OK
-        mock.assert_called_once()
-        mock.assert_called_with(send_mobile, user_id=user_id, message=mocker.ANY)
+        mock.assert_awaited_once_with(
+            kind="sms",
+            user_id=user_id,
+            subject="AUTHMSG",
+            message=mocker.ANY,
+            max_age=LOGIN_CODE_MAX_AGE,
+        )
     else:
         assert response.status_code == status.HTTP_404_NOT_FOUND
         mock.assert_not_called()
@@ -84,37 +89,24 @@ def test_request_totp_mobile(user_id, ok, mocker, client: TestClient):
 )
 def test_request_totp_email(user_id, ok, mocker, client: TestClient):
     email = f"test{user_id}@test.dk"
-    mock = mocker.patch("fastapi.BackgroundTasks.add_task")
+    mock = mocker.patch("lockoff.routers.auth.outbox.add")
     data = {"username": email, "username_type": "email"}
     response = client.post("/request-totp", json=data)
 
     if ok:
         assert response.status_code == status.HTTP_200_OK
-        mock.assert_called_once()
-        mock.assert_called_with(send_email, user_id=user_id, message=mocker.ANY)
+        mock.assert_awaited_once_with(
+            kind="email",
+            user_id=user_id,
+            subject="AUTHMSG",
+            message=mocker.ANY,
+            max_age=LOGIN_CODE_MAX_AGE,
+        )
     else:
         assert response.status_code == status.HTTP_404_NOT_FOUND
         mock.assert_not_called()
 
 
-@pytest.mark.asyncio
-async def test_send_sms(mocker):
-    km_login = mocker.patch("lockoff.routers.auth.KMClient._km_login")
-    km_send_sms = mocker.patch("lockoff.routers.auth.KMClient.send_sms")
-    await send_mobile(user_id=1, message="test")
-    km_login.assert_awaited_once()
-    km_send_sms.assert_awaited_once()
-
-
-@pytest.mark.asyncio
-async def test_send_email(mocker):
-    km_login = mocker.patch("lockoff.routers.auth.KMClient._km_login")
-    km_send_email = mocker.patch("lockoff.routers.auth.KMClient.send_email")
-    await send_email(user_id=1, message="test")
-    km_login.assert_awaited_once()
-    km_send_email.assert_awaited_once()
-
-
 @pytest.mark.parametrize(
     ["user_id", "use_correct_totp", "ok"],
     (
@@ -285,6 +277,9 @@ def test_admin(a1client: TestClient, mocker):
     assert response.status_code == status.HTTP_200_OK
     refresh.assert_awaited_once()
 
+    response = a1client.post("/admin/rollups-rebuild")
+    assert response.status_code == status.HTTP_200_OK
+
     response = a1client.get("/admin/log-raw.json")
     assert response.status_code == status.HTTP_200_OK
 
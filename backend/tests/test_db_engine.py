@@ -0,0 +1,55 @@
+import asyncio
+
+import pytest
+from lockoff.db_engine import PooledSQLiteEngine
+
+
+@pytest.mark.asyncio
+async def test_pooled_engine(tmp_path):
+    engine = PooledSQLiteEngine(path=str(tmp_path / "pool.db3"), readers=2)
+    assert (await engine.run_ddl("PRAGMA journal_mode"))[0]["journal_mode"] == "wal"
+    await engine.run_ddl("CREATE TABLE t (id INTEGER PRIMARY KEY, v TEXT)")
+    await engine.run_ddl("INSERT INTO t (v) VALUES ('a')")
+
+    in_transaction = asyncio.Event()
+    release = asyncio.Event()
+
+    async def slow_write():
+        async with engine.transaction():
+            await engine.run_ddl("INSERT INTO t (v) VALUES ('b')")
+            in_transaction.set()
+            await release.wait()
+
+    async def write():
+        await engine.run_ddl("INSERT INTO t (v) VALUES ('c')")
+
+    writer = asyncio.create_task(slow_write())
+    await in_transaction.wait()
+    # readers see the last commit while the writer holds its transaction
+    rows = await asyncio.wait_for(engine.run_ddl("SELECT v FROM t"), timeout=1)
+    assert rows == [{"v": "a"}]
+    # another write queues for the writer connection
+    queued = asyncio.create_task(write())
+    await asyncio.sleep(0.05)
+    assert not queued.done()
+    release.set()
+    await asyncio.gather(writer, queued)
+    assert [r["v"] for r in await engine.run_ddl("SELECT v FROM t ORDER BY id")] == [
+        "a",
+        "b",
+        "c",
+    ]
+
+    stats = engine.stats()
+    assert stats["writer"]["waited"] == 1
+    assert stats["writer"]["max_wait"] >= 0.05
+    assert stats["writer"]["max_hold"] >= 0.05
+    assert stats["readers"]["acquired"] == 2
+
+    # a failed transaction is rolled back and frees the writer
+    with pytest.raises(ValueError):
+        async with engine.transaction():
+            await engine.run_ddl("INSERT INTO t (v) VALUES ('d')")
+            raise ValueError()
+    assert len(await engine.run_ddl("SELECT v FROM t")) == 3
+    await engine.close_pool()
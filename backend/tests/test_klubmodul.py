@@ -1,7 +1,32 @@
+import asyncio
+import collections
+import csv
+import io
+import json
+import time
+
 import httpx
 import pytest
+from lockoff.access_token import TokenType
 from lockoff.config import settings
-from lockoff.klubmodul import KlubmodulException, KMClient, klubmodul_runner, refresh
+from lockoff.klubmodul import (
+    KlubmodulException,
+    KMClient,
+    KMSessionPool,
+    klubmodul_runner,
+    km_sessions,
+    refresh,
+)
+from lockoff.db import User
+from lockoff.klubmodul.klubmodul import (
+    KM_LISTS,
+    csv_rows,
+    diff_roster,
+    fingerprint,
+    last_sync,
+    split_records,
+)
+from lockoff.misc import simple_hash
 
 
 @pytest.mark.asyncio
@@ -75,6 +100,102 @@ async def test_klubmodul_send_email(httpx_mock):
         )
 
 
+@pytest.mark.asyncio
+async def test_klubmodul_session_relogin(httpx_mock):
+    # first login and a single login again once the session expired
+    _mock_login(httpx_mock)
+    _mock_login(httpx_mock)
+    expired = {"sent": 0}
+
+    async def create(request: httpx.Request):
+        if expired["sent"] < 2:
+            # the two messages in flight both find the session expired
+            expired["sent"] += 1
+            await asyncio.sleep(0.05)
+            return httpx.Response(
+                status_code=302, headers={"location": "/default.aspx?ReturnUrl=x"}
+            )
+        return httpx.Response(status_code=200, json={"savedId": 100})
+
+    httpx_mock.add_callback(
+        create,
+        method="POST",
+        url=f"{settings.klubmodul_base_url}/Adminv2/NewsMail/__Create",
+        is_reusable=True,
+    )
+    httpx_mock.add_response(
+        method="DELETE",
+        url=f"{settings.klubmodul_base_url}/Adminv2/Newsmail/__Delete",
+        is_reusable=True,
+    )
+
+    pool = KMSessionPool()
+    async with pool.session() as km:
+        assert km.login_generation == 1
+        await asyncio.gather(
+            km.send_sms(user_id=1, message="one", delete_delay=0),
+            km.send_sms(user_id=2, message="two", delete_delay=0),
+        )
+    async with pool.session() as again:
+        assert again is km
+        assert km.login_generation == 2
+    await pool.close()
+
+
+def _list_csv(*rows) -> str:
+    lines = ["ID;Fornavn;Efternavn;E-mail;Mobil"]
+    lines += [f"{u};f{u};e{u};F{u}@E.dk;808080{u:02d}" for u in rows]
+    return "\n".join(lines) + "\n"
+
+
+@pytest.mark.asyncio
+async def test_klubmodul_get_members_concurrent(httpx_mock, monkeypatch):
+    monkeypatch.setattr(settings, "klubmodul_list_concurrency", len(KM_LISTS))
+    monkeypatch.setattr(settings, "klubmodul_list_retry_delay", 0)
+    _mock_login(httpx_mock)
+    calls = collections.Counter()
+
+    async def export_csv(request: httpx.Request):
+        list_id = json.loads(request.content)["filter"]["teamId"]
+        calls[list_id] += 1
+        await asyncio.sleep(0.1)
+        if list_id == 117 and calls[list_id] == 1:
+            # the first try of a list fails
+            return httpx.Response(status_code=503)
+        if list_id == 117:
+            return httpx.Response(status_code=200, text=_list_csv(1, 2))
+        if list_id == 128 and calls[list_id] == 1:
+            # and one is cut off
+            raise httpx.RemoteProtocolError("peer closed connection")
+        if list_id == 128:
+            # user 2 is also on the offpeak list later in KM_LISTS
+            return httpx.Response(status_code=200, text=_list_csv(2, 3))
+        return httpx.Response(status_code=200, text=_list_csv())
+
+    httpx_mock.add_callback(
+        export_csv,
+        method="POST",
+        url=f"{settings.klubmodul_base_url}/Adminv2/TeamEnrollmentList/ExportCsv",
+        is_reusable=True,
+    )
+
+    start = time.perf_counter()
+    async with KMClient() as km:
+        members = {
+            user_id: member_type
+            async for user_id, _, member_type, _, _ in km.get_members()
+        }
+    # the lists were fetched side by side (the retry is the slowest)
+    assert time.perf_counter() - start < 0.1 * len(KM_LISTS) / 2
+    assert calls[117] == 2
+    assert calls[128] == 2
+    assert members == {
+        1: TokenType.NORMAL,
+        2: TokenType.OFFPEAK,
+        3: TokenType.OFFPEAK,
+    }
+
+
 # @pytest.mark.asyncio
 # async def test_klubmodul_get_members(httpx_mock):
 #     # login
@@ -140,3 +261,96 @@ async def test_klubmodul_runner(mocker):
 
     sleep.assert_awaited()
     refresh.assert_awaited_once()
+
+
+def test_diff_roster():
+    row = ("Test", TokenType.NORMAL, "e", "m")
+    stored = {
+        1: (fingerprint(*row), True),
+        2: (fingerprint(*row), True),
+        3: (fingerprint(*row), False),
+        4: (fingerprint(*row), True),
+    }
+    fetched = {
+        1: row,
+        2: ("Test", TokenType.OFFPEAK, "e", "m"),
+        3: row,
+        5: row,
+    }
+    summary = diff_roster(batch_id="b", fetched=fetched, stored=stored)
+    assert summary.unchanged == 1
+    assert summary.updated == [2]
+    assert summary.reactivated == [3]
+    assert summary.inserted == [5]
+    assert summary.deactivated == [4]
+
+
+class FakeKMClient:
+    roster = []
+
+    async def ensure_logged_in(self):
+        pass
+
+    async def get_members(self):
+        for member in self.roster:
+            yield member
+
+
+@pytest.mark.asyncio
+async def test_klubmodul_refresh_diff(mocker):
+    mocker.patch.object(km_sessions, "_client", FakeKMClient())
+    FakeKMClient.roster = [
+        (x, f"test user {x}", TokenType.NORMAL, f"test{x}@test.dk", f"1000100{x}")
+        for x in range(7)
+    ] + [(100, "new user", TokenType.OFFPEAK, "new@test.dk", "20002000")]
+
+    summary = await refresh()
+    # sample data has no fingerprints yet
+    assert summary.inserted == [100]
+    assert set(summary.deactivated) == {7}
+    assert (await User.select(User.active).where(User.id == 100).first())["active"]
+
+    # nothing changed - nothing is written
+    batch_ids = {u["id"]: u["batch_id"] for u in await User.select(User.id, User.batch_id)}
+    summary = await refresh()
+    assert not summary.changed
+    assert summary.unchanged == 8
+    assert batch_ids == {
+        u["id"]: u["batch_id"] for u in await User.select(User.id, User.batch_id)
+    }
+
+    FakeKMClient.roster[0] = (0, "renamed", TokenType.NORMAL, "test0@test.dk", "10001000")
+    summary = await refresh()
+    assert summary.updated == [0]
+    assert summary.write_lock_seconds > 0
+    # the latest summary is kept in the database for the system status
+    assert await last_sync() == summary.as_dict()
+    user = await User.select(User.name, User.mobile).where(User.id == 0).first()
+    assert user == {"name": "renamed", "mobile": simple_hash("10001000")}
+
+    await User.delete().where(User.id == 100)
+
+
+def test_split_records():
+    records, rest = split_records('a;b\n1;"multi\nline"\n2;"x')
+    assert records == ["a;b\n", '1;"multi\nline"\n']
+    assert rest == '2;"x'
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1000])
+async def test_csv_rows_streaming(chunk_size):
+    text = (
+        'ID;Fornavn;Efternavn\r\n1;Søren;"Ærø; Øst"\r\n\r\n'
+        '2;"Anne\nMarie";"says ""hi"""\r\n3;Åse;Last'
+    )
+    data = text.encode("utf-8-sig")
+
+    async def chunks():
+        for i in range(0, len(data), chunk_size):
+            yield data[i : i + chunk_size]
+
+    rows = [row async for row in csv_rows(chunks())]
+    assert rows == list(csv.DictReader(io.StringIO(text, newline=""), delimiter=";"))
+    assert rows[0]["ID"] == "1"
+    assert rows[1]["Fornavn"] == "Anne\nMarie"
@@ -0,0 +1,84 @@
+import json
+import time
+
+import pytest
+from lockoff.access_token import TokenType
+from lockoff.db import Otherticket, User
+from lockoff.membership import (
+    MembershipSnapshot,
+    membership,
+    sign_snapshot,
+    signed_export,
+)
+
+
+@pytest.mark.asyncio
+async def test_membership_snapshot():
+    snapshot = MembershipSnapshot()
+    assert snapshot.age() is None
+
+    await snapshot.rebuild()
+    assert snapshot.version == 1
+    assert snapshot.age() is not None
+    # active users from sample data
+    assert snapshot.is_member(0)
+    assert snapshot.members[0] == TokenType.NORMAL
+    assert snapshot.members[5] == TokenType.OFFPEAK
+    # inactive and unknown users
+    assert not snapshot.is_member(9)
+    assert not snapshot.is_member(1000)
+
+
+@pytest.mark.asyncio
+async def test_membership_snapshot_othertickets():
+    ticket_id = (
+        await Otherticket.insert(
+            Otherticket(id=None, name="test ticket", active=True)
+        ).returning(Otherticket.id)
+    )[0]["id"]
+    snapshot = MembershipSnapshot()
+    await snapshot.rebuild()
+    assert snapshot.is_otherticket(ticket_id)
+
+    # a snapshot does not change until rebuilt
+    await Otherticket.update({Otherticket.active: False}).where(
+        Otherticket.id == ticket_id
+    )
+    await User.update({User.active: False}).where(User.id == 0)
+    assert snapshot.is_otherticket(ticket_id)
+    assert snapshot.is_member(0)
+
+    await snapshot.rebuild()
+    assert not snapshot.is_otherticket(ticket_id)
+    assert not snapshot.is_member(0)
+    assert snapshot.version == 2
+
+
+@pytest.mark.asyncio
+async def test_membership_snapshot_export():
+    snapshot = MembershipSnapshot()
+    await snapshot.rebuild()
+    full = snapshot.export()
+    assert full["since"] is None
+    assert [0, TokenType.NORMAL.value] in full["members"]
+    assert snapshot.export(since=full["batch_id"])["unchanged"]
+
+    await User.update({User.active: False}).where(User.id == 0)
+    await User.update({User.token_type: TokenType.OFFPEAK.value}).where(User.id == 1)
+    await snapshot.rebuild()
+
+    delta = snapshot.export(since=full["batch_id"])
+    assert delta["since"] == full["batch_id"]
+    assert delta["batch_id"] == snapshot.batch_id
+    assert delta["members"] == [[1, TokenType.OFFPEAK.value]]
+    assert delta["removed_members"] == [0]
+    # unknown batch gives the full snapshot
+    assert snapshot.export(since="unknown")["since"] is None
+
+
+def test_signed_export():
+    payload = signed_export()
+    assert payload["signature"] == sign_snapshot(payload["payload"])
+    data = json.loads(payload["payload"])
+    assert data["batch_id"] == membership.batch_id
+    assert abs(data["generated_at"] - time.time()) < 5
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+from lockoff.db import DB, AccessLog, APReg, SchemaVersion
+from lockoff.migrations import (
+    MIGRATIONS,
+    Migration,
+    applied_versions,
+    backfill_access_log,
+    backfill_runner,
+    migrate,
+)
+
+
+@pytest.mark.asyncio
+async def test_migrate_applied():
+    # conftest already migrated the test database
+    assert await migrate() == []
+    assert await applied_versions() >= {m.version for m in MIGRATIONS}
+    indexes = {
+        row["name"]
+        for row in await DB.run_ddl("SELECT name FROM sqlite_master WHERE type = 'index'")
+    }
+    assert {"accesslog_epoch", "users_email", "ap_reg_device_serial"} <= indexes
+    assert "accesslog_timestamp" not in indexes
+    plan = await DB.run_ddl(
+        "EXPLAIN QUERY PLAN SELECT id FROM users WHERE mobile = 'x' AND active = 1"
+    )
+    assert "users_mobile" in plan[0]["detail"]
+
+
+@pytest.mark.asyncio
+async def test_ap_reg_unique():
+    for _ in range(2):
+        await APReg.insert(
+            APReg(device_library_identifier="device-1", serial_number="20241")
+        ).on_conflict(action="DO NOTHING")
+    assert await APReg.count().where(APReg.device_library_identifier == "device-1") == 1
+    await APReg.delete().where(APReg.device_library_identifier == "device-1")
+
+
+@pytest.mark.asyncio
+async def test_migrate_rolls_back_failed_migration():
+    migrations = [
+        Migration(
+            1000,
+            "broken",
+            [
+                "CREATE TABLE migration_test (id INTEGER)",
+                "CREATE INDEX migration_test_missing ON migration_test (missing)",
+            ],
+        )
+    ]
+    with pytest.raises(Exception):
+        await migrate(migrations)
+    assert 1000 not in await applied_versions()
+    assert not await DB.run_ddl(
+        "SELECT name FROM sqlite_master WHERE name = 'migration_test'"
+    )
+
+    migrations[0].statements.pop()
+    assert await migrate(migrations) == [1000]
+    assert await migrate(migrations) == []
+    await DB.run_ddl("DROP TABLE migration_test")
+    await SchemaVersion.delete().where(SchemaVersion.version == 1000)
+
+
+@pytest.mark.asyncio
+async def test_backfill_access_log():
+    # rows as written before the epoch columns
+    for obj_id, timestamp in [
+        (4000, "2023-01-02T08:15:00+01:00"),
+        (4001, "2023-07-02T23:59:59+02:00"),
+        (4002, "not a timestamp"),
+    ]:
+        await AccessLog.insert(
+            AccessLog(id=None, obj_id=obj_id, token_type=1, token_media=1, epoch=0)
+        )
+        await AccessLog.update({AccessLog.timestamp: timestamp}).where(
+            AccessLog.obj_id == obj_id
+        )
+    assert await backfill_access_log(batch_size=2, pause=0) == 3
+    assert await backfill_access_log() == 0
+    rows = await AccessLog.select().where(AccessLog.obj_id >= 4000).order_by(AccessLog.id)
+    assert [(r["epoch"], r["day"], r["hour"], r["timestamp"]) for r in rows] == [
+        (1672643700, 20230102, 8, ""),
+        (1688335199, 20230702, 23, ""),
+        (-1, 0, 0, ""),
+    ]
+    await AccessLog.delete().where(AccessLog.obj_id >= 4000)
+
+
+@pytest.mark.asyncio
+async def test_backfill_runner(mocker):
+    # an error is logged and the backfill tried again
+    backfill = mocker.patch(
+        "lockoff.migrations.backfill_access_log", side_effect=[Exception("locked"), 0]
+    )
+    task = asyncio.create_task(backfill_runner(interval=0))
+    await asyncio.sleep(0.05)
+    assert not task.done()
+    assert backfill.await_count >= 2
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
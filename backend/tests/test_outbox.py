@@ -0,0 +1,157 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+from lockoff.config import settings
+from lockoff.db import OutboxMessage
+from lockoff.klubmodul import KlubmodulException, km_sessions
+from lockoff.outbox import Outbox
+
+
+class FakeKMClient:
+    def __init__(self, fail: int = 0):
+        self.fail = fail
+        self.sent = []
+        self.deleted = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def ensure_logged_in(self):
+        pass
+
+    async def _send(self, kind: str, user_id: int) -> str:
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0.02)
+        self.in_flight -= 1
+        if self.fail:
+            self.fail -= 1
+            raise KlubmodulException("send sms server error: Service Unavailable")
+        self.sent.append((kind, user_id))
+        return f"{kind}-{len(self.sent)}"
+
+    async def send_sms(self, user_id, message, delete_delay):
+        assert delete_delay is None
+        return await self._send("sms", user_id)
+
+    async def send_email(self, user_id, subject, message, delete_delay):
+        assert delete_delay is None
+        return await self._send("newsmail", user_id)
+
+    async def delete_draft(self, row_id):
+        self.deleted.append(row_id)
+
+
+@pytest_asyncio.fixture
+async def km(mocker):
+    await OutboxMessage.delete(force=True)
+    client = FakeKMClient()
+    mocker.patch.object(km_sessions, "_client", client)
+    return client
+
+
+@pytest.mark.asyncio
+async def test_outbox_send_and_delete_drafts(km, monkeypatch):
+    monkeypatch.setattr(settings, "outbox_draft_delete_delay", 0)
+    monkeypatch.setattr(settings, "outbox_draft_delete_batch", 2)
+    outbox = Outbox(concurrency=2)
+    for user_id in range(4):
+        await outbox.add(kind="sms", user_id=user_id, message="code is 123456")
+    await outbox.add(kind="email", user_id=9, subject="AUTHMSG", message="code")
+    assert (await outbox.stats())["queue_depth"] == 5
+
+    assert await outbox.send_due() == 5
+    assert km.max_in_flight == 2
+    assert sorted(km.sent) == [("newsmail", 9)] + [("sms", u) for u in range(4)]
+    stats = await outbox.stats()
+    assert stats["queue_depth"] == 0
+    assert stats["drafts_waiting"] == 5
+    assert stats["sent_last_hour"] == 5
+    assert stats["last_send_latency"] > 0
+
+    # the trails are removed in batches
+    assert await outbox.delete_drafts() == 2
+    assert await outbox.delete_drafts() == 2
+    assert await outbox.delete_drafts() == 1
+    assert await outbox.delete_drafts() == 0
+    assert len(set(km.deleted)) == 5
+    assert not await OutboxMessage.exists().where(OutboxMessage.message != "")
+
+
+@pytest.mark.asyncio
+async def test_outbox_retry(km, monkeypatch):
+    monkeypatch.setattr(settings, "outbox_retry_delay", 0)
+    monkeypatch.setattr(settings, "outbox_max_attempts", 2)
+    outbox = Outbox()
+    km.fail = 1
+    message_id = await outbox.add(kind="sms", user_id=1, message="code")
+    await outbox.send_due()
+    row = await OutboxMessage.select().where(OutboxMessage.id == message_id).first()
+    assert row["state"] == "pending"
+    assert row["attempts"] == 1
+    assert "Service Unavailable" in row["last_error"]
+    assert row["message"] == "code"
+
+    await outbox.send_due()
+    row = await OutboxMessage.select().where(OutboxMessage.id == message_id).first()
+    assert row["state"] == "sent"
+    assert row["draft_id"] == "sms-1"
+
+    # given up after outbox_max_attempts
+    km.fail = 2
+    message_id = await outbox.add(kind="sms", user_id=2, message="code")
+    await outbox.send_due()
+    await outbox.send_due()
+    row = await OutboxMessage.select().where(OutboxMessage.id == message_id).first()
+    assert row["state"] == "failed"
+    # a message never sent does not keep the login code
+    assert row["message"] == ""
+    assert (await outbox.stats())["failed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_outbox_expiry(km, monkeypatch):
+    monkeypatch.setattr(settings, "outbox_retry_delay", 30)
+    monkeypatch.setattr(settings, "outbox_max_attempts", 5)
+    outbox = Outbox()
+    km.fail = 1
+    message_id = await outbox.add(kind="sms", user_id=1, message="code", max_age=120)
+    await outbox.send_due()
+    row = await OutboxMessage.select().where(OutboxMessage.id == message_id).first()
+    # the attempts left all fit in the time the code is good for
+    assert row["state"] == "pending"
+    assert row["next_attempt"] - row["created"] <= 120 / 4 + 1
+
+    # a code past its validity (eg. queued before a restart) is not sent
+    await OutboxMessage.update({OutboxMessage.expires: 1.0}).where(
+        OutboxMessage.id == message_id
+    )
+    await outbox.send_due()
+    row = await OutboxMessage.select().where(OutboxMessage.id == message_id).first()
+    assert row["state"] == "expired"
+    assert row["message"] == ""
+    assert km.sent == []
+    assert (await outbox.stats())["expired"] == 1
+
+    # messages without a max age never expire
+    await outbox.add(kind="email", user_id=2, message="hello")
+    await outbox.send_due()
+    assert km.sent == [("newsmail", 2)]
+
+
+@pytest.mark.asyncio
+async def test_outbox_runner(km):
+    # a message queued before a restart is sent when the runner starts
+    await Outbox().add(kind="sms", user_id=1, message="code")
+    outbox = Outbox(poll_interval=60)
+    task = asyncio.create_task(outbox.runner())
+    await asyncio.sleep(0.1)
+    assert km.sent == [("sms", 1)]
+
+    # adding wakes the runner up
+    await outbox.add(kind="email", user_id=2, message="code")
+    await asyncio.sleep(0.1)
+    assert km.sent == [("sms", 1), ("newsmail", 2)]
+
+    await outbox.stop(task)
+    assert task.done()
@@ -1,16 +1,34 @@
 import asyncio
+import json
 
+import pyotp
 import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
 from freezegun import freeze_time
-from lockoff.access_token import TokenError, TokenType, generate_access_token
+from starlette.websockets import WebSocketDisconnect
+from lockoff.access_token import (
+    TokenError,
+    TokenMedia,
+    TokenType,
+    generate_access_token,
+)
+from lockoff.access_log import access_log_writer
+from lockoff.config import settings
+from lockoff.db import GPass, Otherticket, User
+from lockoff.membership import membership, sign_snapshot
+from lockoff.misc import DISPLAY_CODES
+from lockoff.totp_cache import TOTPVerifier, hotp
 
 # from lockoff.misc import O_CMD, GFXDisplay
+from lockoff.routers import reader
 from lockoff.routers.reader import (
     # Reader,
     # check_dayticket,
     check_member,
     check_qrcode,
     check_totp,
+    recent_grants,
 )
 
 
@@ -36,6 +54,11 @@ async def test_check_qr_code_normal(qr_code, _raise):
 )
 @pytest.mark.asyncio
 async def test_check_qr_code_offpeak(qr_code, _raise):
+    async def check_qrcode(qr_code: str):
+        # each scan at another time of day - not a repeat scan
+        recent_grants.clear()
+        return await reader.check_qrcode(qr_code=qr_code)
+
     # weekday morning allowed
     with freeze_time("2023-01-02 08:00:00"):
         await check_qrcode(qr_code=qr_code)
@@ -63,6 +86,58 @@ async def test_check_qr_code_offpeak(qr_code, _raise):
             await check_qrcode(qr_code=qr_code)
 
 
+@pytest.mark.asyncio
+async def test_check_qr_code_otherticket():
+    rows = await Otherticket.insert(
+        Otherticket(id=None, name="active ticket", active=True),
+        Otherticket(id=None, name="deleted ticket", active=False),
+    ).returning(Otherticket.id)
+    active_id, inactive_id = [row["id"] for row in rows]
+    await membership.rebuild()
+    try:
+        qr_code = generate_access_token(user_id=active_id, token_type=TokenType.OTHER)
+        assert (await check_qrcode(qr_code=qr_code.decode()))[0] == active_id
+        # a ticket deleted in the admin no longer opens the door
+        qr_code = generate_access_token(user_id=inactive_id, token_type=TokenType.OTHER)
+        with pytest.raises(TokenError) as ex:
+            await check_qrcode(qr_code=qr_code.decode())
+        assert ex.value.code == DISPLAY_CODES.NO_MEMBER
+    finally:
+        await Otherticket.delete().where(Otherticket.id.is_in([active_id, inactive_id]))
+        await membership.rebuild()
+
+
+@pytest.mark.asyncio
+async def test_check_qr_code_repeat_scan():
+    qr_code = generate_access_token(user_id=3, token_type=TokenType.NORMAL).decode()
+    with freeze_time("2023-01-02 08:00:00"):
+        await check_qrcode(qr_code=qr_code)
+        queued = access_log_writer.queue.qsize()
+        # repeat scan is answered from the cache without another access log
+        assert await check_qrcode(qr_code=qr_code) == (
+            3,
+            TokenType.NORMAL,
+            TokenMedia.PRINT,
+        )
+        assert access_log_writer.queue.qsize() == queued
+
+        # a membership change evicts the grant
+        await User.update({User.active: False}).where(User.id == 3)
+        await membership.rebuild()
+        with pytest.raises(TokenError):
+            await check_qrcode(qr_code=qr_code)
+        await User.update({User.active: True}).where(User.id == 3)
+        await membership.rebuild()
+
+        # and so does the time window
+        await check_qrcode(qr_code=qr_code)
+        assert qr_code in recent_grants
+        recent_grants.expire(recent_grants.timer() + settings.reader_repeat_window)
+        assert qr_code not in recent_grants
+        await check_qrcode(qr_code=qr_code)
+        assert access_log_writer.queue.qsize() == queued + 2
+
+
 # @pytest.mark.parametrize(
 #     ["qr_code", "_raise"],
 #     (
@@ -90,6 +165,48 @@ async def test_check_totp():
         await check_totp(user_id=1, totp="12345678")
 
 
+@pytest.mark.asyncio
+async def test_totp_verifier_new_pass():
+    verifier = TOTPVerifier()
+    assert not await verifier.verify(user_id=3, otp="12345678")
+    # the pass is found on the next scan even without an invalidate
+    secret = pyotp.random_base32()
+    await GPass.insert(GPass(id="totp-new", user_id=3, totp=secret, status=0))
+    try:
+        assert await verifier.verify(user_id=3, otp=pyotp.TOTP(secret, digits=8).now())
+    finally:
+        await GPass.delete().where(GPass.id == "totp-new")
+
+
+@pytest.mark.asyncio
+async def test_totp_verifier():
+    secret = pyotp.random_base32()
+    await GPass.insert(GPass(id="totp-test", user_id=2, totp=secret, status=0))
+    pyotp_totp = pyotp.TOTP(secret, digits=8)
+    verifier = TOTPVerifier()
+
+    with freeze_time("2023-01-02 08:00:00") as frozen:
+        assert hotp(pyotp_totp.byte_secret(), 1000) == pyotp_totp.generate_otp(1000)
+        code = pyotp_totp.now()
+        assert await verifier.verify(user_id=2, otp=code)
+        assert not await verifier.verify(user_id=2, otp="12345678")
+        # still accepted within the window of 5 buckets
+        frozen.tick(delta=5 * 30)
+        assert await verifier.verify(user_id=2, otp=code)
+        frozen.tick(delta=30)
+        assert not await verifier.verify(user_id=2, otp=code)
+
+        # new secret is only picked up after invalidate
+        new_secret = pyotp.random_base32()
+        await GPass.update({GPass.totp: new_secret}).where(GPass.id == "totp-test")
+        new_code = pyotp.TOTP(new_secret, digits=8).now()
+        assert not await verifier.verify(user_id=2, otp=new_code)
+        verifier.invalidate(user_id=2)
+        assert await verifier.verify(user_id=2, otp=new_code)
+
+    await GPass.delete().where(GPass.id == "totp-test")
+
+
 @pytest.mark.asyncio
 async def test_member():
     await check_member(user_id=0, token_type=TokenType.NORMAL)
@@ -162,3 +279,108 @@ async def test_member():
 
 #     send_message.assert_awaited_once_with(b"S")
 #     buzz_in.assert_not_awaited()
+
+
+def test_reader_endpoints(mocker):
+    mocker.patch.object(settings, "reader_token", "reader-test-token")
+    app = FastAPI()
+    app.include_router(reader.router)
+    ok_token = generate_access_token(user_id=1, token_type=TokenType.NORMAL).decode()
+    headers = {"reader-token": "reader-test-token"}
+
+    with TestClient(app=app, base_url="http://test") as client:
+        response = client.post(
+            "/reader-check-code", json={"qr_code": ok_token}, headers=headers
+        )
+        assert response.status_code == 200
+        assert response.json() == {"status": "K"}
+
+        response = client.post(
+            "/reader-check-code", json={"qr_code": "trash"}, headers=headers
+        )
+        assert response.status_code == 418
+        assert response.json()["detail"]["code"] == "Q"
+
+        response = client.post("/reader-check-code", json={"qr_code": ok_token})
+        assert response.status_code == 403
+
+        # same answers over the websocket tagged with the request id
+        with client.websocket_connect("/reader-ws", headers=headers) as ws:
+            ws.send_json({"id": 1, "qr_code": ok_token})
+            assert ws.receive_json() == {"id": 1, "status": "K"}
+            ws.send_json({"id": 2, "qr_code": "trash"})
+            reply = ws.receive_json()
+            assert reply["id"] == 2
+            assert reply["detail"]["code"] == "Q"
+            # a malformed message is answered and the channel stays up
+            ws.send_text("not json")
+            assert ws.receive_json()["detail"]["code"] == "Q"
+            ws.send_json([1, 2])
+            assert ws.receive_json()["id"] is None
+            ws.send_json({"id": 3, "qr_code": None})
+            reply = ws.receive_json()
+            assert reply["id"] == 3
+            assert reply["detail"]["reason"] == "malformed message"
+            # and so is a scan the backend fails on
+            verdict = mocker.patch.object(
+                reader, "reader_verdict", side_effect=RuntimeError("db locked")
+            )
+            ws.send_json({"id": 4, "qr_code": ok_token})
+            assert ws.receive_json() == {
+                "id": 4,
+                "detail": {"code": "E", "reason": "general error"},
+            }
+            mocker.stop(verdict)
+            ws.send_json({"id": 5, "qr_code": ok_token})
+            assert ws.receive_json() == {"id": 5, "status": "K"}
+
+        # signed snapshot for offline readers
+        response = client.get("/reader-snapshot", headers=headers)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["signature"] == sign_snapshot(data["payload"])
+        batch_id = json.loads(data["payload"])["batch_id"]
+        response = client.get(
+            "/reader-snapshot", params={"since": batch_id}, headers=headers
+        )
+        assert json.loads(response.json()["payload"])["unchanged"]
+
+        # access events spooled on the reader while offline
+        queued = access_log_writer.queue.qsize()
+        response = client.post(
+            "/reader-access-log",
+            json={
+                "events": [
+                    {
+                        "user_id": 1,
+                        "token_type": 1,
+                        "token_media": 1,
+                        "timestamp": "2023-01-02T08:00:00+01:00",
+                    }
+                ]
+            },
+            headers=headers,
+        )
+        assert response.status_code == 200
+        assert access_log_writer.queue.qsize() == queued + 1
+        # a malformed event is refused instead of failing the whole request
+        response = client.post(
+            "/reader-access-log",
+            json={
+                "events": [
+                    {
+                        "user_id": 1,
+                        "token_type": 99,
+                        "token_media": 1,
+                        "timestamp": "yesterday",
+                    }
+                ]
+            },
+            headers=headers,
+        )
+        assert response.status_code == 422
+        assert access_log_writer.queue.qsize() == queued + 1
+
+        with pytest.raises(WebSocketDisconnect):
+            with client.websocket_connect("/reader-ws") as ws:
+                ws.receive_json()
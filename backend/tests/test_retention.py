@@ -0,0 +1,116 @@
+import gzip
+from datetime import date, datetime
+
+import pytest
+from lockoff.access_archive import (
+    COLUMNS,
+    ArchiveError,
+    access_log_between,
+    check_archive_dir,
+    append_rows,
+    month_path,
+    months,
+    read_month,
+)
+from lockoff.config import settings
+from lockoff.db import AccessLog, DailyVisitors, HourlyVisitors
+from lockoff.retention import AccessLogRetention
+from lockoff.rollups import rollups
+
+# a day of its own - see test_rollups
+DAY = 20200406
+
+
+def at(hour: int, minute: int) -> datetime:
+    return datetime(2020, 4, 6, hour, minute, tzinfo=settings.tz)
+
+
+async def rolled_up() -> tuple:
+    daily = await DailyVisitors.select(DailyVisitors.visitors).where(
+        DailyVisitors.day == DAY
+    )
+    hourly = await HourlyVisitors.select(
+        HourlyVisitors.hour, HourlyVisitors.visitors
+    ).where(HourlyVisitors.day == DAY)
+    return daily, hourly
+
+
+@pytest.mark.asyncio
+async def test_retention(tmp_path, log_access):
+    retention = AccessLogRetention(days=365, directory=tmp_path, pause=0)
+    for obj_id, hour, minute in [(6000, 10, 0), (6001, 10, 30), (6000, 18, 0)]:
+        await log_access(obj_id, at(hour, minute))
+    # the newest row is never moved
+    assert await retention.run(today=date(2021, 4, 7)) == 0
+    await log_access(6009, datetime.now(tz=settings.tz))
+
+    assert await retention.run(today=date(2021, 4, 6)) == 0
+    assert await retention.run(today=date(2021, 4, 7)) == 3
+    assert await AccessLog.count().where(AccessLog.day == DAY) == 0
+    assert months(tmp_path) == ["2020-04"]
+    assert [r["obj_id"] for r in read_month(tmp_path, "2020-04")] == [6000, 6001, 6000]
+    assert retention.stats()["archive_months"] == 1
+
+    # the stats keep the moved rows - also after a rebuild
+    before = await rolled_up()
+    assert before == (
+        [{"visitors": 2}],
+        [{"hour": 10, "visitors": 2}, {"hour": 18, "visitors": 1}],
+    )
+    await rollups.rebuild(archive_dir=tmp_path)
+    assert await rolled_up() == before
+
+    # archive and table read together
+    await log_access(6002, at(11, 0))
+    rows = await access_log_between(DAY, DAY, tmp_path)
+    assert [r["obj_id"] for r in rows] == [6000, 6002, 6001, 6000]
+    assert await access_log_between(DAY + 1, DAY + 1, tmp_path) == []
+
+    # a late row is appended to the month
+    await log_access(6009, datetime.now(tz=settings.tz))
+    assert await retention.run(today=date(2021, 4, 7)) == 1
+    archived = read_month(tmp_path, "2020-04")
+    assert len(archived) == 4
+    with gzip.open(month_path(tmp_path, "2020-04"), "rt") as f:
+        assert f.read().count("id,obj_id") == 1
+
+    # rows archived twice (died before the delete) are read once
+    append_rows(tmp_path, "2020-04", archived[:2])
+    assert len(read_month(tmp_path, "2020-04")) == 4
+    # and a torn append leaves the rows before it
+    with open(month_path(tmp_path, "2020-04"), "ab") as f:
+        f.write(gzip.compress(b"1,2,3")[:10])
+    assert len(read_month(tmp_path, "2020-04")) == 4
+    # the next append cuts the torn member off first
+    late = dict(archived[0], id=archived[-1]["id"] + 1)
+    append_rows(tmp_path, "2020-04", [late])
+    assert len(read_month(tmp_path, "2020-04")) == 5
+
+
+def test_archive_damaged_member(tmp_path):
+    rows = [dict(zip(COLUMNS, [i, 6000, 1, 1, 0, DAY, 10])) for i in range(1, 4)]
+    append_rows(tmp_path, "2020-04", rows[:1])
+    # a member torn in the middle of the file (as before appends cut it off)
+    with open(month_path(tmp_path, "2020-04"), "ab") as f:
+        f.write(gzip.compress(b"7,7,7,7,7,7,7\n" * 100)[:30])
+        f.write(gzip.compress(b"2,6000,1,1,0,20200406,10\n"))
+    # the members on both sides of it are read
+    assert [r["id"] for r in read_month(tmp_path, "2020-04")] == [1, 2]
+    append_rows(tmp_path, "2020-04", rows[2:])
+    assert [r["id"] for r in read_month(tmp_path, "2020-04")] == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_retention_refuses_unsafe_archive(tmp_path, log_access):
+    (tmp_path / "file").write_text("")
+    retention = AccessLogRetention(days=365, directory=tmp_path / "file" / "archive")
+    await log_access(6100, at(10, 0))
+    await log_access(6109, datetime.now(tz=settings.tz))
+    assert await retention.run(today=date(2021, 4, 7)) == 0
+    assert "cannot create" in retention.stats()["archive_error"]
+    assert await AccessLog.count().where(AccessLog.day == DAY) == 1
+
+    # not on the database volume (nor a mount) - the container's own disk
+    with pytest.raises(ArchiveError):
+        check_archive_dir(tmp_path, db_file="/proc/version")
+    check_archive_dir(tmp_path, db_file=str(tmp_path / "lockoff.db3"))
@@ -0,0 +1,85 @@
+from datetime import datetime
+
+import pytest
+from lockoff.access_token import TokenType
+from lockoff.config import settings
+from lockoff.db import AccessLog, DailyVisitors, HourlyVisitors, VisitDay
+from lockoff.migrations import backfill_access_log
+from lockoff.rollups import rollups, usual_visitors
+
+# a day of its own - see test_retention
+DAY = 20200302
+
+
+def at(hour: int, minute: int) -> datetime:
+    return datetime(2020, 3, 2, hour, minute, tzinfo=settings.tz)
+
+
+async def daily() -> dict:
+    return {
+        TokenType(row["token_type"]).name: row["visitors"]
+        for row in await DailyVisitors.select().where(DailyVisitors.day == DAY)
+    }
+
+
+async def hourly() -> dict:
+    return {
+        row["hour"]: row["visitors"]
+        for row in await HourlyVisitors.select().where(HourlyVisitors.day == DAY)
+    }
+
+
+@pytest.mark.asyncio
+async def test_rollups_catch_up(log_access):
+    await rollups.catch_up()
+    for obj_id, token_type, hour, minute in [
+        (5000, TokenType.NORMAL, 17, 10),
+        (5000, TokenType.NORMAL, 17, 40),
+        (5000, TokenType.NORMAL, 18, 20),
+        (5001, TokenType.OFFPEAK, 17, 30),
+        (5000, TokenType.DAY_TICKET, 19, 0),
+    ]:
+        await log_access(obj_id, at(hour, minute), token_type)
+    assert await rollups.catch_up() == 5
+    assert await rollups.catch_up() == 0
+    assert await daily() == {"NORMAL": 1, "OFFPEAK": 1, "DAY_TICKET": 1}
+    assert await hourly() == {17: 2, 18: 1, 19: 1}
+    assert await VisitDay.select(VisitDay.day).where(
+        (VisitDay.obj_id == 5000) & (VisitDay.token_type == TokenType.NORMAL.value)
+    ) == [{"day": DAY}]
+
+    # a late row (offline reader) is counted in its own day and hour
+    await log_access(5002, at(17, 5))
+    assert await rollups.catch_up() == 1
+    assert (await daily())["NORMAL"] == 2
+    assert (await hourly())[17] == 3
+
+    # 16:30-18:30 a week later - 5000 stays from 17 to 18 and counts once
+    later = datetime(2020, 3, 9, 18, 30, tzinfo=settings.tz)
+    assert await usual_visitors(later) == 3
+    assert await usual_visitors(later.replace(day=10)) == 0
+
+    assert await rollups.rebuild() == await AccessLog.count()
+    assert await daily() == {"NORMAL": 2, "OFFPEAK": 1, "DAY_TICKET": 1}
+    assert await hourly() == {17: 3, 18: 1, 19: 1}
+    assert (await rollups.stats())["behind"] == 0
+
+
+@pytest.mark.asyncio
+async def test_rollups_wait_for_backfill(log_access):
+    await rollups.catch_up()
+    # an old row not yet converted by the backfill holds back the rows after it
+    await AccessLog.insert(
+        AccessLog(id=None, obj_id=5003, token_type=1, token_media=1, epoch=0)
+    )
+    await log_access(5004, at(12, 0))
+    assert await rollups.catch_up() == 0
+    stats = await rollups.stats()
+    assert stats["blocked_on_backfill"]
+    assert stats["unconverted_rows"] == 1
+    assert await backfill_access_log(pause=0) == 1
+    # the unreadable old row is passed over
+    assert await rollups.catch_up() == 2
+    assert await hourly() == {12: 1}
+    assert not (await rollups.stats())["blocked_on_backfill"]
+    await AccessLog.delete().where(AccessLog.obj_id == 5003)
@@ -0,0 +1,94 @@
+import asyncio
+import itertools
+import json
+import logging
+from typing import Optional
+
+from websockets.asyncio.client import ClientConnection, connect
+from websockets.exceptions import WebSocketException
+
+from .config import settings
+
+log = logging.getLogger(__name__)
+
+
+class ChannelUnavailable(Exception):
+    pass
+
+
+class BackendChannel:
+    """long-lived websocket to the backend /reader-ws endpoint
+
+    scans are sent as {"id": n, "qr_code": "..."} and the verdicts come back
+    tagged with the same id, so several scans can be in flight at once.
+    The runner keeps the connection up and reconnects with backoff.
+    """
+
+    def __init__(self, url: str = settings.backend_ws_url):
+        self.url = url
+        self._ws: Optional[ClientConnection] = None
+        self._pending: dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+
+    @property
+    def connected(self) -> bool:
+        return self._ws is not None
+
+    async def runner(self, one_time_run: bool = False):
+        backoff = 0.5
+        while True:
+            try:
+                async with connect(
+                    self.url,
+                    additional_headers={"reader-token": settings.reader_token},
+                    open_timeout=5,
+                    ping_interval=20,
+                ) as ws:
+                    log.info(f"connected to {self.url}")
+                    self._ws = ws
+                    backoff = 0.5
+                    async for raw in ws:
+                        try:
+                            message = json.loads(raw)
+                            future = self._pending.pop(message["id"], None)
+                        except (ValueError, TypeError, KeyError) as ex:
+                            # one bad frame must not take the channel down
+                            log.warning(f"ignoring malformed frame {raw!r:.100} {ex!r}")
+                            continue
+                        if future and not future.done():
+                            future.set_result(message)
+            except (OSError, asyncio.TimeoutError, WebSocketException) as ex:
+                log.warning(f"backend channel error {ex!r}")
+            finally:
+                self._ws = None
+                # scans in flight will not get an answer on this connection
+                for future in self._pending.values():
+                    if not future.done():
+                        future.set_exception(ChannelUnavailable("connection lost"))
+                self._pending.clear()
+            if one_time_run:
+                break
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+    async def check(self, qr_code: str, timeout: float = 5) -> dict:
+        """send a scan and wait for the verdict
+
+        Raises
+        ------
+        ChannelUnavailable
+            if not connected (or the connection drops before the answer)
+        """
+        if self._ws is None:
+            raise ChannelUnavailable("not connected")
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            try:
+                await self._ws.send(json.dumps({"id": request_id, "qr_code": qr_code}))
+            except WebSocketException as ex:
+                raise ChannelUnavailable(str(ex))
+            return await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            self._pending.pop(request_id, None)
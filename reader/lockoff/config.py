@@ -28,9 +28,40 @@ class Settings(BaseSettings):
     sentry_dsn: str = ""
     opticon_url: str = "/dev/OPTICON"
     display_url: str = "/dev/DISPLAY"
+    # the display firmware shows SYSTEM ERROR after 2s without a byte - keep this below
+    display_keepalive: float = 1.5
+    # how long the firmware keeps a verdict up (idle frames are ignored meanwhile)
+    display_verdict_hold: float = 5.0
     tz: tzfile = gettz("Europe/Copenhagen")
     backend_url: str = ""
+    # optional websocket to the backend eg. wss://host/reader-ws (backend_url is the fallback)
+    backend_ws_url: str = ""
     reader_token: str = ""
+    # seconds the relay holds the door open after the latest grant
+    relay_open_time: float = 4.0
+    # scan pipeline
+    scan_queue_size: int = 4
+    scan_dedup_window: float = 1.0
+    # a scan waiting longer than this for a verify slot is dropped
+    scan_stale_after: float = 5.0
+    # the whole online check (backend_url or the websocket) - see Reader.verdict_stale_after
+    verify_timeout: float = 5.0
+    verify_concurrency: int = 2
+    # scans slower than this (serial read to last action) are kept for /slow-scans
+    slow_scan_threshold: float = 1.0
+    slow_scan_buffer: int = 50
+    # offline verification when the backend misses the latency budget
+    offline_enabled: bool = False
+    offline_latency_budget: float = 1.5
+    offline_refresh_interval: int = 60
+    # no offline grants on a snapshot older than this (a cancelled membership
+    # would keep opening the door while the backend is away)
+    offline_snapshot_max_age: float = 2 * 24 * 3600
+    offline_snapshot_file: str = "/data/offline-snapshot.json"
+    offline_spool_file: str = "/data/offline-spool.ndjson"
+    secret: bytes = "changeme"
+    nonce_size: int = 4
+    digest_size: int = 10
 
     @classmethod
     def settings_customise_sources(
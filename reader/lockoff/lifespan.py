@@ -1,10 +1,15 @@
 import asyncio
 from contextlib import asynccontextmanager
 
+import httpx
+
 from fastapi import FastAPI
 
+from .channel import BackendChannel
+from .config import settings
 from .misc import GFXDisplay, watchdog
-from .reader import Reader
+from .offline import OfflineVerifier
+from .reader import Reader, ReaderAuth
 
 
 @asynccontextmanager
@@ -14,9 +19,22 @@ async def lifespan(app: FastAPI):
     await display.setup()
     display_task = asyncio.create_task(display.runner())
     watchdog.watch(display_task)
+    # optional long-lived websocket to the backend
+    channel = None
+    if settings.backend_ws_url:
+        channel = BackendChannel()
+        channel_task = asyncio.create_task(channel.runner())
+        watchdog.watch(channel_task)
+    # optional offline verification with a replicated membership snapshot
+    offline = None
+    if settings.offline_enabled:
+        offline = OfflineVerifier()
+        offline_session = httpx.AsyncClient(auth=ReaderAuth())
+        offline_task = asyncio.create_task(offline.runner(session=offline_session))
+        watchdog.watch(offline_task)
     # start opticon reader
     reader = Reader()
-    await reader.setup(display=display)
+    await reader.setup(display=display, channel=channel, offline=offline)
     opticon_task = asyncio.create_task(reader.runner())
     watchdog.watch(opticon_task)
     yield
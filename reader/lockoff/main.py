@@ -2,9 +2,12 @@ import logging
 
 import sentry_sdk
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
 
 from .config import settings
 from .lifespan import lifespan, watchdog
+from .metrics import metrics
+from .misc import door
 
 log = logging.getLogger(__name__)
 
@@ -27,3 +30,21 @@ async def healthz():
             status_code=500, detail="watchdog report a task is not running"
         )
     return {"everything": "is awesome"}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    # prometheus text format
+    return PlainTextResponse(
+        metrics.render() + door.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/door")
+async def door_state():
+    return door.state()
+
+
+@app.get("/slow-scans")
+async def slow_scans():
+    return list(metrics.slow_scans)
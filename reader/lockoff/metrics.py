@@ -0,0 +1,122 @@
+import bisect
+import collections
+from datetime import datetime
+from typing import Optional
+
+from .config import settings
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# stage -> the mark it is timed from - a scan is marked when the serial read
+# completed ("read"), when verification starts ("queued"), when the backend
+# answered ("backend"), when the display and opticon are written and when the
+# relay is energized
+STAGES = {
+    "queued": "read",
+    "backend": "queued",
+    "display": "backend",
+    "opticon": "display",
+    "relay": "backend",
+}
+
+
+class Histogram:
+    """prometheus style histogram with one series per label value"""
+
+    def __init__(self, name: str, help: str, label: str, buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self._counts: dict[str, list[int]] = {}
+        self._sums: dict[str, float] = collections.defaultdict(float)
+
+    def observe(self, value: str, seconds: float) -> None:
+        counts = self._counts.setdefault(value, [0] * (len(self.buckets) + 1))
+        counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self._sums[value] += seconds
+
+    def quantile(self, value: str, q: float) -> Optional[float]:
+        """estimate like prometheus histogram_quantile (linear within a bucket)"""
+        counts = self._counts.get(value)
+        if not counts:
+            return None
+        rank, cumulative, lower = q * sum(counts), 0, 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, counts in sorted(self._counts.items()):
+            label = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {self._sums[value]:.6f}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+class ReaderMetrics:
+    """per-stage scan latency, scan outcomes and a ring buffer of slow scans"""
+
+    def __init__(self):
+        self.stages = Histogram(
+            "lockoff_reader_stage_seconds", "time spent in each scan stage", "stage"
+        )
+        self.scans = Histogram(
+            "lockoff_reader_scan_seconds",
+            "serial read completed to last action for a scan",
+            "outcome",
+        )
+        self.outcomes: collections.Counter[str] = collections.Counter()
+        self.slow_scans: collections.deque[dict] = collections.deque(
+            maxlen=settings.slow_scan_buffer
+        )
+
+    def dropped(self, reason: str) -> None:
+        self.outcomes[reason] += 1
+
+    def finish(self, scan, outcome: str) -> None:
+        """record the marks of a scan once it has been acted on"""
+        self.outcomes[outcome] += 1
+        marks = scan.marks
+        for stage, since in STAGES.items():
+            if stage in marks and since in marks:
+                self.stages.observe(stage, marks[stage] - marks[since])
+        total = max(marks.values()) - marks["read"]
+        self.scans.observe(outcome, total)
+        if total >= settings.slow_scan_threshold:
+            self.slow_scans.append(
+                {
+                    "seq": scan.seq,
+                    "at": datetime.now(tz=settings.tz).isoformat(timespec="seconds"),
+                    "outcome": outcome,
+                    "total": round(total, 4),
+                    "stages": {
+                        stage: round(marks[stage] - marks[since], 4)
+                        for stage, since in STAGES.items()
+                        if stage in marks and since in marks
+                    },
+                }
+            )
+
+    def render(self) -> str:
+        lines = self.stages.render() + self.scans.render()
+        lines += [
+            "# HELP lockoff_reader_scans_total scans by outcome",
+            "# TYPE lockoff_reader_scans_total counter",
+        ]
+        for outcome, count in sorted(self.outcomes.items()):
+            lines.append(f'lockoff_reader_scans_total{{outcome="{outcome}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+metrics = ReaderMetrics()
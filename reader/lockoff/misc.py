@@ -1,7 +1,9 @@
 import asyncio
 import logging
 import pathlib
+import time
 from datetime import datetime
+from typing import Optional
 
 import serial_asyncio
 from gpiozero import LED
@@ -20,6 +22,7 @@ class DISPLAY_CODES:
     GENERIC_ERROR = b"E"
     DAYTICKET_EXPIRED = b"D"
     NO_MEMBER = b"C"
+    OFFPEAK_OUTSIDE_HOURS = b"M"
     QR_ERROR = b"Q"
     QR_ERROR_SIGNATURE = b"S"
     QR_ERROR_EXPIRED = b"X"
@@ -35,11 +38,67 @@ class O_CMD:
     DETRIGGER = bytes([0x1B, 0x59, 0xD])
 
 
-async def buzz_in(sleep: int = 4):
-    print("buzzing in")
-    relay.on()
-    await asyncio.sleep(sleep)
-    relay.off()
+class RelayController:
+    """keeps the door open until a single deadline
+
+    a grant while the door is already open moves the deadline instead of
+    starting another on/sleep/off cycle - so an earlier grant can not close
+    the door on the person behind
+    """
+
+    def __init__(self):
+        self.open_until: float = 0.0
+        self.openings: int = 0
+        self.coalesced: int = 0
+        self._closer: Optional[asyncio.Task] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._closer is not None and not self._closer.done()
+
+    def open(self, seconds: float = settings.relay_open_time):
+        self.open_until = max(self.open_until, time.monotonic() + seconds)
+        if self.is_open:
+            self.coalesced += 1
+            return
+        log.info("buzzing in")
+        self.openings += 1
+        relay.on()
+        self._closer = asyncio.create_task(self._close_at_deadline())
+
+    async def _close_at_deadline(self):
+        try:
+            while (remaining := self.open_until - time.monotonic()) > 0:
+                await asyncio.sleep(remaining)
+        finally:
+            relay.off()
+
+    def state(self) -> dict:
+        return {
+            "open": self.is_open,
+            "open_for": round(max(0.0, self.open_until - time.monotonic()), 2)
+            if self.is_open
+            else 0.0,
+            "openings": self.openings,
+            "coalesced": self.coalesced,
+        }
+
+    def render(self) -> str:
+        # prometheus text format - appended to /metrics
+        return (
+            "# HELP lockoff_reader_door_open 1 while the relay holds the door open\n"
+            "# TYPE lockoff_reader_door_open gauge\n"
+            f"lockoff_reader_door_open {int(self.is_open)}\n"
+            "# HELP lockoff_reader_door_openings_total times the relay opened the door\n"
+            "# TYPE lockoff_reader_door_openings_total counter\n"
+            f"lockoff_reader_door_openings_total {self.openings}\n"
+            "# HELP lockoff_reader_door_coalesced_total grants while already open\n"
+            "# TYPE lockoff_reader_door_coalesced_total counter\n"
+            f"lockoff_reader_door_coalesced_total {self.coalesced}\n"
+        )
+
+
+door = RelayController()
 
 
 class Watchdog:
@@ -59,27 +118,64 @@ watchdog = Watchdog()
 
 
 class GFXDisplay:
+    """keeps track of what the display shows and only writes when needed
+
+    the firmware shows SYSTEM ERROR if no byte arrives for 2s so an idle frame
+    goes out as keep-alive once display_keepalive has passed since the last
+    write (any write counts). A verdict is written right away and the firmware
+    keeps it up for 5s ignoring idle frames - after that the idle frame is sent
+    as a state change.
+    """
+
+    def __init__(self):
+        self.shown: Optional[bytes] = None
+        self.last_sent: float = 0.0
+        self.verdict_until: float = 0.0
+
     async def setup(self, url=settings.display_url):
         _, display_w = await serial_asyncio.open_serial_connection(url=url)
         self.display_w = display_w
 
+    @staticmethod
+    def idle_frame() -> bytes:
+        # show screensaver at nightime idle
+        return b"," if datetime.now(tz=settings.tz).hour < 7 else b"."
+
+    def next_frame(self, now: float) -> tuple[Optional[bytes], float]:
+        """the idle frame to send now (or None) and seconds until the next check"""
+        keepalive_due = self.last_sent + settings.display_keepalive
+        idle = self.idle_frame()
+        if now < self.verdict_until:
+            # the verdict stays up - only keep the firmware fed
+            if now >= keepalive_due:
+                return idle, settings.display_keepalive
+            return None, min(self.verdict_until, keepalive_due) - now
+        if self.shown != idle or now >= keepalive_due:
+            return idle, settings.display_keepalive
+        return None, keepalive_due - now
+
     async def runner(self, one_time_run: bool = False):
-        # send idle
         while True:
-            now = datetime.now(tz=settings.tz)
             async with lock:
-                # show screensaver at nightime idle
-                if now.hour < 7:
-                    self.display_w.write(b",")
-                else:
-                    self.display_w.write(b".")
-                await self.display_w.drain()
+                now = time.monotonic()
+                frame, wait = self.next_frame(now)
+                if frame is not None:
+                    await self._write(frame)
+                    if now >= self.verdict_until:
+                        self.shown = frame
             if one_time_run:
                 break
-            await asyncio.sleep(1.5)
+            await asyncio.sleep(wait)
 
     async def send_message(self, message: bytes):
+        # verdicts do not wait for the idle schedule
         async with lock:
             log.info(f"display send message {message.decode('utf-8')}")
-            self.display_w.write(message)
-            await self.display_w.drain()
+            await self._write(message)
+            self.shown = message
+            self.verdict_until = self.last_sent + settings.display_verdict_hold
+
+    async def _write(self, frame: bytes):
+        self.display_w.write(frame)
+        await self.display_w.drain()
+        self.last_sent = time.monotonic()
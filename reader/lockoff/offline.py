@@ -0,0 +1,255 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import pathlib
+import secrets
+import struct
+import time
+from datetime import date, datetime
+from enum import Enum
+from typing import Optional
+
+import base45
+import httpx
+
+from .config import settings
+from .misc import DISPLAY_CODES
+
+log = logging.getLogger(__name__)
+
+
+class TokenType(Enum):
+    # same values as the backend
+    NORMAL = 1
+    OFFPEAK = 2
+    DAY_TICKET = 3
+    JUNIOR_HOLD = 4
+    BØRNE_HOLD = 5
+    OTHER = 9
+
+
+MEMBER_TYPES = {
+    TokenType.NORMAL,
+    TokenType.OFFPEAK,
+    TokenType.JUNIOR_HOLD,
+    TokenType.BØRNE_HOLD,
+}
+
+
+class OfflineVerifier:
+    """verify qr codes on the reader when the backend is slow or unreachable
+
+    keeps a replica of the signed membership snapshot from /reader-snapshot
+    (full at first and then deltas keyed by batch_id) on local disk, checks
+    tokens with the same shake_256 scheme as the backend and spools granted
+    access events to disk until they can be replayed to /reader-access-log
+
+    the android totp suffix can not be checked offline - the backend does not
+    hand out the totp secrets. Nothing is granted offline once the snapshot is
+    older than offline_snapshot_max_age (by the signed generated_at)
+    """
+
+    layout = struct.Struct(
+        f">IIHH{settings.nonce_size}s{settings.digest_size}s"
+    )
+
+    def __init__(
+        self,
+        snapshot_file: str = settings.offline_snapshot_file,
+        spool_file: str = settings.offline_spool_file,
+    ):
+        self.snapshot_file = pathlib.Path(snapshot_file)
+        self.spool_file = pathlib.Path(spool_file)
+        self.batch_id: Optional[str] = None
+        # when the backend made the snapshot (unix time)
+        self.generated_at: Optional[float] = None
+        self.members: dict[int, int] = {}
+        self.othertickets: set[int] = set()
+        self.signed_size = 12 + settings.nonce_size
+        self.encoded_size = (self.layout.size // 2) * 3 + (self.layout.size % 2) * 2
+        base_url = httpx.URL(settings.backend_url)
+        self.snapshot_url = base_url.join("reader-snapshot")
+        self.access_log_url = base_url.join("reader-access-log")
+
+    # snapshot replica
+
+    def load(self) -> None:
+        if not self.snapshot_file.exists():
+            return
+        data = json.loads(self.snapshot_file.read_text())
+        self.batch_id = data["batch_id"]
+        self.generated_at = data.get("generated_at")
+        self.members = {int(u): tt for u, tt in data["members"]}
+        self.othertickets = set(data["othertickets"])
+        log.info(f"loaded offline snapshot {self.batch_id} with {len(self.members)} members")
+
+    def save(self) -> None:
+        tmp = self.snapshot_file.with_suffix(".tmp")
+        tmp.write_text(
+            json.dumps(
+                {
+                    "batch_id": self.batch_id,
+                    "generated_at": self.generated_at,
+                    "members": list(self.members.items()),
+                    "othertickets": sorted(self.othertickets),
+                }
+            )
+        )
+        tmp.replace(self.snapshot_file)
+
+    def apply(self, payload: str, signature: str) -> bool:
+        """apply a signed snapshot (or delta) - returns True if anything changed"""
+        expected = hmac.new(settings.secret, payload.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(expected, signature):
+            log.error("offline snapshot has a bad signature - ignoring it")
+            return False
+        data = json.loads(payload)
+        generated_at = data.get("generated_at")
+        if generated_at is None or (
+            self.generated_at is not None and generated_at < self.generated_at
+        ):
+            log.warning(f"offline snapshot from {generated_at} is older than ours")
+            return False
+        if data.get("unchanged"):
+            # still current - only saved with the next change
+            self.generated_at = generated_at
+            return False
+        if data["since"] is None:
+            self.members = dict(data["members"])
+            self.othertickets = set(data["othertickets"])
+        elif data["since"] == self.batch_id:
+            self.members.update(data["members"])
+            for user_id in data["removed_members"]:
+                self.members.pop(user_id, None)
+            self.othertickets.update(data["othertickets"])
+            self.othertickets.difference_update(data["removed_othertickets"])
+        else:
+            log.warning(f"delta since {data['since']} does not match {self.batch_id}")
+            return False
+        self.batch_id = data["batch_id"]
+        self.generated_at = generated_at
+        return True
+
+    async def refresh(self, session: httpx.AsyncClient) -> None:
+        params = {"since": self.batch_id} if self.batch_id else {}
+        response = await session.get(self.snapshot_url, params=params, timeout=30)
+        response.raise_for_status()
+        data = response.json()
+        if self.apply(payload=data["payload"], signature=data["signature"]):
+            self.save()
+            log.info(f"offline snapshot now {self.batch_id} with {len(self.members)} members")
+
+    # verification
+
+    def age(self) -> Optional[float]:
+        """seconds since the backend made the snapshot (None if there is none)"""
+        if self.generated_at is None:
+            return None
+        return time.time() - self.generated_at
+
+    def check(self, qr_code: str) -> tuple[bool, bytes]:
+        """offline version of the backend check - returns (granted, display message)"""
+        age = self.age()
+        if age is None or age > settings.offline_snapshot_max_age:
+            log.warning(f"offline snapshot is too old to grant access ({age})")
+            return False, DISPLAY_CODES.GENERIC_ERROR
+        try:
+            raw_token = base45.b45decode(qr_code[: self.encoded_size])
+            user_id, expires, type_, media_, _, signature = self.layout.unpack(raw_token)
+            token_type = TokenType(type_)
+        except Exception as ex:
+            log.warning(f"offline could not decode token {ex}")
+            return False, DISPLAY_CODES.QR_ERROR
+        digest = hashlib.shake_256(raw_token[: self.signed_size] + settings.secret).digest(
+            settings.digest_size
+        )
+        if not secrets.compare_digest(digest, signature):
+            return False, DISPLAY_CODES.QR_ERROR_SIGNATURE
+        if time.time() > expires:
+            return False, DISPLAY_CODES.QR_ERROR_EXPIRED
+        if token_type in MEMBER_TYPES:
+            if user_id not in self.members:
+                return False, DISPLAY_CODES.NO_MEMBER
+            if token_type == TokenType.OFFPEAK and not self._offpeak_allowed():
+                return False, DISPLAY_CODES.OFFPEAK_OUTSIDE_HOURS
+        elif token_type == TokenType.OTHER and user_id not in self.othertickets:
+            return False, DISPLAY_CODES.NO_MEMBER
+        log.info(f"offline {user_id} {token_type} access granted")
+        self.spool(user_id=user_id, token_type=type_, token_media=media_)
+        return True, DISPLAY_CODES.OK
+
+    @staticmethod
+    def _offpeak_allowed() -> bool:
+        # same rule as the backend check_member
+        now = datetime.now(tz=settings.tz)
+        if date(now.year, 7, 1) <= now.date() <= date(now.year, 8, 10):
+            return True
+        return not (now.weekday() < 4 and now.hour >= 15)
+
+    # access event spool
+
+    def spool(self, user_id: int, token_type: int, token_media: int) -> None:
+        event = {
+            "user_id": user_id,
+            "token_type": token_type,
+            "token_media": token_media,
+            "timestamp": datetime.now(tz=settings.tz).isoformat(timespec="seconds"),
+        }
+        with self.spool_file.open("a") as f:
+            f.write(json.dumps(event) + "\n")
+            # the event is the only record of the grant until it is replayed
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _read_events(self, path: pathlib.Path) -> list[dict]:
+        events = []
+        for line in path.read_text().splitlines():
+            if not line:
+                continue
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # a line torn by a power loss - the event appended after it
+                # (an event has no nested braces) ended up on the same line
+                try:
+                    events.append(json.loads(line[line.rindex("{") :]))
+                except ValueError:
+                    log.warning(f"skipping a damaged spooled access event {line!r}")
+        return events
+
+    async def replay(self, session: httpx.AsyncClient) -> int:
+        """send spooled access events to the backend in one go"""
+        sending = self.spool_file.with_suffix(".sending")
+        # move the spool aside so scans during the upload go to a new file
+        # (unless an earlier upload failed - then send that first)
+        if not sending.exists():
+            if not self.spool_file.exists():
+                return 0
+            self.spool_file.replace(sending)
+        events = self._read_events(sending)
+        if events:
+            response = await session.post(
+                self.access_log_url, json={"events": events}, timeout=30
+            )
+            response.raise_for_status()
+        sending.unlink()
+        log.info(f"replayed {len(events)} offline access events")
+        return len(events)
+
+    async def runner(self, session: httpx.AsyncClient, one_time_run: bool = False):
+        self.load()
+        while True:
+            try:
+                await self.refresh(session)
+            except Exception as ex:
+                log.warning(f"offline snapshot refresh failed {ex!r}")
+            try:
+                await self.replay(session)
+            except Exception as ex:
+                log.warning(f"offline access event replay failed {ex!r}")
+            if one_time_run:
+                break
+            await asyncio.sleep(settings.offline_refresh_interval)
@@ -1,14 +1,21 @@
 import asyncio
+import itertools
 import logging
 import os
 import signal
+import time
+from dataclasses import dataclass, field
+from typing import Optional
 
 import httpx
 import serial_asyncio
 from serial.serialutil import SerialException
 
+from .channel import BackendChannel, ChannelUnavailable
 from .config import settings
-from .misc import DISPLAY_CODES, O_CMD, GFXDisplay, buzz_in
+from .metrics import metrics
+from .misc import DISPLAY_CODES, O_CMD, GFXDisplay, door
+from .offline import OfflineVerifier
 
 log = logging.getLogger(__name__)
 
@@ -24,11 +31,59 @@ class ReaderAuth(httpx.Auth):
         yield request
 
 
+@dataclass
+class Scan:
+    seq: int
+    qr_code: str
+    scanned_at: float = field(default_factory=time.monotonic)
+    # monotonic time each stage was reached - see metrics.STAGES
+    marks: dict[str, float] = field(default_factory=dict)
+
+    def __post_init__(self):
+        self.marks["read"] = self.scanned_at
+
+    def age(self) -> float:
+        return time.monotonic() - self.scanned_at
+
+    def mark(self, stage: str) -> None:
+        self.marks[stage] = time.monotonic()
+
+
+def offer(queue: asyncio.Queue, item) -> None:
+    """put without waiting - when the queue is full the oldest item is dropped"""
+    if queue.full():
+        queue.get_nowait()
+        log.warning("queue full - dropping the oldest item")
+    queue.put_nowait(item)
+
+
 class Reader:
-    async def setup(self, display: GFXDisplay, url=settings.opticon_url):
+    channel: Optional[BackendChannel] = None
+    offline: Optional[OfflineVerifier] = None
+
+    async def setup(
+        self,
+        display: GFXDisplay,
+        url=settings.opticon_url,
+        channel: Optional[BackendChannel] = None,
+        offline: Optional[OfflineVerifier] = None,
+    ):
         self.display = display
+        self.channel = channel
+        self.offline = offline
         self._r, self._w = await serial_asyncio.open_serial_connection(url=url)
         self.background_tasks = set()
+        # pipeline queues - see runner
+        self.raw_scans: asyncio.Queue[Scan] = asyncio.Queue(maxsize=settings.scan_queue_size)
+        self.scans: asyncio.Queue[Scan] = asyncio.Queue(maxsize=settings.scan_queue_size)
+        self.verdicts: asyncio.Queue[tuple[Scan, bool, bytes]] = asyncio.Queue(
+            maxsize=settings.scan_queue_size
+        )
+        self._verify_slots = asyncio.Semaphore(settings.verify_concurrency)
+        self._seq = itertools.count(1)
+        self._last_seen: dict[str, float] = {}
+        # qr code -> seq of the latest scan of it acted on
+        self._last_actuated: dict[str, int] = {}
         self.session = httpx.AsyncClient(auth=ReaderAuth())
 
     # write opticon command to serial
@@ -37,40 +92,194 @@ class Reader:
             self._w.write(cmd)
         await self._w.drain()
 
+    async def check_code(self, qr_code: str) -> tuple[bool, bytes]:
+        """ask the backend about the qr_code - returns (granted, display message)
+
+        with offline verification enabled the reader decides itself if the
+        backend does not answer within the latency budget
+        """
+        if self.offline is None:
+            # httpx timeouts are per read/write - bound the whole check
+            timeout = settings.verify_timeout
+            return await asyncio.wait_for(
+                self._check_online(qr_code, timeout=timeout), timeout=timeout
+            )
+        budget = settings.offline_latency_budget
+        try:
+            return await asyncio.wait_for(
+                self._check_online(qr_code, timeout=budget), timeout=budget
+            )
+        except (asyncio.TimeoutError, httpx.TransportError) as ex:
+            log.warning(f"backend missed the latency budget ({ex!r}) - checking offline")
+            return self.offline.check(qr_code)
+
+    async def _check_online(self, qr_code: str, timeout: float) -> tuple[bool, bytes]:
+        if self.channel is not None and self.channel.connected:
+            try:
+                reply = await self.channel.check(qr_code, timeout=timeout)
+                if "status" in reply:
+                    return True, reply["status"].encode()
+                return (
+                    False,
+                    reply.get("detail", {})
+                    .get("code", DISPLAY_CODES.GENERIC_ERROR.decode())
+                    .encode(),
+                )
+            except ChannelUnavailable:
+                log.warning("backend channel unavailable - falling back to http")
+        response = await self.session.post(
+            settings.backend_url, json={"qr_code": qr_code}, timeout=timeout
+        )
+        if response.is_success:
+            # get message to show on display from status and fallback to OK
+            return (
+                True,
+                response.json().get("status", DISPLAY_CODES.OK.decode()).encode(),
+            )
+        # if error then get the 418 teapot error in the json detail
+        data = response.json().get("detail", {})
+        return False, data.get("code", DISPLAY_CODES.GENERIC_ERROR.decode()).encode()
+
+    # the scan pipeline - serial ingest -> de-duplication -> verification -> actuation
+    # connected by bounded queues so a slow backend never blocks reading the next scan
+
+    @staticmethod
+    def verdict_stale_after() -> float:
+        """the age a verdict can reach normally - waiting for a slot plus the check
+
+        with a second to spare for the queues, so only a stalled pipeline
+        makes a verdict stale
+        """
+        return settings.scan_stale_after + settings.verify_timeout + 1.0
+
     async def runner(self, one_time_run: bool = False):
+        await asyncio.gather(
+            self.ingest(one_time_run=one_time_run),
+            self.dedup(one_time_run=one_time_run),
+            self.verify(one_time_run=one_time_run),
+            self.actuate(one_time_run=one_time_run),
+        )
+
+    async def ingest(self, one_time_run: bool = False):
         while True:
             try:
                 # read a scan from the barcode reader read until carriage return CR
                 qr_code: str = (
                     (await self._r.readuntil(separator=b"\r")).decode("utf-8").strip()
                 )
-                # check the qr_code
-                response = await self.session.post(
-                    settings.backend_url, json={"qr_code": qr_code}, timeout=5
-                )
-                if response.is_success:
+                offer(self.raw_scans, Scan(seq=next(self._seq), qr_code=qr_code))
+            # serial exception most likely happens if display or qr-reader is disconnected
+            # if it happens then exit the reader code and let docker restart the container
+            except SerialException:
+                log.exception("exit reader due to serial exception")
+                system_exit()
+            except Exception as ex:
+                log.exception(f"generic error reading scan {ex}")
+            # one_time_run is used for testing
+            if one_time_run:
+                break
+
+    async def dedup(self, one_time_run: bool = False):
+        """drop the same code read again within scan_dedup_window (the opticon repeats)"""
+        while True:
+            scan = await self.raw_scans.get()
+            last_seen = self._last_seen.get(scan.qr_code)
+            if last_seen is not None and scan.scanned_at - last_seen < settings.scan_dedup_window:
+                log.info(f"dropping repeated scan {scan.seq}")
+                metrics.dropped("duplicate")
+            else:
+                if len(self._last_seen) > 100:
+                    self._last_seen = {
+                        code: at
+                        for code, at in self._last_seen.items()
+                        if scan.scanned_at - at < settings.scan_dedup_window
+                    }
+                self._last_seen[scan.qr_code] = scan.scanned_at
+                offer(self.scans, scan)
+            if one_time_run:
+                break
+
+    async def verify(self, one_time_run: bool = False):
+        """check scans against the backend - up to verify_concurrency at a time
+
+        while the slots are busy new scans wait in the bounded queue (the oldest
+        is dropped when it is full) so someone scanning again after a slow
+        answer gets a slot of their own
+        """
+        while True:
+            await self._verify_slots.acquire()
+            scan = await self.scans.get()
+            if scan.age() > settings.scan_stale_after:
+                # not worth asking the backend any more - answer with an error
+                # (counted as denied) rather than leave them hanging
+                log.warning(f"not checking stale scan {scan.seq} ({scan.age():.1f}s old)")
+                self._verify_slots.release()
+                await self.verdicts.put((scan, False, DISPLAY_CODES.GENERIC_ERROR))
+                continue
+            task = asyncio.create_task(self._verify(scan))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
+            if one_time_run:
+                await task
+                break
+
+    async def _verify(self, scan: Scan):
+        scan.mark("queued")
+        try:
+            granted, message = await self.check_code(scan.qr_code)
+        except Exception as ex:
+            log.exception(f"error checking scan {scan.seq} {ex}")
+            granted, message = False, DISPLAY_CODES.GENERIC_ERROR
+        finally:
+            self._verify_slots.release()
+            scan.mark("backend")
+        await self.verdicts.put((scan, granted, message))
+
+    def _remember_actuated(self, scan: Scan) -> None:
+        if len(self._last_actuated) > 100:
+            self._last_actuated = {
+                code: seq
+                for code, seq in self._last_actuated.items()
+                if seq > scan.seq - 100
+            }
+        self._last_actuated[scan.qr_code] = scan.seq
+
+    async def actuate(self, one_time_run: bool = False):
+        """relay, display and opticon feedback for verdicts in scan order"""
+        while True:
+            scan, granted, message = await self.verdicts.get()
+            try:
+                if scan.seq < self._last_actuated.get(scan.qr_code, 0):
+                    # a later scan of the same code was answered first
+                    log.info(f"dropping superseded verdict for scan {scan.seq}")
+                    metrics.dropped("superseded")
+                elif granted and scan.age() > self.verdict_stale_after():
+                    # whoever scanned may be gone - keep the door shut but tell
+                    # them to scan again
+                    self._remember_actuated(scan)
+                    log.warning(f"not opening for stale verdict of scan {scan.seq}")
+                    metrics.dropped("stale")
+                    await self.display.send_message(DISPLAY_CODES.GENERIC_ERROR)
+                    await self.o_cmd(cmds=[O_CMD.ERROR_SOUND, O_CMD.ERROR_LED])
+                elif granted:
+                    self._remember_actuated(scan)
                     # buzz in
-                    task = asyncio.create_task(buzz_in())
-                    self.background_tasks.add(task)
-                    task.add_done_callback(self.background_tasks.discard)
-                    # get message to show on display from status and fallback to OK
-                    message = (
-                        response.json()
-                        .get("status", DISPLAY_CODES.OK.decode())
-                        .encode()
-                    )
+                    door.open()
+                    scan.mark("relay")
                     await self.display.send_message(message)
+                    scan.mark("display")
                     # give good sound+led on opticon now qr code is verified
                     await self.o_cmd(cmds=[O_CMD.OK_SOUND, O_CMD.OK_LED])
+                    scan.mark("opticon")
+                    metrics.finish(scan, outcome="granted")
                 else:
-                    # if error then get the 418 teapot error in the json detail
-                    data = response.json().get("detail", {})
-                    await self.display.send_message(
-                        data.get("code", DISPLAY_CODES.GENERIC_ERROR.decode()).encode()
-                    )
+                    # denials and errors are shown however late they are
+                    self._remember_actuated(scan)
+                    await self.display.send_message(message)
+                    scan.mark("display")
                     await self.o_cmd(cmds=[O_CMD.ERROR_SOUND, O_CMD.ERROR_LED])
-            # serial exception most likely happens if display or qr-reader is disconnected
-            # if it happens then exit the reader code and let docker restart the container
+                    scan.mark("opticon")
+                    metrics.finish(scan, outcome="denied")
             except SerialException:
                 log.exception("exit reader due to serial exception")
                 system_exit()
@@ -82,6 +291,5 @@ class Reader:
                     await self.o_cmd(cmds=[O_CMD.ERROR_SOUND, O_CMD.ERROR_LED])
                 except SerialException:
                     system_exit()
-            # one_time_run is used for testing
             if one_time_run:
                 break
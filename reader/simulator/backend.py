@@ -0,0 +1,46 @@
+"""in-process stand-in for the backend /reader-check-code with injected latency"""
+
+import asyncio
+import itertools
+import json
+import random
+import string
+import time
+
+import httpx
+
+
+# display codes handed out as tags so a frame on the display can be traced back
+# to the scan it answers (the idle frames "." and "," are never used)
+TAGS = string.ascii_letters + string.digits
+
+
+class MockBackend:
+    """grants qr codes starting with "ok" and answers 418 for the rest
+
+    every answer is delayed by latency plus a random jitter (seconds). The
+    display code in the answer is a tag unique among the last len(TAGS)
+    requests - tags maps it back to the qr_code, received holds (monotonic
+    time, qr_code) for every request
+    """
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, seed: int = 1234):
+        self.latency = latency
+        self.jitter = jitter
+        self.received: list[tuple[float, str]] = []
+        self.tags: dict[str, str] = {}
+        self._tags = itertools.cycle(TAGS)
+        self._rnd = random.Random(seed)
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        qr_code = json.loads(request.content)["qr_code"]
+        self.received.append((time.monotonic(), qr_code))
+        tag = next(self._tags)
+        self.tags[tag] = qr_code
+        await asyncio.sleep(self.latency + self._rnd.uniform(0, self.jitter))
+        if qr_code.startswith("ok"):
+            return httpx.Response(200, json={"status": tag})
+        return httpx.Response(418, json={"detail": {"code": tag, "reason": "no member"}})
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handler)
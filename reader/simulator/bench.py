@@ -0,0 +1,158 @@
+"""benchmark Reader.runner and GFXDisplay end to end without the pi
+
+the opticon and the display are pty pairs, the relay is a stub and the
+backend answers in-process after an injected latency:
+
+    python -m simulator.bench --rate 2 --scans 200 --latency 0.05 --jitter 0.05
+    python -m simulator.bench --trace scans.txt --latency 1.5 --output sim.json
+
+the report is printed as json - scan to display latency (exact, every verdict
+frame is tagged by the mock backend), the reader's own per-stage histograms,
+what was dropped and how the display link behaved (frames per second and the
+longest gap, which must stay below the firmware's 2s).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import pathlib
+import platform
+import sys
+import time
+from datetime import datetime
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--trace", type=pathlib.Path, help="replay this trace file")
+    parser.add_argument("--scans", type=int, default=100, help="generated trace length")
+    parser.add_argument("--rate", type=float, default=1.0, help="generated scans/sec")
+    parser.add_argument("--deny-share", type=float, default=0.1)
+    parser.add_argument("--repeat-share", type=float, default=0.1)
+    parser.add_argument("--latency", type=float, default=0.05, help="backend seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random seconds")
+    parser.add_argument("--settle", type=float, default=6.0, help="seconds after last scan")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", type=pathlib.Path, help="also write the report here")
+    return parser.parse_args(argv)
+
+
+def percentiles(samples: list[float]) -> dict:
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2)
+
+    return {"n": len(ordered), "p50_ms": pct(0.5), "p95_ms": pct(0.95), "p99_ms": pct(0.99)}
+
+
+async def run(args: argparse.Namespace) -> dict:
+    # imported here as the gpiozero pin factory must be set before lockoff.misc is imported
+    import httpx
+
+    import lockoff.misc
+    from lockoff.metrics import STAGES, metrics
+    from lockoff.misc import GFXDisplay, door
+    from lockoff.reader import Reader, ReaderAuth
+
+    from . import trace as traces
+    from .backend import MockBackend
+    from .devices import FIRMWARE_POLL, DisplaySim, OpticonSim, StubRelay
+
+    if args.trace:
+        trace = traces.load(args.trace)
+    else:
+        trace = traces.generate(
+            scans=args.scans,
+            rate=args.rate,
+            deny_share=args.deny_share,
+            repeat_share=args.repeat_share,
+            seed=args.seed,
+        )
+    opticon, display_dev, relay = OpticonSim(), DisplaySim(), StubRelay()
+    backend = MockBackend(latency=args.latency, jitter=args.jitter, seed=args.seed)
+    lockoff.misc.relay = relay
+    opticon.start()
+    display_dev.start()
+
+    display = GFXDisplay()
+    await display.setup(url=display_dev.port)
+    reader = Reader()
+    await reader.setup(display=display, url=opticon.port)
+    reader.session = httpx.AsyncClient(transport=backend.transport(), auth=ReaderAuth())
+    tasks = [asyncio.create_task(display.runner()), asyncio.create_task(reader.runner())]
+
+    start = time.monotonic()
+    for offset, qr_code in trace:
+        await asyncio.sleep(max(0.0, start + offset - time.monotonic()))
+        opticon.scan(qr_code)
+    await asyncio.sleep(args.settle)
+    end = time.monotonic()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    opticon.close()
+    display_dev.close()
+
+    # scan -> verdict on the display, traced through the backend tag
+    first_scan: dict[str, float] = {}
+    for at, qr_code in opticon.scans:
+        first_scan.setdefault(qr_code, at)
+    to_display = [
+        at - first_scan[backend.tags[frame.decode()]]
+        for at, frame in display_dev.verdicts()
+        if frame.decode() in backend.tags
+    ]
+    to_backend = [at - first_scan[qr_code] for at, qr_code in backend.received]
+    elapsed = end - start
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "trace": str(args.trace) if args.trace else "generated",
+            "latency": args.latency,
+            "jitter": args.jitter,
+        },
+        "scans": len(trace),
+        "distinct_codes": len(first_scan),
+        "backend_requests": len(backend.received),
+        "verdict_frames": len(display_dev.verdicts()),
+        "opticon_feedback": len(opticon.feedback),
+        "relay_activations": len(relay.energized),
+        "door": door.state(),
+        "scan_to_backend": percentiles(to_backend),
+        "scan_to_display": percentiles(to_display),
+        "reader_stages": {
+            stage: {
+                f"p{int(q * 100)}_ms": round(value * 1000, 2)
+                for q in (0.5, 0.95, 0.99)
+                if (value := metrics.stages.quantile(stage, q)) is not None
+            }
+            for stage in STAGES
+        },
+        "reader_outcomes": dict(metrics.outcomes),
+        "display_link": {
+            "frames_per_sec": round(len(display_dev.frames) / elapsed, 2),
+            "max_gap_s": round(display_dev.max_gap(until=end), 3),
+            "firmware_error": display_dev.max_gap(until=end) >= FIRMWARE_POLL,
+        },
+    }
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+    os.environ.setdefault("BACKEND_URL", "http://simulator/reader-check-code")
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""pty backed stand-ins for the opticon scanner and the gfx display plus a relay stub"""
+
+import asyncio
+import os
+import time
+import tty
+
+# feedback commands the reader sends to the opticon (see lockoff.misc.O_CMD)
+OK_SOUND = bytes([0x1B, 0x42, 0xD])
+ERROR_SOUND = bytes([0x1B, 0x45, 0xD])
+# the display firmware shows SYSTEM ERROR after 2s without a byte
+FIRMWARE_POLL = 2.0
+
+
+class PtyDevice:
+    """a pty pair - the reader opens .port like a serial device, we hold the master"""
+
+    def __init__(self):
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        self._slave = slave
+        os.set_blocking(self.master, False)
+        self.received: list[tuple[float, bytes]] = []
+
+    def start(self) -> None:
+        asyncio.get_running_loop().add_reader(self.master, self._read)
+
+    def _read(self) -> None:
+        try:
+            data = os.read(self.master, 1024)
+        except BlockingIOError:
+            return
+        self.on_data(time.monotonic(), data)
+
+    def on_data(self, at: float, data: bytes) -> None:
+        self.received.append((at, data))
+
+    def write(self, data: bytes) -> None:
+        os.write(self.master, data)
+
+    def close(self) -> None:
+        asyncio.get_running_loop().remove_reader(self.master)
+        os.close(self.master)
+        os.close(self._slave)
+
+
+class OpticonSim(PtyDevice):
+    def __init__(self):
+        super().__init__()
+        self.scans: list[tuple[float, str]] = []
+        self._buffer = b""
+        self.feedback: list[tuple[float, bytes]] = []
+
+    def scan(self, qr_code: str) -> None:
+        self.scans.append((time.monotonic(), qr_code))
+        self.write(qr_code.encode() + b"\r")
+
+    def on_data(self, at: float, data: bytes) -> None:
+        # commands are ESC <cmd> CR
+        self._buffer += data
+        while b"\r" in self._buffer:
+            cmd, self._buffer = self._buffer.split(b"\r", 1)
+            cmd += b"\r"
+            if cmd in (OK_SOUND, ERROR_SOUND):
+                self.feedback.append((at, cmd))
+
+
+class DisplaySim(PtyDevice):
+    """records every frame and what the firmware would show"""
+
+    def __init__(self):
+        super().__init__()
+        self.frames: list[tuple[float, bytes]] = []
+
+    def on_data(self, at: float, data: bytes) -> None:
+        self.frames.extend((at, data[i : i + 1]) for i in range(len(data)))
+
+    def verdicts(self) -> list[tuple[float, bytes]]:
+        return [(at, frame) for at, frame in self.frames if frame not in (b".", b",")]
+
+    def max_gap(self, until: float) -> float:
+        """longest time without a byte - above FIRMWARE_POLL the display shows an error"""
+        times = [at for at, _ in self.frames] + [until]
+        return max((b - a for a, b in zip(times, times[1:])), default=0.0)
+
+
+class StubRelay:
+    """replaces the gpiozero LED driving the door relay"""
+
+    def __init__(self):
+        self.is_lit = False
+        self.energized: list[float] = []
+
+    def on(self) -> None:
+        self.energized.append(time.monotonic())
+        self.is_lit = True
+
+    def off(self) -> None:
+        self.is_lit = False
@@ -0,0 +1,41 @@
+"""scan traces - a list of (seconds from start, qr_code)
+
+a trace file has one scan per line: the offset in seconds and the qr code,
+separated by whitespace. Lines starting with # are ignored.
+"""
+
+import pathlib
+import random
+
+
+def load(path: pathlib.Path) -> list[tuple[float, str]]:
+    trace = []
+    for line in path.read_text().splitlines():
+        if not line.strip() or line.startswith("#"):
+            continue
+        offset, qr_code = line.split(maxsplit=1)
+        trace.append((float(offset), qr_code.strip()))
+    return sorted(trace)
+
+
+def generate(
+    scans: int,
+    rate: float,
+    deny_share: float = 0.1,
+    repeat_share: float = 0.1,
+    seed: int = 1234,
+) -> list[tuple[float, str]]:
+    """poisson arrivals at rate scans/sec
+
+    deny_share of the codes are not granted by the mock backend and
+    repeat_share of the scans are read twice by the opticon 0.1-0.3s apart
+    """
+    rnd = random.Random(seed)
+    trace, offset = [], 0.0
+    for n in range(scans):
+        offset += rnd.expovariate(rate)
+        qr_code = f"{'bad' if rnd.random() < deny_share else 'ok'}-{n:06d}"
+        trace.append((offset, qr_code))
+        if rnd.random() < repeat_share:
+            trace.append((offset + rnd.uniform(0.1, 0.3), qr_code))
+    return sorted(trace)
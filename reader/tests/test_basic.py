@@ -4,3 +4,10 @@ from fastapi.testclient import TestClient
 def test_healthz(client: TestClient):
     response = client.get("/healtz")
     assert response.status_code == 200
+
+
+def test_metrics(client: TestClient):
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert isinstance(client.get("/slow-scans").json(), list)
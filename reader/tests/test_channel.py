@@ -0,0 +1,70 @@
+import asyncio
+import json
+
+import pytest
+from websockets.asyncio.server import serve
+
+from lockoff.channel import BackendChannel, ChannelUnavailable
+from lockoff.misc import GFXDisplay
+from lockoff.reader import Reader
+
+
+async def fake_backend(ws):
+    assert ws.request.headers["reader-token"] is not None
+    async for raw in ws:
+        message = json.loads(raw)
+        if message["qr_code"] == "garbled":
+            # frames the reader can not use ahead of the answer
+            for frame in ["not json", "[1]", json.dumps({"status": "K"})]:
+                await ws.send(frame)
+            await ws.send(json.dumps({"id": message["id"], "status": "K"}))
+        elif message["qr_code"] == "ok":
+            await ws.send(json.dumps({"id": message["id"], "status": "K"}))
+        else:
+            await ws.send(
+                json.dumps({"id": message["id"], "detail": {"code": "S", "reason": ""}})
+            )
+
+
+@pytest.mark.asyncio
+async def test_channel_check():
+    async with serve(fake_backend, "127.0.0.1", 0) as server:
+        port = server.sockets[0].getsockname()[1]
+        channel = BackendChannel(url=f"ws://127.0.0.1:{port}")
+        with pytest.raises(ChannelUnavailable):
+            await channel.check("ok")
+
+        task = asyncio.create_task(channel.runner())
+        for _ in range(50):
+            if channel.connected:
+                break
+            await asyncio.sleep(0.01)
+        assert channel.connected
+
+        # several scans in flight at once get their own answer
+        replies = await asyncio.gather(channel.check("ok"), channel.check("bad"))
+        assert replies[0]["status"] == "K"
+        assert replies[1]["detail"]["code"] == "S"
+
+        # malformed frames are skipped and the connection stays up
+        assert (await channel.check("garbled"))["status"] == "K"
+        assert channel.connected
+
+        # the reader uses the channel when connected
+        reader = Reader()
+        reader.channel = channel
+        assert await reader.check_code("ok") == (True, b"K")
+        assert await reader.check_code("bad") == (False, b"S")
+
+        task.cancel()
+
+
+@pytest.mark.asyncio
+async def test_reader_http_fallback(mocker, mock_serial, httpx_mock):
+    httpx_mock.add_response(method="POST", json={"status": "K"})
+    channel = BackendChannel(url="ws://127.0.0.1:1")
+    reader = Reader()
+    await reader.setup(display=GFXDisplay(), url=mock_serial.port, channel=channel)
+
+    # not connected - the http endpoint is used
+    assert await reader.check_code("ok") == (True, b"K")
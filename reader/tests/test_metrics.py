@@ -0,0 +1,45 @@
+from lockoff.config import settings
+from lockoff.metrics import Histogram, ReaderMetrics
+from lockoff.reader import Scan
+
+
+def test_histogram_render():
+    histogram = Histogram("test_seconds", "test", "stage", buckets=(0.1, 1.0))
+    histogram.observe("backend", 0.05)
+    histogram.observe("backend", 0.5)
+    histogram.observe("backend", 5)
+    lines = histogram.render()
+    assert 'test_seconds_bucket{stage="backend",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="backend",le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{stage="backend",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="backend"} 3' in lines
+
+
+def test_reader_metrics():
+    metrics = ReaderMetrics()
+    scan = Scan(seq=1, qr_code="test", scanned_at=100)
+    scan.marks.update(queued=100.01, backend=100.5, display=100.51, opticon=100.52)
+    metrics.finish(scan, outcome="granted")
+    assert metrics.outcomes["granted"] == 1
+    assert not metrics.slow_scans
+
+    slow = Scan(seq=2, qr_code="test", scanned_at=200)
+    slow.marks.update(queued=200.01, backend=200 + settings.slow_scan_threshold)
+    metrics.finish(slow, outcome="denied")
+    metrics.dropped("stale")
+    assert metrics.slow_scans[0]["seq"] == 2
+    assert metrics.slow_scans[0]["stages"]["backend"] > 0.9
+
+    text = metrics.render()
+    assert 'lockoff_reader_stage_seconds_count{stage="backend"} 2' in text
+    assert 'lockoff_reader_scans_total{outcome="stale"} 1' in text
+
+
+def test_histogram_quantile():
+    histogram = Histogram("test_seconds", "test", "stage", buckets=(0.1, 1.0))
+    assert histogram.quantile("backend", 0.5) is None
+    for _ in range(4):
+        histogram.observe("backend", 0.05)
+    histogram.observe("backend", 0.5)
+    assert histogram.quantile("backend", 0.5) == 0.0625
+    assert 0.1 < histogram.quantile("backend", 0.99) <= 1.0
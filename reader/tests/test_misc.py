@@ -2,7 +2,7 @@ import pytest
 import asyncio
 from datetime import datetime
 from lockoff.config import settings
-from lockoff.misc import GFXDisplay, buzz_in
+from lockoff.misc import GFXDisplay, RelayController
 
 
 @pytest.mark.asyncio
@@ -22,6 +22,8 @@ async def test_display(mock_serial):
     assert stub.called
     assert stub.calls == 1
 
+    # idle frame once the verdict hold is over
+    lcd.verdict_until = 0
     now = datetime.now(tz=settings.tz)
     stub = mock_serial.stub(
         send_bytes=b"",
@@ -35,8 +37,48 @@ async def test_display(mock_serial):
 
 
 @pytest.mark.asyncio
-async def test_buzz_in(mocker):
+async def test_relay_controller(mocker):
     relay = mocker.patch("lockoff.misc.relay")
-    await buzz_in(sleep=0)
+    door = RelayController()
+    door.open(seconds=0.1)
+    assert door.is_open
+    relay.on.assert_called_once()
+
+    # a second grant extends the deadline instead of toggling the relay
+    await asyncio.sleep(0.05)
+    door.open(seconds=0.1)
+    await asyncio.sleep(0.07)
+    assert door.is_open
+    relay.off.assert_not_called()
+    assert door.state()["coalesced"] == 1
+
+    await asyncio.sleep(0.1)
+    assert not door.is_open
     relay.on.assert_called_once()
     relay.off.assert_called_once()
+    assert door.state() == {"open": False, "open_for": 0.0, "openings": 1, "coalesced": 1}
+
+    # the next grant opens the door again
+    door.open(seconds=0.01)
+    assert door.state()["openings"] == 2
+    assert relay.on.call_count == 2
+    await asyncio.sleep(0.03)
+
+
+def test_display_next_frame():
+    lcd = GFXDisplay()
+    idle = lcd.idle_frame()
+    # nothing shown yet
+    assert lcd.next_frame(now=100)[0] == idle
+
+    # idle is up - wait for the keep-alive
+    lcd.shown, lcd.last_sent = idle, 100
+    assert lcd.next_frame(now=100.5) == (None, settings.display_keepalive - 0.5)
+    assert lcd.next_frame(now=100 + settings.display_keepalive)[0] == idle
+
+    # a verdict is up - keep-alive only until the hold is over
+    lcd.shown, lcd.verdict_until = b"K", 100 + settings.display_verdict_hold
+    assert lcd.next_frame(now=100.5)[0] is None
+    lcd.last_sent = lcd.verdict_until - 0.1
+    assert lcd.next_frame(now=lcd.verdict_until - 0.05)[0] is None
+    assert lcd.next_frame(now=lcd.verdict_until)[0] == idle
@@ -0,0 +1,181 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import secrets
+import struct
+import time
+
+import base45
+import httpx
+import pytest
+
+from lockoff.config import settings
+from lockoff.misc import DISPLAY_CODES
+from lockoff.offline import OfflineVerifier, TokenType
+from lockoff.reader import Reader
+
+
+def make_token(user_id: int, token_type: TokenType, expires: int) -> str:
+    # same scheme as the backend access_token
+    data = struct.pack(
+        f">IIHH{settings.nonce_size}s",
+        user_id,
+        expires,
+        token_type.value,
+        1,
+        secrets.token_bytes(settings.nonce_size),
+    )
+    digest = hashlib.shake_256(data + settings.secret).digest(settings.digest_size)
+    return base45.b45encode(data + digest).decode()
+
+
+def signed(data: dict) -> tuple[str, str]:
+    payload = json.dumps({"generated_at": int(time.time()), **data})
+    return payload, hmac.new(settings.secret, payload.encode(), hashlib.sha256).hexdigest()
+
+
+@pytest.fixture
+def verifier(tmp_path):
+    verifier = OfflineVerifier(
+        snapshot_file=tmp_path / "snapshot.json", spool_file=tmp_path / "spool.ndjson"
+    )
+    payload, signature = signed(
+        {
+            "batch_id": "b1",
+            "since": None,
+            "members": [[1, TokenType.NORMAL.value], [2, TokenType.NORMAL.value]],
+            "othertickets": [7],
+        }
+    )
+    assert verifier.apply(payload, signature)
+    return verifier
+
+
+def test_offline_apply(verifier):
+    assert verifier.members == {1: TokenType.NORMAL.value, 2: TokenType.NORMAL.value}
+    # bad signature is ignored
+    payload, _ = signed({"batch_id": "evil", "since": None, "members": [], "othertickets": []})
+    assert not verifier.apply(payload, "00")
+    assert verifier.batch_id == "b1"
+    # delta against the current batch
+    payload, signature = signed(
+        {
+            "batch_id": "b2",
+            "since": "b1",
+            "members": [[3, TokenType.OFFPEAK.value]],
+            "removed_members": [2],
+            "othertickets": [],
+            "removed_othertickets": [7],
+        }
+    )
+    assert verifier.apply(payload, signature)
+    assert verifier.members == {1: TokenType.NORMAL.value, 3: TokenType.OFFPEAK.value}
+    assert verifier.othertickets == set()
+    # and survives a restart
+    verifier.save()
+    restarted = OfflineVerifier(
+        snapshot_file=verifier.snapshot_file, spool_file=verifier.spool_file
+    )
+    restarted.load()
+    assert restarted.batch_id == "b2"
+    assert restarted.members == verifier.members
+    assert restarted.generated_at == verifier.generated_at
+    # an older snapshot (eg. replayed) is not applied
+    payload, signature = signed(
+        {
+            "batch_id": "b0",
+            "since": None,
+            "members": [],
+            "othertickets": [],
+            "generated_at": verifier.generated_at - 60,
+        }
+    )
+    assert not verifier.apply(payload, signature)
+    assert verifier.batch_id == "b2"
+
+
+def test_offline_check(verifier):
+    expires = int(time.time()) + 60
+    assert verifier.check(make_token(1, TokenType.NORMAL, expires)) == (
+        True,
+        DISPLAY_CODES.OK,
+    )
+    assert verifier.check(make_token(9, TokenType.NORMAL, expires)) == (
+        False,
+        DISPLAY_CODES.NO_MEMBER,
+    )
+    assert verifier.check(make_token(1, TokenType.NORMAL, int(time.time()) - 1)) == (
+        False,
+        DISPLAY_CODES.QR_ERROR_EXPIRED,
+    )
+    assert verifier.check(make_token(7, TokenType.OTHER, expires))[0]
+    assert verifier.check("garbage") == (False, DISPLAY_CODES.QR_ERROR)
+    # only granted scans are spooled
+    assert len(verifier.spool_file.read_text().splitlines()) == 2
+
+
+def test_offline_check_stale_snapshot(verifier):
+    token = make_token(1, TokenType.NORMAL, int(time.time()) + 60)
+    verifier.generated_at -= settings.offline_snapshot_max_age + 1
+    assert verifier.check(token) == (False, DISPLAY_CODES.GENERIC_ERROR)
+    # an unchanged reply from the backend brings it up to date again
+    payload, signature = signed({"batch_id": "b1", "since": "b1", "unchanged": True})
+    assert not verifier.apply(payload, signature)
+    assert verifier.check(token) == (True, DISPLAY_CODES.OK)
+    # no snapshot at all
+    verifier.generated_at = None
+    assert verifier.check(token) == (False, DISPLAY_CODES.GENERIC_ERROR)
+
+
+@pytest.mark.asyncio
+async def test_offline_replay(verifier, httpx_mock):
+    verifier.check(make_token(1, TokenType.NORMAL, int(time.time()) + 60))
+    httpx_mock.add_response(method="POST", status_code=503)
+    async with httpx.AsyncClient() as session:
+        with pytest.raises(httpx.HTTPStatusError):
+            await verifier.replay(session)
+        # a later scan goes to a new spool while the failed batch is retried
+        verifier.check(make_token(2, TokenType.NORMAL, int(time.time()) + 60))
+        httpx_mock.add_response(method="POST", json={})
+        httpx_mock.add_response(method="POST", json={})
+        assert await verifier.replay(session) == 1
+        assert await verifier.replay(session) == 1
+        assert await verifier.replay(session) == 0
+    sent = json.loads(httpx_mock.get_requests()[-1].content)
+    assert sent["events"][0]["user_id"] == 2
+
+
+@pytest.mark.asyncio
+async def test_offline_replay_torn_spool(verifier, httpx_mock):
+    verifier.check(make_token(1, TokenType.NORMAL, int(time.time()) + 60))
+    # a power loss while spooling leaves a line without its end
+    with verifier.spool_file.open("a") as f:
+        f.write('{"user_id": 1, "token_ty')
+    verifier.check(make_token(2, TokenType.NORMAL, int(time.time()) + 60))
+    with verifier.spool_file.open("a") as f:
+        f.write("not json\n")
+    httpx_mock.add_response(method="POST", json={})
+    async with httpx.AsyncClient() as session:
+        assert await verifier.replay(session) == 2
+        assert await verifier.replay(session) == 0
+    sent = json.loads(httpx_mock.get_requests()[-1].content)
+    assert [event["user_id"] for event in sent["events"]] == [1, 2]
+
+
+@pytest.mark.asyncio
+async def test_reader_offline_fallback(verifier, httpx_mock):
+    async def slow_response(request: httpx.Request):
+        await asyncio.sleep(1)
+        return httpx.Response(status_code=200, json={"status": "K"})
+
+    httpx_mock.add_callback(slow_response)
+    reader = Reader()
+    reader.offline = verifier
+    reader.session = httpx.AsyncClient()
+    settings.offline_latency_budget = 0.1
+    try:
+        token = make_token(1, TokenType.NORMAL, int(time.time()) + 60)
+        assert await reader.check_code(token) == (True, DISPLAY_CODES.OK)
+    finally:
+        settings.offline_latency_budget = 1.5
@@ -1,9 +1,12 @@
 import asyncio
+import time
 
 import pytest
-from lockoff.misc import O_CMD, GFXDisplay
+from lockoff.misc import DISPLAY_CODES, O_CMD, GFXDisplay
 from lockoff.reader import (
     Reader,
+    Scan,
+    offer,
 )
 from lockoff.config import settings
 
@@ -13,7 +16,7 @@ async def test_reader_ok(mocker, mock_serial, httpx_mock):
     httpx_mock.add_response(
         method="POST", url=settings.backend_url, json={"status": "K"}
     )
-    buzz_in = mocker.patch("lockoff.reader.buzz_in")
+    door = mocker.patch("lockoff.reader.door")
     send_message = mocker.patch("lockoff.misc.GFXDisplay.send_message")
     display = GFXDisplay()
 
@@ -37,7 +40,7 @@ async def test_reader_ok(mocker, mock_serial, httpx_mock):
     stream_writer.assert_any_call(O_CMD.OK_LED)
 
     send_message.assert_awaited_once_with(b"K")
-    buzz_in.assert_awaited_once()
+    door.open.assert_called_once()
 
 
 @pytest.mark.asyncio
@@ -48,7 +51,7 @@ async def test_reader_fail(mocker, mock_serial, httpx_mock):
         json={"detail": {"code": "Q", "reason": "failed to do something"}},
         status_code=418,
     )
-    buzz_in = mocker.patch("lockoff.reader.buzz_in")
+    door = mocker.patch("lockoff.reader.door")
     send_message = mocker.patch("lockoff.misc.GFXDisplay.send_message")
     display = GFXDisplay()
 
@@ -72,4 +75,80 @@ async def test_reader_fail(mocker, mock_serial, httpx_mock):
     stream_writer.assert_any_call(O_CMD.ERROR_LED)
 
     send_message.assert_awaited_once_with(b"Q")
-    buzz_in.assert_not_awaited()
+    door.open.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_reader_pipeline(mocker, mock_serial):
+    door = mocker.patch("lockoff.reader.door")
+    send_message = mocker.patch("lockoff.misc.GFXDisplay.send_message")
+    mocker.patch("asyncio.StreamWriter.write")
+    reader = Reader()
+    await reader.setup(display=GFXDisplay(), url=mock_serial.port)
+
+    backend_slow = asyncio.Event()
+
+    async def check_code(qr_code: str):
+        if qr_code == "slow":
+            await backend_slow.wait()
+        return True, qr_code[0].upper().encode()
+
+    reader.check_code = check_code
+    stages = [
+        asyncio.create_task(stage())
+        for stage in [reader.dedup, reader.verify, reader.actuate]
+    ]
+
+    offer(reader.raw_scans, Scan(seq=1, qr_code="slow"))
+    # the opticon repeating the same code is dropped
+    offer(reader.raw_scans, Scan(seq=2, qr_code="slow"))
+    # someone scanning again is not stuck behind the slow answer
+    offer(reader.raw_scans, Scan(seq=3, qr_code="fast"))
+    await asyncio.sleep(0.05)
+    send_message.assert_awaited_once_with(b"F")
+
+    # the late answer for another code still counts
+    backend_slow.set()
+    await asyncio.sleep(0.05)
+    assert send_message.await_args_list == [mocker.call(b"F"), mocker.call(b"S")]
+    assert door.open.call_count == 2
+
+    for stage in stages:
+        stage.cancel()
+
+
+@pytest.mark.asyncio
+async def test_reader_superseded_and_stale(mocker, mock_serial):
+    door = mocker.patch("lockoff.reader.door")
+    send_message = mocker.patch("lockoff.misc.GFXDisplay.send_message")
+    mocker.patch("asyncio.StreamWriter.write")
+    reader = Reader()
+    await reader.setup(display=GFXDisplay(), url=mock_serial.port)
+    actuate = asyncio.create_task(reader.actuate())
+
+    # a late answer for a code scanned again and answered since is dropped
+    await reader.verdicts.put((Scan(seq=2, qr_code="again"), False, b"Q"))
+    await reader.verdicts.put((Scan(seq=1, qr_code="again"), False, b"R"))
+    await asyncio.sleep(0.05)
+    send_message.assert_awaited_once_with(b"Q")
+
+    # past the verify timeout the door stays shut but the error is shown
+    old = time.monotonic() - reader.verdict_stale_after() - 1
+    await reader.verdicts.put((Scan(seq=3, qr_code="old", scanned_at=old), True, b"K"))
+    await reader.verdicts.put((Scan(seq=4, qr_code="old2", scanned_at=old), False, b"E"))
+    await asyncio.sleep(0.05)
+    assert send_message.await_args_list[1:] == [
+        mocker.call(DISPLAY_CODES.GENERIC_ERROR),
+        mocker.call(b"E"),
+    ]
+    door.open.assert_not_called()
+    assert reader.verdict_stale_after() > settings.scan_stale_after + settings.verify_timeout
+
+    actuate.cancel()
+
+
+def test_offer_drops_oldest():
+    queue = asyncio.Queue(maxsize=2)
+    for seq in range(3):
+        offer(queue, seq)
+    assert [queue.get_nowait(), queue.get_nowait()] == [1, 2]
@@ -0,0 +1,24 @@
+import pytest
+
+from simulator import bench, trace
+
+
+def test_generate_trace():
+    scans = trace.generate(scans=50, rate=10, deny_share=0.5, repeat_share=0.5)
+    assert len({qr_code for _, qr_code in scans}) == 50
+    assert len(scans) > 50
+    assert [offset for offset, _ in scans] == sorted(offset for offset, _ in scans)
+
+
+@pytest.mark.asyncio
+async def test_simulator_end_to_end(mocker):
+    # bench.run swaps in a relay stub - let mocker put the real one back
+    mocker.patch("lockoff.misc.relay")
+    args = bench.parse_args(
+        ["--scans", "3", "--rate", "20", "--repeat-share", "0", "--settle", "0.5"]
+    )
+    report = await bench.run(args)
+    assert report["backend_requests"] == 3
+    assert report["verdict_frames"] == 3
+    assert report["scan_to_display"]["n"] == 3
+    assert not report["display_link"]["firmware_error"]